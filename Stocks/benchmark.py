@@ -0,0 +1,437 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pytz
+
+import metrics
+import time_tools
+from time_tools import interval_dict, period_dict, open_days, open_time, close_time, day_denom
+
+# Benchmarks for the hot paths of the stock pipeline
+# Run with: python benchmark.py [timestamps | ingest | compare]
+#
+# The ingest benchmark runs the whole Stock pipeline against a throwaway
+# local PostgreSQL server (initdb on the PATH, or the pgserver package)
+# with synthetic upstream data, so it needs neither network access nor
+# the database of database.ini. Results are appended to a JSON lines file
+# with the git commit they were measured at, for comparing commits.
+
+# Stock methods timed by the ingest benchmark, in the order they are run
+download_methods = ['download_stock_info', 'download_stock_financials',
+                    'download_stock_actions', 'download_stock_holders',
+                    'download_stock_price_data']
+
+results_file = 'benchmark_results.jsonl'
+
+
+def legacy_generate_timestamps(period: str, interval: str, end: datetime.datetime) -> list:
+    '''
+    Loop based generate_timestamps, kept as the reference implementation
+    for benchmarking and for checking the vectorized version
+    '''
+
+    end = end.astimezone(pytz.UTC)
+
+    if end.time() > close_time:
+        end = end.replace(hour=close_time.hour, minute=close_time.minute,
+                          second=close_time.second, microsecond=close_time.microsecond)
+    if end.time() < open_time:
+        end = end - datetime.timedelta(days=1)
+        end = end.replace(hour=close_time.hour, minute=close_time.minute,
+                          second=close_time.second, microsecond=close_time.microsecond)
+
+    interval_seconds = interval_dict[interval]
+    timestamps_list = []
+
+    largest_time = datetime.datetime(year=end.year, month=end.month, day=end.day,
+                                     hour=close_time.hour, minute=close_time.minute,
+                                     second=close_time.second, microsecond=close_time.microsecond)
+
+    # Whole day intervals never reach the end time
+    if interval_seconds % day_denom:
+        while largest_time.time() > end.time():
+            largest_time = largest_time - datetime.timedelta(seconds=interval_seconds)
+
+        if largest_time.time() != end.time():
+            timestamps_list.append(end)
+            end = end.replace(hour=largest_time.hour, minute=largest_time.minute,
+                              second=largest_time.second, microsecond=largest_time.microsecond)
+
+    if period_dict.get(period) >= day_denom:
+        start = end.replace(hour=open_time.hour, minute=open_time.minute,
+                            second=open_time.second, microsecond=open_time.microsecond)
+        sub_days = (period_dict.get(period) / day_denom) - 1
+        start = start - datetime.timedelta(days=sub_days)
+    if period_dict.get(period) < day_denom:
+        start = end - datetime.timedelta(seconds=period_dict[period])
+
+    while start < end:
+        if start.time() >= open_time and start.time() < close_time:
+            timestamps_list.append(start)
+        start += datetime.timedelta(seconds=interval_seconds)
+
+    if end not in timestamps_list:
+        timestamps_list.append(end)
+
+    days = sorted(set(timestamp.date() for timestamp in timestamps_list))[::-1]
+
+    offset = 0
+    new_day_dict = {}
+    for day in days:
+        new_day = day - datetime.timedelta(days=offset)
+        if new_day.weekday() not in open_days:
+            offset += new_day.weekday() - max(open_days)
+        new_day_dict[day] = day - datetime.timedelta(days=offset)
+
+    normalised_list = []
+    for timestamp in timestamps_list:
+        new_day = new_day_dict[timestamp.date()]
+        normalised_list.append(timestamp.replace(year=new_day.year, month=new_day.month,
+                                                 day=new_day.day))
+
+    return normalised_list
+
+def benchmark_generate_timestamps(end: datetime.datetime = None,
+                                  periods: list = None, intervals: list = None) -> list:
+    """Time the loop based and vectorized generate_timestamps
+
+    Every period/interval pair is run through both implementations,
+    checked for equal output and timed.
+
+    Parameters:
+    ----------
+    end (datetime.datetime) : end of the periods, defaults to now
+    periods (list) : periods to run, defaults to every key of period_dict
+    intervals (list) : intervals to run, defaults to every key of interval_dict
+
+    Returns:
+    ----------
+    list : one dict per pair with the timestamp count, both timings and the speedup
+    """
+
+    if end is None:
+        end = datetime.datetime.now(datetime.timezone.utc)
+    periods = periods or list(period_dict.keys())
+    intervals = intervals or list(interval_dict.keys())
+
+    results = []
+
+    print(f"{'period':>6} {'interval':>8} {'timestamps':>10} {'loop (s)':>10} {'vector (s)':>10} {'speedup':>8}")
+
+    for period in periods:
+        for interval in intervals:
+            start = time.perf_counter()
+            expected = legacy_generate_timestamps(period, interval, end)
+            loop_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            timestamps = time_tools.generate_timestamps(period, interval, end=end)
+            vector_seconds = time.perf_counter() - start
+
+            expected = pd.DatetimeIndex(expected).as_unit('ns').asi8
+            if not np.array_equal(expected, timestamps.asi8):
+                raise Exception(f'generate_timestamps differs from the loop for {period}, {interval}')
+
+            result = {'period': period,
+                      'interval': interval,
+                      'timestamps': len(timestamps),
+                      'loop_seconds': loop_seconds,
+                      'vector_seconds': vector_seconds,
+                      'speedup': loop_seconds / vector_seconds}
+            results.append(result)
+
+            print(f"{period:>6} {interval:>8} {result['timestamps']:>10} {loop_seconds:>10.4f} " \
+                  f"{vector_seconds:>10.4f} {result['speedup']:>7.1f}x")
+
+    return results
+
+
+@contextmanager
+def throwaway_postgres():
+    """Run a PostgreSQL server in a temporary directory for the duration
+    of a with block, deleting it afterwards
+
+    Uses initdb and pg_ctl from the PATH if found, otherwise the pgserver
+    package.
+
+    Yields:
+    ----------
+    dict : keyword arguments of psycopg2.connect
+
+    Raises:
+    ----------
+    Exception : neither initdb nor pgserver is available
+    """
+
+    directory = tempfile.mkdtemp(prefix='stocks_benchmark_')
+
+    try:
+        if shutil.which('initdb') and shutil.which('pg_ctl'):
+            data = os.path.join(directory, 'data')
+            subprocess.run(['initdb', '-D', data, '-U', 'postgres', '--auth=trust'],
+                           check=True, capture_output=True)
+            subprocess.run(['pg_ctl', '-D', data, '-w', '-l', os.path.join(directory, 'log'),
+                            '-o', f"-k {directory} -c listen_addresses=''", 'start'],
+                           check=True, capture_output=True)
+            try:
+                yield {'host': directory, 'dbname': 'postgres', 'user': 'postgres'}
+            finally:
+                subprocess.run(['pg_ctl', '-D', data, '-m', 'fast', 'stop'], capture_output=True)
+        else:
+            try:
+                import pgserver
+            except ImportError:
+                raise Exception('A throwaway PostgreSQL server needs initdb on the PATH ' \
+                                'or the pgserver package (pip install pgserver)')
+
+            server = pgserver.get_server(directory, cleanup_mode='stop')
+            try:
+                yield {'host': directory, 'dbname': 'postgres', 'user': 'postgres'}
+            finally:
+                server.cleanup()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def git_revision() -> dict:
+    '''Commit of the working tree and whether it has uncommitted changes'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, cwd=directory,
+                                capture_output=True, text=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                check=True, cwd=directory, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+def latency_summary(seconds: list) -> dict:
+    '''Count, mean, p50 and p99 (milliseconds) of call durations'''
+    milliseconds = np.array(seconds) * 1000
+    return {'calls': len(milliseconds),
+            'mean_ms': float(milliseconds.mean()),
+            'p50_ms': float(np.percentile(milliseconds, 50)),
+            'p99_ms': float(np.percentile(milliseconds, 99))}
+
+def benchmark_ingest(tickers: int = 20, period: str = '5d', interval: str = '1m',
+                     seed: int = 0, provider=None, maxconn: int = 4,
+                     output: str = results_file) -> dict:
+    """Time the full ingest pipeline of Stock against a throwaway database
+
+    Every ticker runs each of download_methods once, with the freshness
+    TTLs and the response cache disabled so every call does its work.
+
+    Parameters:
+    ----------
+    tickers (int) : number of tickers to ingest
+    period (str) : period of price data downloaded per ticker
+    interval (str) : interval of the price data
+    seed (int) : seed of the synthetic data
+    provider (providers.Provider) : source of upstream data, defaults to
+        a SyntheticProvider with seed
+    maxconn (int) : size of the connection pool
+    output (str) : JSON lines file the result is appended to (None to not save)
+
+    Returns:
+    ----------
+    dict : git revision, parameters, price rows per second, statements
+        (in total and by kind), pool checkouts and connections opened per
+        ticker, and latencies of every download method
+    """
+
+    # Imported here, as they read database.ini on first use
+    import connect
+    from freshness import get_freshness_cache
+    from providers import SyntheticProvider
+    from schema import ensure_schema, forget_schema
+    from stock import Stock
+
+    if provider is None:
+        provider = SyntheticProvider(seed=seed)
+    names = [f'SYN{number:04d}' for number in range(tickers)]
+    no_ttls = {request_type: datetime.timedelta(0) for request_type in
+               ['stock_info', 'stock_financials', 'stock_actions', 'stock_holders', 'stock_price']}
+
+    latencies = {method: [] for method in download_methods}
+
+    # Count statements with an in memory sink alone, for the duration
+    sinks = metrics.get_sinks()
+    sink = metrics.MemorySink()
+    metrics.set_sinks([sink])
+
+    with throwaway_postgres() as params:
+        pool = connect.ConnectionPool(minconn=1, maxconn=maxconn,
+                                      cursor_factory=metrics.MetricsCursor, **params)
+        connect.set_pool(pool)
+        try:
+            forget_schema()
+            get_freshness_cache().forget()
+
+            # Create the tables before timing
+            ensure_schema()
+            sink.reset()
+            start = time.perf_counter()
+
+            for name in names:
+                stock = Stock(name, freshness_ttls=no_ttls)
+                stock.provider = provider
+                stock.response_cache = None
+
+                for method in download_methods:
+                    kwargs = {'period': period, 'interval': interval} \
+                        if method == 'download_stock_price_data' else {}
+                    method_start = time.perf_counter()
+                    getattr(stock, method)(**kwargs)
+                    latencies[method].append(time.perf_counter() - method_start)
+
+            seconds = time.perf_counter() - start
+            snapshot = sink.snapshot()
+
+            with connect.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT count(*) FROM stock_price')
+                price_rows = cursor.fetchone()[0]
+
+            # The tables go with the server
+            forget_schema()
+            get_freshness_cache().forget()
+        finally:
+            connect.close_pool()
+            metrics.set_sinks(sinks)
+
+    price_seconds = sum(latencies['download_stock_price_data'])
+    result = dict(git_revision(),
+                  time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                  benchmark='ingest',
+                  parameters={'tickers': tickers, 'period': period, 'interval': interval,
+                              'seed': seed, 'provider': provider.name, 'maxconn': maxconn},
+                  seconds=seconds,
+                  price_rows=price_rows,
+                  rows_per_second=price_rows / price_seconds if price_seconds else 0.0,
+                  statements_per_ticker=sink.total('sql_statements') / tickers,
+                  statements_by_kind={labels['kind']: value / tickers for name, labels, value
+                                      in snapshot['counters'] if name == 'sql_statements'},
+                  checkouts_per_ticker=sink.total('connection_checkouts') / tickers,
+                  connections_opened_per_ticker=sink.total('connections_opened') / tickers,
+                  latency={method: latency_summary(values) for method, values in latencies.items()})
+
+    print_ingest_result(result)
+    if output:
+        with open(output, 'a') as file:
+            file.write(json.dumps(result) + '\n')
+        print(f'Saved result to {output}')
+
+    return result
+
+
+def print_ingest_result(result: dict) -> None:
+    print(f"\n{result['parameters']['tickers']} tickers in {result['seconds']:.2f} s: " \
+          f"{result['price_rows']} price rows ({result['rows_per_second']:.0f} rows/s), " \
+          f"{result['statements_per_ticker']:.1f} statements, " \
+          f"{result['checkouts_per_ticker']:.1f} connection checkouts and " \
+          f"{result.get('connections_opened_per_ticker', 0):.2f} connections opened per ticker")
+    print(f"{'method':>26} {'calls':>6} {'mean (ms)':>10} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for method, latency in result['latency'].items():
+        print(f"{method:>26} {latency['calls']:>6} {latency['mean_ms']:>10.1f} " \
+              f"{latency['p50_ms']:>10.1f} {latency['p99_ms']:>10.1f}")
+
+def load_results(path: str = results_file, benchmark: str = 'ingest') -> list:
+    '''Read the saved results of a benchmark, oldest first'''
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        results = [json.loads(line) for line in file if line.strip()]
+    return [result for result in results if result.get('benchmark') == benchmark]
+
+def compare_results(base: str, head: str = None, path: str = results_file) -> dict:
+    """Compare the latest ingest results saved at two commits
+
+    Parameters:
+    ----------
+    base (str) : commit (or prefix) to compare against
+    head (str) : commit (or prefix) to compare, defaults to the latest result
+    path (str) : JSON lines file of the results
+
+    Returns:
+    ----------
+    dict : metric: (base value, head value, relative change)
+
+    Raises:
+    ----------
+    KeyError : no result was saved for a commit
+    """
+
+    results = load_results(path)
+
+    def latest(commit: str) -> dict:
+        matching = [result for result in results
+                    if commit is None or (result['commit'] or '').startswith(commit)]
+        if not matching:
+            raise KeyError(f'No ingest result for commit {commit} in {path}')
+        return matching[-1]
+
+    old, new = latest(base), latest(head)
+
+    def metrics(result: dict) -> dict:
+        # Results saved before a metric was added lack it
+        values = {name: result[name] for name in
+                  ['rows_per_second', 'statements_per_ticker', 'checkouts_per_ticker',
+                   'connections_opened_per_ticker'] if name in result}
+        for method, latency in result['latency'].items():
+            values[f'{method} p50_ms'] = latency['p50_ms']
+            values[f'{method} p99_ms'] = latency['p99_ms']
+        return values
+
+    if old['parameters'] != new['parameters']:
+        print(f"Warning: parameters differ ({old['parameters']} vs {new['parameters']})")
+
+    comparison = dict()
+    print(f"{'metric':>40} {(old['commit'] or '')[:8]:>12} {(new['commit'] or '')[:8]:>12} {'change':>8}")
+    old_metrics, new_metrics = metrics(old), metrics(new)
+    for name, old_value in old_metrics.items():
+        new_value = new_metrics.get(name)
+        if new_value is None:
+            continue
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        comparison[name] = (old_value, new_value, change)
+        print(f"{name:>40} {old_value:>12.2f} {new_value:>12.2f} {change:>+8.1%}")
+
+    return comparison
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks of the stock pipeline')
+    commands = arg_parser.add_subparsers(dest='command')
+
+    commands.add_parser('timestamps', help='loop based vs vectorized generate_timestamps')
+
+    ingest_parser = commands.add_parser('ingest', help='full ingest pipeline on synthetic data')
+    ingest_parser.add_argument('--tickers', type=int, default=20)
+    ingest_parser.add_argument('--period', default='5d')
+    ingest_parser.add_argument('--interval', default='1m')
+    ingest_parser.add_argument('--seed', type=int, default=0)
+    ingest_parser.add_argument('--maxconn', type=int, default=4)
+    ingest_parser.add_argument('--output', default=results_file)
+
+    compare_parser = commands.add_parser('compare', help='compare saved ingest results of two commits')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head', nargs='?')
+    compare_parser.add_argument('--output', default=results_file)
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'ingest':
+        benchmark_ingest(tickers=args.tickers, period=args.period, interval=args.interval,
+                         seed=args.seed, maxconn=args.maxconn, output=args.output)
+    elif args.command == 'compare':
+        compare_results(args.base, args.head, path=args.output)
+    else:
+        benchmark_generate_timestamps()
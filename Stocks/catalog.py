@@ -0,0 +1,166 @@
+import threading
+import time
+
+# Created libraries
+from config import config
+from connect import connection
+import metrics
+
+# In-process cache of the columns and types of the tables, shared by type
+# inference, schema evolution (db_tools.adjust_database_columns) and the
+# writer (db_tools.write_dataframe).
+#
+# The columns of every table are loaded in one query on first use, and
+# again once max_age seconds have passed (other processes may alter the
+# tables) or a table missing from the cache is looked up. DDL issued by
+# this process updates the cache in place, so reconciling a dataframe
+# whose types the table already holds needs no round trip.
+
+columns_query = """
+        SELECT table_name, column_name, data_type, character_maximum_length
+        FROM information_schema.columns
+        WHERE table_schema = ANY(current_schemas(false))
+        {condition}
+        ORDER BY table_name, ordinal_position
+"""
+
+
+def column_type(data_type: str, maximum_length: int) -> str:
+    '''Type of a column as written by this package (e.g. varchar(255)), or
+    None for a varchar without a length'''
+    if data_type == 'character varying':
+        return f'varchar({maximum_length})' if type(maximum_length) == int else None
+    return data_type
+
+
+class Catalog:
+    '''
+    Cached column names and types of every table
+    '''
+
+    def __init__(self, max_age: float = 300) -> None:
+        """Initialise instance of Catalog class
+
+        Parameters:
+        ----------
+        max_age (float) : seconds the loaded columns are used before the
+            catalog is read again (None never reads it again)
+        """
+
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        # table name: {column name: type}, in column order
+        self._tables = dict()
+        # monotonic time the catalog was loaded, None if not loaded
+        self._loaded = None
+
+    def read(self, cursor, table_name: str = None) -> dict:
+        """Read the columns of every table (or of one) from the database
+
+        Returns:
+        ----------
+        dict : table name: {column name: type}
+        """
+
+        if table_name is None:
+            cursor.execute(columns_query.format(condition=''))
+        else:
+            cursor.execute(columns_query.format(condition='AND table_name = %s'), (table_name,))
+        metrics.count('catalog_loads', scope='all' if table_name is None else 'table')
+
+        tables = dict()
+        for table, column, data_type, maximum_length in cursor.fetchall():
+            columns = tables.setdefault(table, dict())
+            type_name = column_type(data_type, maximum_length)
+            if type_name is not None:
+                columns[column] = type_name
+        return tables
+
+    def load(self) -> None:
+        '''Read the columns of every table, replacing the cache'''
+        with connection() as conn:
+            tables = self.read(conn.cursor())
+
+        with self._lock:
+            self._tables = tables
+            self._loaded = time.monotonic()
+
+    def reload(self, cursor, table_name: str) -> dict:
+        """Read the columns of one table in the caller's transaction (e.g.
+        before altering it) and cache them
+
+        Returns:
+        ----------
+        dict : column name: type, empty if the table does not exist
+        """
+
+        columns = self.read(cursor, table_name).get(table_name, dict())
+        with self._lock:
+            if columns:
+                self._tables[table_name] = columns
+            else:
+                self._tables.pop(table_name, None)
+        return dict(columns)
+
+    def expired(self) -> bool:
+        if self._loaded is None:
+            return True
+        return self.max_age is not None and time.monotonic() - self._loaded >= self.max_age
+
+    def column_types(self, table_name: str) -> dict:
+        """Get the columns of a table
+
+        Parameters:
+        ----------
+        table_name (str) : name of the table
+
+        Returns:
+        ----------
+        dict : column name: type, in column order (empty if the table does not exist)
+        """
+
+        with self._lock:
+            columns = self._tables.get(table_name)
+            if columns is not None and not self.expired():
+                metrics.count('catalog_hits')
+                return dict(columns)
+
+        self.load()
+        with self._lock:
+            return dict(self._tables.get(table_name, dict()))
+
+    def update(self, table_name: str, column_types: dict) -> None:
+        '''Set the types of columns added or altered by this process
+        (after the DDL is committed)'''
+        with self._lock:
+            self._tables.setdefault(table_name, dict()).update(column_types)
+
+    def forget(self, table_name: str = None) -> None:
+        '''Drop the cached columns of a table, or of every table (e.g.
+        after they are dropped or migrated)'''
+        with self._lock:
+            if table_name is None:
+                self._tables = dict()
+                self._loaded = None
+            else:
+                self._tables.pop(table_name, None)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog() -> Catalog:
+    '''Return the process-wide catalog (max_age is read from the optional
+    catalog section of database.ini)
+    '''
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None:
+            try:
+                max_age = config(section='catalog').get('max_age', 300)
+            except Exception:
+                max_age = 300
+            _catalog = Catalog(max_age=float(max_age) if max_age != '' else None)
+        return _catalog
@@ -1,5 +1,11 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import psycopg2
 from config import config
+import metrics
 
 def connect():
     '''Connect to the PostgreSQL database server'''
@@ -9,12 +15,311 @@ def connect():
         params = config()
 
         # connect to the PostreSQL server
-        print('Connecting to the PostgreSQL database...')
+        metrics.event('database_connect', host=params.get('host'), database=params.get('database'))
         conn = psycopg2.connect(**params)
-        
+
         # return connectoin
         return conn
 
     except (Exception, psycopg2.DatabaseError) as error:
         raise Exception(error)
 
+
+class PoolTimeout(Exception):
+    '''Raised when no connection becomes available within the pool timeout'''
+
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of PostgreSQL connections shared by the whole process
+    '''
+
+    def __init__(self, minconn: int = 1, maxconn: int = 10,
+                 timeout: float = 30.0, health_check_interval: float = 30.0,
+                 **params) -> None:
+        """Initialise instance of ConnectionPool class
+
+        Parameters:
+        ----------
+        minconn (int) : number of connections opened up front and kept idle
+        maxconn (int) : maximum number of connections open at once
+        timeout (float) : seconds to wait for a free connection before failing
+        health_check_interval (float) : seconds a connection may sit idle
+            before it is checked with SELECT 1 on checkout
+        params : keyword arguments passed to psycopg2.connect
+
+        Raises:
+        ----------
+        ValueError : pool sizes are inconsistent
+        """
+
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f'Invalid pool size (minconn: {minconn}, maxconn: {maxconn})')
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.params = params
+
+        self._lock = threading.Condition()
+        # (connection, time returned to pool)
+        self._idle = deque()
+        self._in_use = set()
+        # Slots reserved by checkouts opening or checking a connection
+        self._reserved = 0
+        self._closed = False
+
+        self._stats = {'connections_created': 0,
+                       'connections_discarded': 0,
+                       'checkouts': 0,
+                       'waits': 0,
+                       'wait_time': 0.0,
+                       'timeouts': 0,
+                       'health_checks': 0,
+                       'health_check_failures': 0}
+
+        for _ in range(minconn):
+            self._idle.append((self._create(), time.monotonic()))
+
+    def _create(self):
+        '''Open a connection (without holding the lock)'''
+        conn = psycopg2.connect(**self.params)
+        with self._lock:
+            self._stats['connections_created'] += 1
+        metrics.count('connections_opened')
+        return conn
+
+    def _discard(self, conn) -> None:
+        '''Close a connection (without holding the lock)'''
+        with self._lock:
+            self._stats['connections_discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        '''Check an idle connection before handing it out (without holding the lock)'''
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            healthy = True
+        except psycopg2.Error:
+            healthy = False
+
+        with self._lock:
+            self._stats['health_checks'] += 1
+            if not healthy:
+                self._stats['health_check_failures'] += 1
+        return healthy
+
+    def _reserve(self, deadline: float):
+        """Reserve a connection slot, waiting while the pool is exhausted
+
+        Returns:
+        ----------
+        tuple : (idle connection, time returned to pool), or (None, None)
+            if a new connection may be opened in the reserved slot
+        """
+
+        waited = False
+
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise Exception('Connection pool is closed')
+
+                if self._idle:
+                    self._reserved += 1
+                    return self._idle.pop()
+
+                if len(self._in_use) + self._reserved < self.maxconn:
+                    self._reserved += 1
+                    return None, None
+
+                # Pool exhausted, wait for a connection to be returned
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'No connection available after {self.timeout} seconds')
+                start = time.monotonic()
+                self._lock.wait(remaining)
+                self._stats['wait_time'] += time.monotonic() - start
+
+    def _release(self, conn=None) -> None:
+        '''Turn a reserved slot into a checkout of conn, or free it if conn is None'''
+        with self._lock:
+            self._reserved -= 1
+            if conn is None:
+                self._lock.notify()
+            else:
+                self._in_use.add(conn)
+                self._stats['checkouts'] += 1
+
+    def getconn(self):
+        """Check a connection out of the pool
+
+        Reuse an idle connection if one passes its health check, open a
+        new one while below maxconn, otherwise wait for a connection
+        to be returned. A slot is reserved under the lock, and the
+        connection is opened or health checked outside it, so other
+        checkouts never wait behind a connect or a probe.
+
+        Raises:
+        ----------
+        PoolTimeout : no connection became available within timeout
+        """
+
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            conn, idle_since = self._reserve(deadline)
+
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                self._release()
+                self._discard(conn)
+                continue
+
+            if conn is None:
+                try:
+                    conn = self._create()
+                except BaseException:
+                    self._release()
+                    raise
+
+            self._release(conn)
+            metrics.count('connection_checkouts')
+            return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """Return a connection to the pool
+
+        Parameters:
+        ----------
+        conn : connection previously returned by getconn
+        discard (bool) : close the connection instead of reusing it
+        """
+
+        if not discard and not conn.closed:
+            # Never hand out a connection with an open transaction
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        with self._lock:
+            self._in_use.discard(conn)
+            discard = discard or conn.closed or self._closed or len(self._idle) >= self.maxconn
+            if not discard:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+        if discard:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block
+
+        Commit when the block exits normally and roll back (then
+        re-raise) when it raises.
+        """
+
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def statistics(self) -> dict:
+        '''Return a snapshot of the pool counters'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._in_use)
+        return stats
+
+    def closeall(self) -> None:
+        '''Close every idle connection and refuse further checkouts'''
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._lock.notify_all()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    '''Return the process-wide connection pool, creating it on first use
+
+    Connection parameters are read from the postgresql section of
+    database.ini and pool settings from the optional pool section. If
+    metrics are enabled, statements are counted with metrics.MetricsCursor.
+    '''
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            params = config()
+            if metrics.enabled():
+                params.setdefault('cursor_factory', metrics.MetricsCursor)
+            try:
+                pool_params = config(section='pool')
+            except Exception:
+                pool_params = {}
+
+            _pool = ConnectionPool(
+                minconn=int(pool_params.get('minconn', 1)),
+                maxconn=int(pool_params.get('maxconn', 10)),
+                timeout=float(pool_params.get('timeout', 30)),
+                health_check_interval=float(pool_params.get('health_check_interval', 30)),
+                **params)
+        return _pool
+
+def set_pool(pool: ConnectionPool) -> None:
+    '''Replace the process-wide pool (closing the previous one)'''
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None and _pool is not pool:
+            _pool.closeall()
+        _pool = pool
+
+def close_pool() -> None:
+    '''Close the process-wide pool, if it was created'''
+    set_pool(None)
+
+def connection():
+    '''Check out a pooled connection as a context manager
+
+    Usage:
+        with connection() as conn:
+            cursor = conn.cursor()
+    '''
+    return get_pool().connection()
+
+def pool_statistics() -> dict:
+    '''Return the statistics of the process-wide pool'''
+    return get_pool().statistics()
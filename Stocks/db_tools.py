@@ -1,12 +1,49 @@
+import hashlib
+import io
 import sys
-from connect import connect
+import threading
+import weakref
+from functools import lru_cache
+from catalog import get_catalog
+from connect import connection
+import metrics
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import numpy as np
 import pandas as pd
 import yfinance as yf
 
 # Tools to help with implementation of database functions in stock.py
 # Needs tidying up! 
 
+# name: [min, max], from narrowest to widest
+integer_types = {
+    'smallint': [-32768, 32767],
+    'integer': [-2147483648, 2147483647],
+    'bigint': [-9223372036854775808, 9223372036854775807]
+}
+
+# name: decimal precision, from least to most precise
+# 2*32 is an arbitrarily large number
+float_types = {
+    'real': 6,
+    'double precision': 15,
+    'decimal': 2*32,
+    'numeric': 2*32
+}
+
+bool_values = ['yes', 'true', 'no', 'false']
+true_values = ['yes', 'true']
+
+# Send numpy scalars as plain SQL values (psycopg2 would otherwise use their repr)
+for numpy_type in [np.int8, np.int16, np.int32, np.int64,
+                   np.uint8, np.uint16, np.uint32, np.uint64]:
+    psycopg2.extensions.register_adapter(numpy_type, lambda value: psycopg2.extensions.AsIs(int(value)))
+for numpy_type in [np.float16, np.float32, np.float64]:
+    psycopg2.extensions.register_adapter(numpy_type, lambda value: psycopg2.extensions.Float(float(value)))
+psycopg2.extensions.register_adapter(np.bool_, lambda value: psycopg2.extensions.AsIs(bool(value)))
+
 
 def isfloat(value):
     try:
@@ -23,7 +60,6 @@ def isint(value):
         return False
 
 def isbool(value):
-    bool_values = ['yes', 'true', 'no', 'false']
     return str(value).lower() in bool_values
 
 def convert_type(value):
@@ -43,8 +79,6 @@ def convert_type(value):
     elif isfloat(value):
         return float(value)
     elif isbool(value):
-        # somewhat redunant code, also repetative
-        true_values = ['yes', 'true']
         return value in true_values
 
     elif type(value) == str:
@@ -57,29 +91,10 @@ def get_postgres_type(value):
     Determine the postgresql type of a value
     '''
 
-    # name: storage (bytes)
-    integer_types = {
-        'smallint': [-32768, 32767],
-        'integer': [-2147483648, 2147483647],
-        'bigint': [-9223372036854775808, 9223372036854775807]
-    }
-
-    # name: decimal precision
-    # 2*32 is an arbitrarily large number
-    float_types = {
-        'decimal': 2*32,
-        'numeric': 2*32,
-        'real': 6,
-        'double precision': 15
-    }
-
     value = convert_type(value)
 
     # Integer types
     if type(value) == int:
-        # Sort integer dictionary by size range
-        integer_types = dict(sorted(integer_types.items(), 
-                                    key=lambda item: max(item[1]) + min(item[1])))
         # Determine smallest suitable type
         for key, item in integer_types.items():
             if value <= max(item) and value >= min(item):
@@ -91,9 +106,6 @@ def get_postgres_type(value):
     elif type(value) == float:
         # Get number of decimal places
         decimal_places = lambda x: str(x)[::-1].find('.')
-        # Sort float dictionary by size
-        float_types = dict(sorted(float_types.items(),
-                                  key=lambda item: item[1]))
         # Determine smallest suitable type
         for key, item in float_types.items():
             if decimal_places(value) <= item:
@@ -120,63 +132,16 @@ def get_postgres_type(value):
 
 
 def get_column_types(table_name) -> dict:
-    
-    conn = None
-    
-    try:
+    """Get the columns of a table from the catalog cache (see catalog)
 
-        conn = connect()
-        cursor = conn.cursor()
-
-        # get list of all columns
-        columns_query = f"""
-                        SELECT column_name, data_type, character_maximum_length
-                        FROM information_schema.columns
-                        WHERE table_name = '{table_name}';
-        """
-        cursor.execute(columns_query)
-        columns = cursor.fetchall()
-
-        data_types = dict()
-        for column in columns:
-            if column[1] == 'character varying':
-                if type(column[2]) == int:
-                    data_types[column[0]] = f'varchar({column[2]})'
-            else:
-                data_types[column[0]] = column[1]
-        
-        return data_types
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        # Rollback changes if an error occurs
-        conn.rollback()
-        raise Exception(error)
-    finally:
-        # Commit and close
-        if conn:
-            conn.commit()
-            conn.close()
-            print("Database closed")
+    Returns:
+    ----------
+    dict : column name: type, in column order
+    """
+    return get_catalog().column_types(table_name)
 
 def get_compatible_types(type1, type2):
 
-    # !this is repeated
-    # name: storage (bytes)
-    integer_types = {
-        'smallint': [-32768, 32767],
-        'integer': [-2147483648, 2147483647],
-        'bigint': [-9223372036854775808, 9223372036854775807]
-    }
-
-    # name: decimal precision
-    # 2*32 is an arbitrarily large number
-    float_types = {
-        'decimal': 2*32,
-        'numeric': 2*32,
-        'real': 6,
-        'double precision': 15
-    }
-
     if type1 == type2:
         return type1
     # If both are integer types
@@ -211,131 +176,637 @@ def get_compatible_types(type1, type2):
     else:
         return 'text'
 
-def adjust_database_columns_2(data: pd.DataFrame, table_name: str):
-    """Adjust database columns to account for differing datatypes
-    and new columns
+def is_missing(value) -> bool:
+    '''
+    Determine whether a value should be stored as NULL
+    '''
+    if isinstance(value, (list, tuple, dict)):
+        return False
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
 
-    Iterate through each index in column
-    Get types of each index in column
-    Remove NoneTypes
-    Get most compatible type
-    Change table type
+def get_integer_type(minimum, maximum):
+    '''
+    Determine the narrowest integer type holding values between minimum and maximum
+    '''
+    for key, item in integer_types.items():
+        if minimum >= item[0] and maximum <= item[1]:
+            return key
+    return 'numeric'
 
-    
+def get_float_type(values: np.ndarray):
+    '''
+    Determine the narrowest float type holding an array of floats without loss
+    '''
+    values = values[np.isfinite(values)]
+    if np.array_equal(values.astype(np.float32).astype(np.float64), values):
+        return 'real'
+    return 'double precision'
+
+def infer_column_type(column: pd.Series):
+    """Determine the postgresql type of a dataframe column
+
+    Vectorized equivalent of applying get_postgres_type to every value and
+    merging the results: the type is chosen from the column dtype and
+    whole-column checks (integer range from min/max, float precision from
+    a float32 round trip, string length from the longest string).
+
+    Parameters:
+    ----------
+    column (pd.Series) : column to get the type of
+
+    Returns:
+    ----------
+    str : postgresql type, or None if the column contains only missing values
     """
-    pass
 
-    # for column in list(data.columns):
-    #     column_types = [type(value) for value in data[column]]
+    values = column.dropna()
+    if values.empty:
+        return None
+
+    kind = values.dtype.kind
+
+    if kind == 'b':
+        return 'boolean'
+    if kind in 'iu':
+        return get_integer_type(values.min(), values.max())
+    if kind == 'f':
+        return get_float_type(values.to_numpy(dtype=np.float64))
+    if kind == 'M':
+        if getattr(values.dtype, 'tz', None) is not None:
+            return 'timestamp with time zone'
+        return 'timestamp'
+    if kind == 'm':
+        return 'interval'
+
+    # Object columns: classify by the types of the values
+    inferred = pd.api.types.infer_dtype(values, skipna=True)
+
+    if inferred == 'boolean':
+        return 'boolean'
+    if inferred == 'integer':
+        try:
+            values = values.to_numpy(dtype=np.int64)
+        except OverflowError:
+            return 'numeric'
+        return get_integer_type(values.min(), values.max())
+    if inferred in ('floating', 'mixed-integer-float'):
+        return get_float_type(values.to_numpy(dtype=np.float64))
+    if inferred != 'string':
+        return 'text'
+
+    # Strings may hold numbers or booleans, as in convert_type
+    strings = values.astype(str)
+    stripped = strings.str.strip()
+
+    if stripped.str.fullmatch(r'[+-]?\d+').all():
+        numbers = pd.to_numeric(stripped, errors='coerce')
+        if numbers.notna().all() and numbers.dtype.kind in 'iu':
+            return get_integer_type(numbers.min(), numbers.max())
+        return 'numeric'
+
+    numbers = pd.to_numeric(stripped, errors='coerce')
+    if numbers.notna().all():
+        return get_float_type(numbers.to_numpy(dtype=np.float64))
+
+    if strings.str.lower().isin(bool_values).all():
+        return 'boolean'
 
-    #     # If all entries are none, do nothing with column
-    #     print(column)
-    #     print(column_types)
+    if strings.str.len().max() < 255:
+        return 'varchar(255)'
+    return 'text'
 
-    #     print(all([col == type(None) for col in column_types]))
+def get_dataframe_types(data: pd.DataFrame, column_types: dict = None) -> dict:
+    """Determine the postgresql type of each column of a dataframe
 
+    Columns containing only missing values are left out.
 
-def adjust_database_columns(data: dict, table_name: str):
+    Parameters:
+    ----------
+    data (pd.DataFrame) : data to get the types of
+    column_types (dict) : existing column name: type, e.g. from
+        get_column_types; inferred types are merged with them through
+        get_compatible_types
+
+    Returns:
+    ----------
+    dict : column name: postgresql type
+    """
+
+    data_types = dict()
+
+    for column in data.columns:
+        column_type = infer_column_type(data[column])
+        if column_type is None:
+            continue
+
+        if column_types and column in column_types:
+            column_type = get_compatible_types(column_types[column], column_type)
+        data_types[column] = column_type
+
+    return data_types
+
+def column_changes(info_types: dict, column_types: dict) -> tuple:
+    """Compute the column changes needed for a table to hold data
+
+    Parameters:
+    ----------
+    info_types (dict) : column name: type of the data
+    column_types (dict) : column name: type of the table
+
+    Returns:
+    ----------
+    tuple : (columns to add: type, existing columns to widen: compatible type)
+    """
+
+    # Compute columns not in database
+    excluded_columns = {column: info_type for column, info_type in info_types.items()
+                        if column not in column_types}
+
+    # Compute the type each existing column must have to hold the data
+    compatible_types = dict()
+    for column, info_type in info_types.items():
+        if column in column_types and info_type != column_types[column]:
+            compatible_type = get_compatible_types(column_types[column], info_type)
+            # Columns already of the compatible type (e.g. text) are left as they are
+            if compatible_type != column_types[column]:
+                compatible_types[column] = compatible_type
+
+    return excluded_columns, compatible_types
+
+def adjust_database_columns(data: pd.DataFrame, table_name: str):
     """Adjust database columns to account for differing
     datatypes and new columns
 
-    To implement: make work for dataframe
+    Reconcile the whole dataframe with the table at once: the null
+    counts of every column that needs them come from a single aggregate
+    query and every column change is applied in a single ALTER TABLE,
+    so the table is rewritten at most once.
+
+    The table's columns come from the catalog cache, so a dataframe the
+    table already holds needs no query at all; they are read again (in
+    the transaction altering the table) only when a change is needed.
+
+    New columns are added with the type of their data. Existing columns
+    are widened to a type compatible with both the table and the data,
+    unless they contain only nulls, in which case they take the type
+    of the data.
 
     Parameters:
     ----------
-    data (dict) : data to add to db
+    data (pd.DataFrame or dict) : data to add to db (a dict is one row)
     table_name (str) : name of table to change
 
     """
 
-    # Get types of columns of database and postgresql types of values in data
+    if isinstance(data, dict):
+        data = pd.DataFrame([data])
 
-    # Get columns and types from database
-    column_types = get_column_types(table_name)
-    # Get keys and types from data
-    info_types = {key: get_postgres_type(value) for key, value in data.items()}
-    
-    # Compute columns not in database
-    excluded_columns = dict()
-    for key, value in info_types.items():
-        if key not in column_types.values():
-            excluded_columns[key] = value
+    # Get columns and types from data
+    info_types = get_dataframe_types(data)
 
-    try:
-        # Connect to db
-        conn = connect()
+    # Nothing to change if the cached columns already hold the data
+    excluded_columns, compatible_types = column_changes(info_types, get_column_types(table_name))
+    if not excluded_columns and not compatible_types:
+        return
+
+    catalog = get_catalog()
+    altered_types = dict()
+
+    with connection() as conn:
         cursor = conn.cursor()
 
+        # Another process may have altered the table since it was cached
+        column_types = catalog.reload(cursor, table_name)
+        excluded_columns, compatible_types = column_changes(info_types, column_types)
+
+        # Falling back to text is only needed for columns that hold data
+        candidate_columns = [column for column, compatible_type in compatible_types.items()
+                             if compatible_type == 'text' and info_types[column] != 'text']
+
+        # Compute which columns contain only null values in one scan
+        null_columns = set()
+        if candidate_columns:
+            counts = ', '.join(f'COUNT("{column}")' for column in candidate_columns)
+            cursor.execute(f"SELECT {counts} FROM {table_name}")
+            non_null_counts = cursor.fetchone()
+            null_columns = {column for column, count in zip(candidate_columns, non_null_counts)
+                            if count == 0}
+
+        alterations = []
+
         # Add excluded columns
-        for key, value in excluded_columns.items():
-            add_column_query = f"""
-                                ALTER TABLE {table_name}
-                                ADD COLUMN IF NOT EXISTS "{key}" {value};
-            """
-            cursor.execute(add_column_query)
-
-        # Get number of rows in table
-        row_count_query = f"""SELECT COUNT(*) FROM {table_name}"""
-        cursor.execute(row_count_query)
-        row_count = cursor.fetchall()[0][0]
-
-
-        # Compute which columns contain only null values
-        null_columns = []
-        for column_name in column_types.keys():
-            # Count the number of null values
-            null_query = f"""
-                SELECT COUNT(*)
-                FROM {table_name}
-                WHERE "{column_name}" IS NULL
-            """
-            cursor.execute(null_query)
-            null_count = cursor.fetchall()[0][0]
-            # Check that the number of rows is the same as the number of null values
-            if row_count == null_count:
-                null_columns.append(column_name)
-        
-        #
-        columns_to_alter = dict()
-
-        # Compute which null_columns are in keys of data
-        included_null_columns = [col for col in null_columns if col in data.keys()]
-
-        for column in excluded_columns.keys():
-            columns_to_alter[column] = info_types[column]
-
-        # Get columns with incompatible datatypes
-        incompatible_cols = []
-        for col_name in column_types.keys():
-            if info_types.get(col_name):
-                if info_types[col_name] != column_types[col_name]:
-                    incompatible_cols.append(col_name)
-
-        # Get incompatible cols
-        for col_name in incompatible_cols:
-            col_type = column_types[col_name]
-            info_type = column_types[col_name]
-
-            columns_to_alter[col_name] = get_compatible_types(col_type, info_type)
-        
-
-        # repeated code: join together
-        for col_name, type_name in columns_to_alter.items():
-            # Update datatype
-            new_data_type_query = f"""
-                ALTER TABLE {table_name}
-                ALTER COLUMN "{col_name}" TYPE {type_name}
-                USING "{col_name}"::{type_name}
-            """
-            cursor.execute(new_data_type_query)
-
-    except (Exception, psycopg2.DatabaseError) as error:
-            # Rollback changes if an error occurs
-            conn.rollback()
-            raise Exception(error)
-    finally:
-        # Commit and close
-        if conn:
-            conn.commit()
-            conn.close()
-            print("Database closed")
+        for column, type_name in excluded_columns.items():
+            alterations.append(f'ADD COLUMN IF NOT EXISTS "{column}" {type_name}')
+            altered_types[column] = type_name
+
+        # Change types of incompatible columns
+        for column, type_name in compatible_types.items():
+            if column in null_columns:
+                type_name = info_types[column]
+            if type_name != column_types[column]:
+                alterations.append(f'ALTER COLUMN "{column}" TYPE {type_name} '
+                                   f'USING "{column}"::{type_name}')
+                altered_types[column] = type_name
+
+        if alterations:
+            alter_query = f"ALTER TABLE {table_name} {', '.join(alterations)}"
+            cursor.execute(alter_query)
+            prepared_statements.invalidate()
+
+    # The DDL is committed: keep the catalog in step without reading it again
+    if altered_types:
+        catalog.update(table_name, altered_types)
+
+def copy_dataframe(cursor, df: pd.DataFrame, table_name: str,
+                   columns: list = None, batch_size: int = None) -> int:
+    """Bulk load a dataframe into a table with COPY
+
+    Rows are streamed as CSV through COPY ... FROM STDIN. Missing values
+    (NaN/None) are written as NULL. The caller owns the transaction, so
+    every batch is committed (or rolled back) together.
+
+    Parameters:
+    ----------
+    cursor : psycopg2 cursor to copy through
+    df (pd.DataFrame) : data to load, columns in the same order as columns
+    table_name (str) : name of the table to load into
+    columns (list) : table columns to fill, defaults to df.columns
+    batch_size (int) : number of rows per COPY, defaults to a single COPY
+
+    Returns:
+    ----------
+    int : number of rows loaded
+    """
+
+    if columns is None:
+        columns = list(df.columns)
+    if len(columns) != len(df.columns):
+        raise ValueError(f'{len(columns)} columns given for {len(df.columns)} dataframe columns')
+
+    column_names = ', '.join(f'"{column}"' for column in columns)
+    copy_query = f"COPY {table_name} ({column_names}) FROM STDIN WITH (FORMAT csv)"
+
+    if not batch_size:
+        batch_size = max(len(df.index), 1)
+
+    rows = 0
+    for start in range(0, len(df.index), batch_size):
+        batch = df.iloc[start:start + batch_size]
+
+        buffer = io.StringIO()
+        batch.to_csv(buffer, header=False, index=False, na_rep='')
+        buffer.seek(0)
+
+        cursor.copy_expert(copy_query, buffer)
+        rows += len(batch.index)
+
+    return rows
+
+def upsert_dataframe(cursor, df: pd.DataFrame, table_name: str, key: list,
+                     columns: list = None, batch_size: int = None) -> int:
+    """Bulk insert or update a dataframe by a unique key
+
+    The rows are copied into a temporary staging table and merged into
+    the table with one INSERT ... ON CONFLICT, so loading the same rows
+    again updates them rather than duplicating them. Rows repeated
+    within df keep their last occurrence.
+
+    Parameters:
+    ----------
+    cursor : psycopg2 cursor to copy through
+    df (pd.DataFrame) : data to load, columns in the same order as columns
+    table_name (str) : name of the table to load into
+    key (list) : columns of a unique index or constraint of the table
+    columns (list) : table columns to fill, defaults to df.columns
+    batch_size (int) : number of rows per COPY, defaults to a single COPY
+
+    Returns:
+    ----------
+    int : number of rows inserted or updated
+    """
+
+    if columns is None:
+        columns = list(df.columns)
+
+    # Keep the last of any rows with the same key
+    key_positions = [columns.index(column) for column in key]
+    df = df[~df.iloc[:, key_positions].duplicated(keep='last').to_numpy()]
+
+    staging_table = f'staging_{table_name}'
+    column_names = ', '.join(f'"{column}"' for column in columns)
+    key_names = ', '.join(f'"{column}"' for column in key)
+    update_names = ', '.join(f'"{column}" = EXCLUDED."{column}"'
+                             for column in columns if column not in key)
+    conflict_action = f'DO UPDATE SET {update_names}' if update_names else 'DO NOTHING'
+
+    cursor.execute(f"""CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS
+                       SELECT {column_names} FROM {table_name} WITH NO DATA""")
+    copy_dataframe(cursor, df, staging_table, columns=columns, batch_size=batch_size)
+
+    cursor.execute(f"""INSERT INTO {table_name} ({column_names})
+                       SELECT {column_names} FROM {staging_table}
+                       ON CONFLICT ({key_names}) {conflict_action}""")
+    rows = cursor.rowcount
+
+    cursor.execute(f"DROP TABLE {staging_table}")
+
+    metrics.count('rows_written', rows, table=table_name)
+    return rows
+
+class PreparedStatements:
+    '''
+    Server side prepared statements, prepared once per pooled connection
+    '''
+
+    def __init__(self) -> None:
+        # connection: names of the statements prepared on it (dropped
+        # with the connection when the pool discards it)
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # Parameter types are fixed when a statement is prepared, so
+        # statements are prepared again after the columns change
+        self._generation = 0
+
+    def statement_name(self, query: str, types: tuple = None) -> str:
+        key = f'{self._generation}:{types}:{query}'
+        return 'stocks_' + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def invalidate(self) -> None:
+        '''Prepare every statement again on next use (e.g. after ALTER TABLE)'''
+        with self._lock:
+            self._generation += 1
+
+    def prepare(self, cursor, query: str, types: tuple = None) -> str:
+        """Prepare a statement on the cursor's connection, unless already prepared
+
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor
+        query (str) : statement with $1, $2, ... parameters
+        types (tuple) : postgres type of every parameter, inferred by
+            the server if not given
+
+        Returns:
+        ----------
+        str : name to EXECUTE the statement by
+        """
+
+        name = self.statement_name(query, types)
+        with self._lock:
+            prepared = self._prepared.setdefault(cursor.connection, set())
+            if name in prepared:
+                return name
+
+        parameter_types = f" ({', '.join(types)})" if types else ''
+        cursor.execute(f"PREPARE {name}{parameter_types} AS {query}")
+        metrics.count('statements_prepared')
+
+        with self._lock:
+            prepared.add(name)
+        return name
+
+    def execute_batch(self, cursor, query: str, rows: list, page_size: int = 100,
+                      types: tuple = None) -> None:
+        """Execute a prepared statement for every row, page_size
+        executions per round trip
+
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor
+        query (str) : statement with one $n parameter per value of a row
+        rows (list) : tuples of parameter values
+        page_size (int) : number of executions sent together
+        types (tuple) : postgres type of every parameter (see prepare)
+        """
+
+        if not rows:
+            return
+
+        name = self.prepare(cursor, query, types)
+        placeholders = ', '.join(['%s'] * len(rows[0]))
+        psycopg2.extras.execute_batch(cursor, f"EXECUTE {name} ({placeholders})",
+                                      rows, page_size=page_size)
+
+prepared_statements = PreparedStatements()
+
+@lru_cache(maxsize=1024)
+def insert_statement(table_name: str, columns: tuple) -> str:
+    '''INSERT of one row of columns, with $n parameters'''
+    column_names = ', '.join(f'"{column}"' for column in columns)
+    parameters = ', '.join(f'${number}' for number in range(1, len(columns) + 1))
+    return f"INSERT INTO {table_name} ({column_names}) VALUES ({parameters})"
+
+@lru_cache(maxsize=1024)
+def update_statement(table_name: str, columns: tuple, identifier: str) -> str:
+    '''UPDATE of columns of the rows where identifier is the last $n parameter'''
+    assignments = ', '.join(f'"{column}" = ${number}' for number, column in enumerate(columns, 1))
+    return f'UPDATE {table_name} SET {assignments} WHERE "{identifier}" = ${len(columns) + 1}'
+
+def group_rows(df: pd.DataFrame) -> dict:
+    """Group the rows of a dataframe by their set of non missing columns
+
+    Missing values (None/NaN/NaT) are left out, so the table defaults
+    apply. Lists and dicts are stored as text, as in convert_type.
+
+    Returns:
+    ----------
+    dict : tuple of column names: list of tuples of their values
+    """
+
+    columns = np.array(df.columns, dtype=object)
+    values = df.to_numpy(dtype=object)
+    present = ~df.isna().to_numpy()
+
+    groups = dict()
+    for row, mask in zip(values, present):
+        key = tuple(columns[mask])
+        if not key:
+            continue
+        groups.setdefault(key, []).append(tuple(
+            str(value) if isinstance(value, (list, dict, tuple, set)) else value
+            for value in row[mask]))
+    return groups
+
+def write_dataframe(cursor, df: pd.DataFrame, table_name: str, mode: str = 'insert',
+                    identifier: dict = None, page_size: int = 100) -> int:
+    """Insert the rows of a dataframe, or update a row with them
+
+    Rows are grouped by their non missing columns. Each group is written
+    with one statement prepared per connection (and cached for the table
+    and column set), executed page_size rows per round trip, so a frame
+    takes a handful of statements rather than one per row. Values are
+    sent as parameters, so quotes in strings need no escaping. The
+    parameters are typed as their columns in the catalog cache, so a
+    statement is prepared again whenever a column type changes.
+
+    Parameters:
+    ----------
+    cursor : psycopg2 cursor (the caller owns the transaction)
+    df (pd.DataFrame) : data to write, columns named as the table columns
+    table_name (str) : name of the table
+    mode (str) : 'insert' or 'update'
+    identifier (dict) : 'column' and 'value' of the row to update (update mode)
+    page_size (int) : number of rows sent per round trip
+
+    Returns:
+    ----------
+    int : number of rows written
+
+    Raises:
+    ----------
+    ValueError : mode is not insert or update, or update has no identifier
+    """
+
+    if mode not in ['insert', 'update']:
+        raise ValueError(f"{mode} is not a write mode ('insert' or 'update')")
+    if mode == 'update' and not identifier:
+        raise ValueError('update needs an identifier (column and value)')
+
+    column_types = get_column_types(table_name)
+
+    rows = 0
+    for columns, values in group_rows(df).items():
+        if mode == 'insert':
+            query = insert_statement(table_name, columns)
+        else:
+            query = update_statement(table_name, columns, identifier['column'])
+            values = [value + (identifier['value'],) for value in values]
+            columns = columns + (identifier['column'],)
+
+        # Leave the types to the server if a column is not in the catalog
+        types = tuple(column_types.get(column) for column in columns)
+        if None in types:
+            types = None
+
+        prepared_statements.execute_batch(cursor, query, values, page_size=page_size, types=types)
+        rows += len(values)
+
+    metrics.count('rows_written', rows, table=table_name)
+    return rows
+
+# Postgres binary COPY field type: big endian numpy dtype
+binary_types = {'bigint': '>i8',
+                'double precision': '>f8',
+                'timestamp with time zone': '>i8'}
+
+# Binary timestamps count microseconds from 2000-01-01 UTC
+postgres_epoch_us = 946684800 * 10**6
+
+class BinaryCopyReader:
+    '''
+    File-like target of a binary COPY ... TO STDOUT that parses fixed size
+    rows into numpy column arrays as the data arrives
+    '''
+
+    def __init__(self, types: list, chunk_size: int = 2**22) -> None:
+        """Initialise instance of BinaryCopyReader class
+
+        Parameters:
+        ----------
+        types (list) : postgres type of every column (key of binary_types)
+        chunk_size (int) : bytes buffered before they are parsed
+        """
+
+        self.types = types
+        self.chunk_size = chunk_size
+
+        # Row: field count, then the length and value of every field
+        fields = [('count', '>i2')]
+        for position, column_type in enumerate(types):
+            fields += [(f'length{position}', '>i4'), (f'value{position}', binary_types[column_type])]
+        self.row_dtype = np.dtype(fields)
+
+        self._buffer = bytearray()
+        self._header_read = False
+        self._chunks = [[] for _ in types]
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.parse()
+        return len(data)
+
+    def parse(self) -> None:
+        '''Parse the complete rows in the buffer'''
+        if not self._header_read:
+            # Signature (11 bytes), flags (4), extension length (4) and extension
+            if len(self._buffer) < 19:
+                return
+            extension_length = int.from_bytes(self._buffer[15:19], 'big')
+            if len(self._buffer) < 19 + extension_length:
+                return
+            del self._buffer[:19 + extension_length]
+            self._header_read = True
+
+        row_count = len(self._buffer) // self.row_dtype.itemsize
+        if not row_count:
+            return
+
+        size = row_count * self.row_dtype.itemsize
+        rows = np.frombuffer(self._buffer, dtype=self.row_dtype, count=row_count)
+
+        if (rows['count'] != len(self.types)).any():
+            # Only the trailer (a field count of -1) may follow the rows
+            row_count = int(np.argmax(rows['count'] != len(self.types)))
+            size = row_count * self.row_dtype.itemsize
+            rows = rows[:row_count]
+
+        for position, column_type in enumerate(self.types):
+            if (rows[f'length{position}'] < 0).any():
+                raise ValueError(f'Column {position} of the COPY contains NULLs')
+            self._chunks[position].append(rows[f'value{position}'].astype(binary_types[column_type][1:]))
+
+        del rows
+        del self._buffer[:size]
+
+    def columns(self) -> list:
+        """Finish parsing and return the columns
+
+        Returns:
+        ----------
+        list : np.ndarray of every column, timestamps as UTC nanoseconds (int64)
+        """
+
+        self.parse()
+        if bytes(self._buffer) != b'\xff\xff':
+            raise ValueError('COPY returned rows of an unexpected size (does the query return NULLs?)')
+
+        columns = []
+        for position, column_type in enumerate(self.types):
+            values = np.concatenate(self._chunks[position]) if self._chunks[position] \
+                else np.empty(0, dtype=binary_types[column_type][1:])
+            self._chunks[position] = None
+            if column_type == 'timestamp with time zone':
+                values += postgres_epoch_us
+                values *= 1000
+            columns.append(values)
+
+        return columns
+
+def copy_to_arrays(cursor, query: str, types: list) -> list:
+    """Run a query with binary COPY ... TO STDOUT and parse the result
+    into one numpy array per column
+
+    Every row of the binary format is the same size when no value is
+    NULL, so the rows are viewed as a structured array as they stream in,
+    without creating a Python object per row or value. Peak memory stays
+    close to the size of the returned arrays. The query must not return
+    NULLs (e.g. COALESCE floats to 'NaN').
+
+    Parameters:
+    ----------
+    cursor : psycopg2 cursor
+    query (str) : SELECT query (without parameters, use cursor.mogrify)
+    types (list) : postgres type of every column (key of binary_types)
+
+    Returns:
+    ----------
+    list : np.ndarray of every column, timestamps as UTC nanoseconds (int64)
+    """
+
+    reader = BinaryCopyReader(types)
+    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", reader)
+    return reader.columns()
@@ -0,0 +1,190 @@
+import datetime
+import json
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import psycopg2.extras
+
+# Created libraries
+from config import config
+from connect import connection
+import metrics
+from schema import default_tables, ensure_schema
+
+# JSONB storage of yfinance payloads whose keys drift between responses.
+#
+# In the jsonb storage mode, each stock info response and each financial
+# report is one JSONB document rather than a row of a column per key, so
+# new keys never ALTER (and lock) the table. A few hot fields are copied
+# into typed generated columns, and a GIN index serves containment
+# queries. query_documents extracts selected fields of many documents in
+# one query.
+
+storage_modes = ['columns', 'jsonb']
+
+# Document kind: key columns (the tables and their hot columns are
+# created by schema.create_document_tables)
+document_kinds = {'stock_info': ['stock_id'],
+                  'stock_financials': ['stock_id', 'date']}
+
+# Types query_documents can extract fields as
+field_types = ['text', 'boolean', 'integer', 'bigint', 'double precision', 'numeric']
+
+
+def document_table(kind: str, tables: dict = None) -> str:
+    '''Name of the document table of a kind, derived from the table it replaces'''
+    tables = dict(default_tables, **(tables or {}))
+    if kind == 'stock_info':
+        return f"{tables['stock']}_info_document"
+    return f"{tables[kind]}_document"
+
+def field_expression(key: str, type_name: str) -> str:
+    """SQL extracting a payload field as a type (NULL if missing or of
+    another JSON type, so drifting payloads never fail a cast)
+
+    Parameters:
+    ----------
+    key (str) : SQL of the payload key (e.g. %s)
+    type_name (str) : one of field_types
+
+    Raises:
+    ----------
+    ValueError : type_name is not one of field_types
+    """
+
+    if type_name not in field_types:
+        raise ValueError(f'{type_name} is not a field type (types: {field_types})')
+    if type_name == 'text':
+        return f"payload->>{key}"
+    if type_name == 'boolean':
+        return f"CASE WHEN jsonb_typeof(payload->{key}) = 'boolean' THEN (payload->>{key})::boolean END"
+    return f"CASE WHEN jsonb_typeof(payload->{key}) = 'number' THEN (payload->>{key})::{type_name} END"
+
+@lru_cache(maxsize=1)
+def get_storage_mode() -> str:
+    '''Storage mode from the storage section of database.ini (default
+    columns), read on first use only; call reload_storage_mode after
+    changing it'''
+    try:
+        return config(section='storage').get('mode', 'columns')
+    except Exception:
+        return 'columns'
+
+def reload_storage_mode() -> None:
+    '''Read the storage section again on next use of get_storage_mode'''
+    get_storage_mode.cache_clear()
+
+def json_value(value):
+    '''Convert a value to one json.dumps accepts (None for missing values)'''
+    if isinstance(value, dict):
+        return {str(key): json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return [json_value(item) for item in value]
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, (float, np.floating)):
+        return None if not np.isfinite(value) else float(value)
+    if isinstance(value, (datetime.date, pd.Timestamp)):
+        return None if pd.isna(value) else value.isoformat()
+    if value is None or value is pd.NaT:
+        return None
+    return value
+
+def to_payload(row: dict) -> str:
+    '''JSON text of a row, leaving out missing values'''
+    payload = {str(key): json_value(value) for key, value in row.items()}
+    return json.dumps({key: value for key, value in payload.items() if value is not None})
+
+def write_documents(cursor, kind: str, rows: list, tables: dict = None,
+                    utc_time: datetime.datetime = None, page_size: int = 100) -> int:
+    """Insert or replace documents
+
+    One multi row INSERT ... ON CONFLICT per page; the documents replace
+    any with the same key. No DDL is ever run, whatever keys the payloads have.
+
+    Parameters:
+    ----------
+    cursor : psycopg2 cursor (the caller owns the transaction)
+    kind (str) : key of document_kinds
+    rows (list) : (tuple of key values, payload dict) of every document
+    tables (dict) : table role: table name, defaults to schema.default_tables
+    utc_time (datetime.datetime) : time the payloads were fetched, defaults to now
+    page_size (int) : number of documents per statement
+
+    Returns:
+    ----------
+    int : number of documents written
+    """
+
+    if not rows:
+        return 0
+
+    table = document_table(kind, tables)
+    key = document_kinds[kind]
+    if utc_time is None:
+        utc_time = datetime.datetime.now(datetime.timezone.utc)
+
+    columns = ', '.join(key + ['utc_time', 'payload'])
+    psycopg2.extras.execute_values(
+        cursor,
+        f"""INSERT INTO {table} ({columns}) VALUES %s
+            ON CONFLICT ({', '.join(key)}) DO UPDATE
+                SET utc_time = EXCLUDED.utc_time, payload = EXCLUDED.payload""",
+        [tuple(key_values) + (utc_time, to_payload(payload)) for key_values, payload in rows],
+        template=f"({', '.join(['%s'] * len(key))}, %s, %s::jsonb)",
+        page_size=page_size)
+
+    metrics.count('rows_written', len(rows), table=table)
+    return len(rows)
+
+def query_documents(kind: str, fields, stock_ids: list = None, contains: dict = None,
+                    tables: dict = None) -> pd.DataFrame:
+    """Extract fields of many documents in one query
+
+    Parameters:
+    ----------
+    kind (str) : key of document_kinds
+    fields (list or dict) : payload keys to extract as text, or payload
+        key: one of field_types (values of other JSON types become NULL)
+    stock_ids (list) : stocks to read, defaults to every stock
+    contains (dict) : only documents whose payload contains this (e.g.
+        {'sector': 'Technology'}), answered from the GIN index
+    tables (dict) : table role: table name, defaults to schema.default_tables
+
+    Returns:
+    ----------
+    pd.DataFrame : key columns and one column per field
+    """
+
+    tables = dict(default_tables, **(tables or {}))
+    ensure_schema(tables)
+
+    if not isinstance(fields, dict):
+        fields = {field: 'text' for field in fields}
+
+    table = document_table(kind, tables)
+    key = document_kinds[kind]
+
+    selected = key + [f'{field_expression("%s", type_name)} AS "{index}"'
+                      for index, type_name in enumerate(fields.values())]
+    # Each field is bound once per use in its expression
+    params = [field for field, type_name in fields.items()
+              for _ in range(1 if type_name == 'text' else 2)]
+
+    conditions = []
+    if stock_ids is not None:
+        conditions.append('stock_id = ANY(%s)')
+        params.append(list(stock_ids))
+    if contains:
+        conditions.append('payload @> %s::jsonb')
+        params.append(json.dumps(contains))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(selected)} FROM {table} {where} ORDER BY {', '.join(key)}",
+                       params)
+        rows = cursor.fetchall()
+
+    return pd.DataFrame(rows, columns=key + list(fields))
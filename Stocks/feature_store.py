@@ -0,0 +1,358 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Created libraries
+from connect import connection
+from db_tools import copy_to_arrays, float_types, get_column_types, integer_types
+from documents import document_table, field_expression, get_storage_mode, storage_modes
+import metrics
+from schema import default_tables, ensure_schema
+
+# Materialised feature matrices for training models.
+#
+# Each ticker is one block: a float32 matrix of its bars (rows) by the
+# features (columns) of prices, the latest financial report, actions on
+# the bar and numeric stock info, memory mapped from one file. The
+# manifest records the last request of each type that fed every block,
+# so a build only rebuilds the blocks of stocks with newer requests.
+#
+# Financials and info are read from the storage of the storage mode (see
+# documents): the numeric columns of their tables, or the numeric fields
+# of their JSONB documents.
+
+price_features = ['open', 'high', 'low', 'close', 'adj_close', 'volume']
+
+# Request type: source of features
+request_sources = {'stock_price': 'price',
+                   'stock_financials': 'financials',
+                   'stock_actions': 'actions',
+                   'stock_info': 'info'}
+
+# Columns of the source tables that are not features
+key_columns = ['id', 'stock_id', 'date', 'ticker']
+
+# Source: document kind, in the jsonb storage mode
+document_sources = {'financials': 'stock_financials',
+                    'info': 'stock_info'}
+
+manifest_file = 'manifest.json'
+
+
+class FeatureStore:
+    '''
+    Per ticker, memory mapped float32 feature matrices rebuilt only when
+    their source data changes
+    '''
+
+    def __init__(self, directory: str = 'feature_store', interval: str = '1d',
+                 rollup: bool = True, tables: dict = None, storage: str = None) -> None:
+        """Initialise instance of FeatureStore class
+
+        Parameters:
+        ----------
+        directory (str) : directory the blocks and manifest are kept in
+        interval (str) : interval of the bars (rows)
+        rollup (bool) : use bars rolled up from finer bars (see rollups)
+            rather than downloaded bars
+        tables (dict) : table role: table name, defaults to schema.default_tables
+        storage (str) : storage mode the stocks were downloaded with (one
+            of documents.storage_modes), defaults to documents.get_storage_mode()
+
+        Raises:
+        ----------
+        ValueError : storage is not a storage mode
+        """
+
+        storage = storage or get_storage_mode()
+        if storage not in storage_modes:
+            raise ValueError(f'{storage} is not a storage mode (modes: {storage_modes})')
+
+        self.directory = directory
+        self.interval = interval
+        self.rollup = rollup
+        self.tables = dict(default_tables, **(tables or {}))
+        self.storage = storage
+
+        self._lock = threading.Lock()
+
+    @property
+    def price_table(self) -> str:
+        if self.rollup:
+            return f"{self.tables['stock_price']}_rollup"
+        return self.tables['stock_price']
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, manifest_file)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'interval': self.interval, 'rollup': self.rollup, 'features': [], 'blocks': {}}
+
+    def write_manifest(self, manifest: dict) -> None:
+        path = os.path.join(self.directory, manifest_file)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.replace(path + '.tmp', path)
+
+    @property
+    def features(self) -> list:
+        '''Names of the columns of the blocks'''
+        return self.read_manifest()['features']
+
+    def numeric_columns(self, table: str) -> list:
+        '''Numeric columns of a table that are features'''
+        numeric_types = list(integer_types) + list(float_types)
+        return [column for column, data_type in get_column_types(table).items()
+                if data_type in numeric_types and column not in key_columns]
+
+    def numeric_fields(self, cursor, kind: str) -> list:
+        '''Payload keys holding a number in any document of a kind'''
+        cursor.execute(f"""
+                SELECT DISTINCT field.key
+                    FROM {document_table(kind, self.tables)}, jsonb_each(payload) AS field
+                WHERE jsonb_typeof(field.value) = 'number'
+                ORDER BY field.key""")
+        return [key for (key,) in cursor.fetchall() if key not in key_columns]
+
+    def is_document(self, source: str) -> bool:
+        '''True if a source is stored as JSONB documents'''
+        return self.storage == 'jsonb' and source in document_sources
+
+    def source_table(self, source: str) -> str:
+        if self.is_document(source):
+            return document_table(document_sources[source], self.tables)
+        return self.tables[{'financials': 'stock_financials',
+                            'actions': 'stock_actions',
+                            'info': 'stock'}[source]]
+
+    def source_columns(self, cursor) -> dict:
+        '''Feature columns (or document fields) of every source, without the feature prefix'''
+        columns = dict()
+        for source in ['financials', 'actions', 'info']:
+            if self.is_document(source):
+                columns[source] = self.numeric_fields(cursor, document_sources[source])
+            else:
+                columns[source] = self.numeric_columns(self.source_table(source))
+        return columns
+
+    def values_sql(self, cursor, source: str, columns: list) -> str:
+        '''SQL selecting the features of a source as double precision'''
+        if self.is_document(source):
+            return ', '.join(field_expression(cursor.mogrify('%s', (column,)).decode(), 'double precision')
+                             for column in columns)
+        return ', '.join(f'"{column}"::double precision' for column in columns)
+
+    def request_signatures(self, cursor, stock_ids: dict) -> dict:
+        """Get the last request of each type of every stock
+
+        Returns:
+        ----------
+        dict : ticker: {request type: last request id}
+        """
+
+        cursor.execute(f"""
+                SELECT stock_id, request_type, max(id) FROM {self.tables['request']}
+                WHERE stock_id = ANY(%s) AND request_type = ANY(%s)
+                GROUP BY stock_id, request_type""",
+                       (list(stock_ids.values()), list(request_sources)))
+
+        tickers = {stock_id: ticker for ticker, stock_id in stock_ids.items()}
+        signatures = {ticker: {} for ticker in stock_ids}
+        for stock_id, request_type, request_id in cursor.fetchall():
+            signatures[tickers[stock_id]][request_type] = request_id
+        return signatures
+
+    def load_bars(self, cursor, stock_id: int) -> tuple:
+        '''Bar times (UTC nanoseconds) and price features of a stock'''
+        selected = ['utc_time'] + [f"COALESCE({column}::double precision, 'NaN')"
+                                   for column in price_features]
+        query = cursor.mogrify(f"""
+                SELECT {', '.join(selected)} FROM {self.price_table}
+                WHERE stock_id = %s AND interval = %s
+                ORDER BY utc_time""", (stock_id, self.interval)).decode()
+        arrays = copy_to_arrays(cursor, query, ['timestamp with time zone'] +
+                                ['double precision'] * len(price_features))
+        return arrays[0], np.column_stack(arrays[1:]) if len(arrays[0]) else \
+            np.empty((0, len(price_features)))
+
+    def load_dated(self, cursor, source: str, stock_id: int, columns: list) -> tuple:
+        '''Times (UTC nanoseconds) and values of the dated rows of a stock, sorted by time'''
+        if not columns:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0))
+
+        cursor.execute(f"""SELECT date, {self.values_sql(cursor, source, columns)}
+                           FROM {self.source_table(source)} WHERE stock_id = %s""", (stock_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(columns)))
+
+        times = pd.DatetimeIndex(pd.to_datetime([row[0] for row in rows], utc=True)).as_unit('ns').asi8
+        values = np.array([row[1:] for row in rows], dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        return times[order], values[order]
+
+    def build_block(self, cursor, stock_id: int, columns: dict) -> tuple:
+        """Build the feature matrix of a stock
+
+        Returns:
+        ----------
+        tuple : (bar times as UTC nanoseconds, float32 matrix of bars by features)
+        """
+
+        times, prices = self.load_bars(cursor, stock_id)
+        blocks = [prices]
+
+        # Latest financial report at each bar (NaN before the first)
+        report_times, reports = self.load_dated(cursor, 'financials', stock_id, columns['financials'])
+        latest = np.searchsorted(report_times, times, side='right') - 1
+        financials = np.full((len(times), len(columns['financials'])), np.nan)
+        if len(report_times):
+            financials[latest >= 0] = reports[latest[latest >= 0]]
+        blocks.append(financials)
+
+        # Actions on each bar: added to the bar starting at or before them
+        action_times, actions = self.load_dated(cursor, 'actions', stock_id, columns['actions'])
+        action_bars = np.zeros((len(times), len(columns['actions'])))
+        if len(action_times) and len(times):
+            bars = np.searchsorted(times, action_times, side='right') - 1
+            in_range = bars >= 0
+            np.add.at(action_bars, bars[in_range], np.nan_to_num(actions[in_range]))
+        blocks.append(action_bars)
+
+        # Stock info, the same on every bar
+        info = np.full(len(columns['info']), np.nan)
+        if columns['info']:
+            key = 'stock_id' if self.is_document('info') else 'id'
+            cursor.execute(f"""SELECT {self.values_sql(cursor, 'info', columns['info'])}
+                               FROM {self.source_table('info')} WHERE {key} = %s""", (stock_id,))
+            row = cursor.fetchone()
+            if row:
+                info = np.array(row, dtype=np.float64)
+        blocks.append(np.broadcast_to(info, (len(times), len(info))))
+
+        return times, np.hstack(blocks).astype(np.float32)
+
+    def write_block(self, ticker: str, times: np.ndarray, matrix: np.ndarray) -> None:
+        # Write new files rather than truncating ones that may be mapped
+        for suffix, values in [('time', times), ('features', matrix)]:
+            path = os.path.join(self.directory, f'{ticker}.{suffix}')
+            np.ascontiguousarray(values).tofile(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def build(self, tickers: list) -> dict:
+        """Build the blocks of tickers whose source data changed since the last build
+
+        A block is rebuilt if the last request of any type for its stock
+        differs from the manifest. Every block is rebuilt if the features
+        changed (e.g. a new financials column was added).
+
+        Parameters:
+        ----------
+        tickers (list) : names of the stock tickers
+
+        Returns:
+        ----------
+        dict : ticker: 'rebuilt', 'unchanged' or 'missing' (not in the stock table)
+        """
+
+        ensure_schema(self.tables)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with self._lock, connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"SELECT ticker, id FROM {self.tables['stock']} WHERE ticker = ANY(%s)",
+                           (list(tickers),))
+            stock_ids = dict(cursor.fetchall())
+
+            columns = self.source_columns(cursor)
+            features = [f'price.{column}' for column in price_features] + \
+                       [f'{source}.{column}' for source in ['financials', 'actions', 'info']
+                        for column in columns[source]]
+
+            manifest = self.read_manifest()
+            if manifest['features'] != features or manifest['interval'] != self.interval \
+                    or manifest['rollup'] != self.rollup:
+                manifest = {'interval': self.interval, 'rollup': self.rollup,
+                            'features': features, 'blocks': {}}
+
+            signatures = self.request_signatures(cursor, stock_ids)
+
+            results = dict()
+            for ticker in tickers:
+                if ticker not in stock_ids:
+                    results[ticker] = 'missing'
+                    continue
+
+                block = manifest['blocks'].get(ticker)
+                if block is not None and block['requests'] == signatures[ticker]:
+                    results[ticker] = 'unchanged'
+                    continue
+
+                times, matrix = self.build_block(cursor, stock_ids[ticker], columns)
+                self.write_block(ticker, times, matrix)
+                manifest['blocks'][ticker] = {'rows': len(times), 'requests': signatures[ticker]}
+                results[ticker] = 'rebuilt'
+
+            self.write_manifest(manifest)
+
+        rebuilt = sum(result == 'rebuilt' for result in results.values())
+        metrics.count('feature_blocks_rebuilt', rebuilt)
+        metrics.event('feature_blocks_refreshed', directory=self.directory,
+                      rebuilt=rebuilt, blocks=len(results))
+
+        return results
+
+    def load(self, ticker: str) -> tuple:
+        """Memory map the block of a ticker
+
+        Returns:
+        ----------
+        tuple : (bar times as UTC nanoseconds, float32 matrix of bars by features)
+
+        Raises:
+        ----------
+        KeyError : ticker has not been built
+        """
+
+        manifest = self.read_manifest()
+        rows = manifest['blocks'][ticker]['rows']
+        width = len(manifest['features'])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, width), dtype=np.float32)
+
+        times = np.memmap(os.path.join(self.directory, f'{ticker}.time'), dtype=np.int64,
+                          mode='r', shape=(rows,))
+        matrix = np.memmap(os.path.join(self.directory, f'{ticker}.features'), dtype=np.float32,
+                           mode='r', shape=(rows, width))
+        return times, matrix
+
+    def matrix(self, tickers: list = None) -> tuple:
+        """Stack the blocks of tickers into one (ticker, timestamp) x feature matrix
+
+        Parameters:
+        ----------
+        tickers (list) : tickers to stack, defaults to every built ticker
+
+        Returns:
+        ----------
+        tuple : (ticker of each row, UTC nanoseconds of each row, float32 matrix)
+        """
+
+        if tickers is None:
+            tickers = list(self.read_manifest()['blocks'])
+
+        blocks = [(ticker,) + self.load(ticker) for ticker in tickers]
+        if not blocks:
+            return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), \
+                np.empty((0, len(self.features)), dtype=np.float32)
+
+        row_tickers = np.concatenate([np.full(len(times), ticker, dtype=object)
+                                      for ticker, times, _ in blocks])
+        times = np.concatenate([times for _, times, _ in blocks])
+        matrix = np.concatenate([matrix for _, _, matrix in blocks])
+        return row_tickers, times, matrix
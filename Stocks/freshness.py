@@ -0,0 +1,183 @@
+import datetime
+import threading
+import time
+from functools import lru_cache
+
+# Created libraries
+from config import config
+from connect import connection
+
+# Last successful fetch of every (stock, request type), so downloads can be
+# skipped while the stored data is fresh.
+#
+# The <request>_freshness table holds one row per (stock_id, request_type,
+# scope), kept up to date in the transaction that stores the fetched data.
+# The scope tells apart fetches of the same type that cover different data
+# (for prices, the period and interval). Lookups go through an in-process
+# cache whose entries are reused for cache_seconds, so a process skipping
+# many downloads does one indexed SELECT per stock and type at most.
+
+# Request type: seconds a fetch stays fresh (0 never skips a download)
+default_ttls = {'stock_info': 0,
+                'stock_financials': 86400,
+                'stock_actions': 86400,
+                'stock_holders': 86400,
+                'stock_price': 60}
+
+
+def freshness_table(request_table: str) -> str:
+    return f'{request_table}_freshness'
+
+def price_scope(period: str, interval: str) -> str:
+    '''Scope of a price fetch: a fetch only makes the same period and interval fresh'''
+    return f'{period}/{interval}'
+
+@lru_cache(maxsize=None)
+def read_ttls(filename: str) -> dict:
+    '''Read the freshness section of a file (once, see load_ttls)'''
+    try:
+        params = config(filename, section='freshness')
+    except Exception:
+        params = dict()
+
+    return {request_type: datetime.timedelta(seconds=float(params.get(request_type, seconds)))
+            for request_type, seconds in default_ttls.items()}
+
+def load_ttls(filename: str = 'database.ini') -> dict:
+    """Get the time each request type stays fresh from the freshness
+    section of database.ini (seconds per request type)
+
+    The file is read on first use only; call reload_ttls after changing it.
+
+    Returns:
+    ----------
+    dict : request type: datetime.timedelta, defaults to default_ttls
+    """
+
+    return dict(read_ttls(filename))
+
+def reload_ttls() -> None:
+    '''Read the freshness section again on next use of load_ttls'''
+    read_ttls.cache_clear()
+
+
+class FreshnessCache:
+    '''
+    Cached lookups of the last successful fetch of every (stock, request type)
+    '''
+
+    def __init__(self, request_table: str = 'request', cache_seconds: float = 60) -> None:
+        """Initialise instance of FreshnessCache class
+
+        Parameters:
+        ----------
+        request_table (str) : name of the request table the freshness table belongs to
+        cache_seconds (float) : time a looked up fetch time is reused before
+            being read again (it may be updated by other processes)
+        """
+
+        self.request_table = request_table
+        self.table = freshness_table(request_table)
+        self.cache_seconds = cache_seconds
+
+        self._lock = threading.Lock()
+        # (stock_id, request_type, scope): (last fetch, monotonic time looked up)
+        self._entries = dict()
+
+    def last_update(self, stock_id: int, request_type: str, scope: str = '') -> datetime.datetime:
+        """Get the time of the last successful fetch
+
+        Parameters:
+        ----------
+        stock_id (int) : id of the stock
+        request_type (str) : type of the request (e.g. 'stock_info')
+        scope (str) : scope of the fetch (see price_scope), '' for other types
+
+        Returns:
+        ----------
+        datetime.datetime : UTC time of the last fetch, or None if never fetched
+        """
+
+        key = (stock_id, request_type, scope)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.cache_seconds:
+                return entry[0]
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""SELECT utc_time FROM {self.table}
+                               WHERE stock_id = %s AND request_type = %s AND scope = %s""",
+                           key)
+            row = cursor.fetchone()
+
+        last_update = row[0] if row else None
+        with self._lock:
+            self._entries[key] = (last_update, time.monotonic())
+        return last_update
+
+    def is_fresh(self, stock_id: int, request_type: str, ttl: datetime.timedelta,
+                 scope: str = '') -> bool:
+        '''Return True if the last fetch was less than ttl ago'''
+        if not ttl:
+            return False
+
+        last_update = self.last_update(stock_id, request_type, scope)
+        if last_update is None:
+            return False
+        return last_update + ttl > datetime.datetime.now(datetime.timezone.utc)
+
+    def record(self, cursor, stock_ids, request_type: str,
+               utc_time: datetime.datetime = None, scope: str = '') -> None:
+        """Record successful fetches, in the transaction storing their data
+
+        The cached entries are dropped rather than updated, so a rolled
+        back transaction is never taken as a fetch.
+
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor of the transaction
+        stock_ids (int or list) : id of the stock, or ids of many stocks
+        request_type (str) : type of the request
+        utc_time (datetime.datetime) : time of the fetch, defaults to now
+        scope (str) : scope of the fetch (see price_scope)
+        """
+
+        if isinstance(stock_ids, int):
+            stock_ids = [stock_ids]
+        stock_ids = [int(stock_id) for stock_id in stock_ids]
+        if utc_time is None:
+            utc_time = datetime.datetime.now(datetime.timezone.utc)
+
+        cursor.execute(f"""
+                INSERT INTO {self.table} (stock_id, request_type, scope, utc_time)
+                SELECT unnest(%s::integer[]), %s, %s, %s
+                ON CONFLICT (stock_id, request_type, scope)
+                    DO UPDATE SET utc_time = GREATEST({self.table}.utc_time, EXCLUDED.utc_time)""",
+                       (stock_ids, request_type, scope, utc_time))
+
+        with self._lock:
+            for stock_id in stock_ids:
+                self._entries.pop((stock_id, request_type, scope), None)
+
+    def forget(self) -> None:
+        '''Drop every cached entry (e.g. after the tables are dropped)'''
+        with self._lock:
+            self._entries.clear()
+
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+def get_freshness_cache(request_table: str = 'request') -> FreshnessCache:
+    '''Return the process-wide freshness cache of a request table
+    (cache_seconds is read from the freshness section of database.ini)
+    '''
+    with _caches_lock:
+        if request_table not in _caches:
+            try:
+                cache_seconds = float(config(section='freshness').get('cache_seconds', 60))
+            except Exception:
+                cache_seconds = 60
+            _caches[request_table] = FreshnessCache(request_table, cache_seconds=cache_seconds)
+        return _caches[request_table]
@@ -0,0 +1,467 @@
+import abc
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Created libraries
+from connect import connection
+from db_tools import copy_to_arrays, upsert_dataframe
+from price_stream import to_utc
+from rollups import load_bars
+import time_tools
+
+# Technical indicators computed over stored price data.
+#
+# Every indicator keeps the state needed to extend it (e.g. the last EMA
+# value, or the last window of closes), so that new bars are processed in
+# O(new bars) rather than recomputing the whole history. Values are kept in
+# the <stock_price>_indicator table, one series per output (named
+# '<indicator key>.<output>'), and states in <stock_price>_indicator_state.
+
+
+def ema(values: np.ndarray, alpha: float, last: float = None) -> np.ndarray:
+    '''Exponential moving average of values, continuing from last (if given)'''
+    if last is None or np.isnan(last):
+        return pd.Series(values).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    return pd.Series(np.concatenate([[last], values])).ewm(alpha=alpha, adjust=False).mean().to_numpy()[1:]
+
+def last_value(values: np.ndarray, default=None):
+    return float(values[-1]) if len(values) else default
+
+
+class Indicator(abc.ABC):
+    '''
+    Base class of indicators: update(bars, state) returns the outputs of
+    the new bars and the state after them
+    '''
+
+    name = ''
+    outputs = ['value']
+
+    def __init__(self, **params) -> None:
+        self.params = params
+
+    @property
+    def key(self) -> str:
+        '''Name and parameters, e.g. sma(20)'''
+        return f"{self.name}({','.join(str(value) for value in self.params.values())})"
+
+    def series(self) -> list:
+        '''Names of the stored series of every output'''
+        return [f'{self.key}.{output}' for output in self.outputs]
+
+    def initial_state(self) -> dict:
+        return {}
+
+    @abc.abstractmethod
+    def update(self, bars: dict, state: dict) -> tuple:
+        """Compute the indicator for new bars
+
+        Parameters:
+        ----------
+        bars (dict) : 'utc_time' and price columns: np.ndarray of the new bars
+        state (dict) : state after the previous bars
+
+        Returns:
+        ----------
+        tuple : (dict output: np.ndarray, state after the new bars)
+        """
+
+    def __repr__(self) -> str:
+        return self.key
+
+
+class WindowIndicator(Indicator):
+    '''
+    Indicator over a rolling window of closes: the state is the closes
+    of the last bars, which are prepended to the new bars
+    '''
+
+    def __init__(self, window: int = 20, **params) -> None:
+        if window < 1:
+            raise ValueError(f'window must be positive (window: {window})')
+        super().__init__(window=window, **params)
+        self.window = window
+
+    @property
+    def tail_length(self) -> int:
+        return self.window - 1
+
+    def initial_state(self) -> dict:
+        return {'tail': []}
+
+    def windowed(self, values: np.ndarray, state: dict) -> tuple:
+        '''Prepend the tail to values, returning (series, tail after values)'''
+        series = pd.Series(np.concatenate([np.asarray(state['tail'], dtype=np.float64), values]))
+        tail = series.to_numpy()[len(series) - self.tail_length:] if self.tail_length else []
+        return series, [float(value) for value in tail]
+
+    def new(self, values: pd.Series, count: int) -> np.ndarray:
+        '''Values of the count new bars'''
+        return values.to_numpy()[len(values) - count:]
+
+
+class SMA(WindowIndicator):
+    name = 'sma'
+
+    def update(self, bars, state):
+        series, tail = self.windowed(bars['close'], state)
+        values = series.rolling(self.window).mean()
+        return {'value': self.new(values, len(bars['close']))}, {'tail': tail}
+
+
+class Bollinger(WindowIndicator):
+    name = 'bollinger'
+    outputs = ['middle', 'upper', 'lower']
+
+    def __init__(self, window: int = 20, k: float = 2.0) -> None:
+        super().__init__(window=window, k=k)
+        self.k = k
+
+    def update(self, bars, state):
+        series, tail = self.windowed(bars['close'], state)
+        count = len(bars['close'])
+        middle = self.new(series.rolling(self.window).mean(), count)
+        deviation = self.new(series.rolling(self.window).std(ddof=0), count)
+        return {'middle': middle,
+                'upper': middle + self.k * deviation,
+                'lower': middle - self.k * deviation}, {'tail': tail}
+
+
+class Volatility(WindowIndicator):
+    '''Rolling standard deviation of log returns'''
+    name = 'volatility'
+
+    @property
+    def tail_length(self) -> int:
+        # window returns need window + 1 closes
+        return self.window
+
+    def update(self, bars, state):
+        series, tail = self.windowed(bars['close'], state)
+        returns = np.log(series).diff()
+        values = returns.rolling(self.window).std()
+        return {'value': self.new(values, len(bars['close']))}, {'tail': tail}
+
+
+class EMA(Indicator):
+    name = 'ema'
+
+    def __init__(self, span: int = 20) -> None:
+        super().__init__(span=span)
+        self.alpha = 2 / (span + 1)
+
+    def initial_state(self):
+        return {'ema': None}
+
+    def update(self, bars, state):
+        values = ema(bars['close'], self.alpha, state['ema'])
+        return {'value': values}, {'ema': last_value(values, state['ema'])}
+
+
+class MACD(Indicator):
+    name = 'macd'
+    outputs = ['macd', 'signal', 'histogram']
+
+    def __init__(self, fast: int = 12, slow: int = 26, signal: int = 9) -> None:
+        super().__init__(fast=fast, slow=slow, signal=signal)
+        self.alphas = {'fast': 2 / (fast + 1), 'slow': 2 / (slow + 1), 'signal': 2 / (signal + 1)}
+
+    def initial_state(self):
+        return {'fast': None, 'slow': None, 'signal': None}
+
+    def update(self, bars, state):
+        fast = ema(bars['close'], self.alphas['fast'], state['fast'])
+        slow = ema(bars['close'], self.alphas['slow'], state['slow'])
+        macd = fast - slow
+        signal = ema(macd, self.alphas['signal'], state['signal'])
+        return {'macd': macd, 'signal': signal, 'histogram': macd - signal}, \
+               {'fast': last_value(fast, state['fast']),
+                'slow': last_value(slow, state['slow']),
+                'signal': last_value(signal, state['signal'])}
+
+
+class RSI(Indicator):
+    '''Relative strength index with Wilder smoothing'''
+    name = 'rsi'
+
+    def __init__(self, window: int = 14) -> None:
+        super().__init__(window=window)
+        self.window = window
+
+    def initial_state(self):
+        return {'close': None, 'gain': None, 'loss': None, 'count': 0}
+
+    def update(self, bars, state):
+        closes = bars['close']
+        previous = np.nan if state['close'] is None else state['close']
+        changes = np.diff(np.concatenate([[previous], closes]))
+
+        gains = ema(np.where(changes > 0, changes, 0.0), 1 / self.window, state['gain'])
+        losses = ema(np.where(changes < 0, -changes, 0.0), 1 / self.window, state['loss'])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = 100 - 100 / (1 + gains / losses)
+        values = np.where(losses == 0, 100.0, values)
+
+        # Not defined until a window of changes has been seen
+        count = state['count'] + np.arange(1, len(closes) + 1) - (state['close'] is None)
+        values = np.where(count < self.window, np.nan, values)
+
+        return {'value': values}, {'close': last_value(closes, state['close']),
+                                   'gain': last_value(gains, state['gain']),
+                                   'loss': last_value(losses, state['loss']),
+                                   'count': int(count[-1]) if len(count) else state['count']}
+
+
+class VWAP(Indicator):
+    '''Volume weighted average of the typical price, reset every UTC day'''
+    name = 'vwap'
+
+    def initial_state(self):
+        return {'day': None, 'price_volume': 0.0, 'volume': 0.0}
+
+    def update(self, bars, state):
+        days = np.asarray(bars['utc_time'], dtype=np.int64) // time_tools.day_ns
+        volume = np.nan_to_num(bars['volume'])
+        price_volume = np.nan_to_num((bars['high'] + bars['low'] + bars['close']) / 3 * volume)
+
+        totals = pd.DataFrame({'day': days, 'price_volume': price_volume, 'volume': volume})
+        totals = totals.groupby('day')[['price_volume', 'volume']].cumsum()
+        cumulative_price_volume = totals['price_volume'].to_numpy()
+        cumulative_volume = totals['volume'].to_numpy()
+
+        # Continue the day in progress
+        continuing = days == state['day']
+        cumulative_price_volume = cumulative_price_volume + np.where(continuing, state['price_volume'], 0.0)
+        cumulative_volume = cumulative_volume + np.where(continuing, state['volume'], 0.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = cumulative_price_volume / cumulative_volume
+
+        if not len(days):
+            return {'value': values}, state
+        return {'value': values}, {'day': int(days[-1]),
+                                   'price_volume': float(cumulative_price_volume[-1]),
+                                   'volume': float(cumulative_volume[-1])}
+
+
+default_indicators = [SMA(20), EMA(20), RSI(14), MACD(12, 26, 9),
+                      Bollinger(20, 2.0), VWAP(), Volatility(20)]
+
+# Bars are loaded up to this time (UTC nanoseconds, year 2116)
+last_time = 2 ** 62
+
+
+class IndicatorEngine:
+    '''
+    Computes indicators over the stored price data and persists their
+    values and states, extending them with only the bars added since
+    '''
+
+    def __init__(self, stock_price_table: str = 'stock_price') -> None:
+        """Initialise instance of IndicatorEngine class
+
+        Parameters:
+        ----------
+        stock_price_table (str) : name of the stock price table
+        """
+
+        self.stock_price_table = stock_price_table
+        self.indicator_table = f'{stock_price_table}_indicator'
+        self.state_table = f'{stock_price_table}_indicator_state'
+
+        # (stock_id, interval, indicator key): state row, as last persisted
+        self._states = dict()
+        self._lock = threading.Lock()
+
+    def load_states(self, cursor, stock_id: int, interval: str, indicators: list) -> dict:
+        '''Get the persisted state of every indicator (cached after the first load)'''
+        keys = [indicator.key for indicator in indicators]
+        with self._lock:
+            missing = [key for key in keys if (stock_id, interval, key) not in self._states]
+
+        if missing:
+            cursor.execute(f"""
+                    SELECT indicator, request_id, last_time, state FROM {self.state_table}
+                    WHERE stock_id = %s AND interval = %s AND indicator = ANY(%s)""",
+                           (stock_id, interval, missing))
+            loaded = {key: None for key in missing}
+            for key, request_id, last_update, state in cursor.fetchall():
+                loaded[key] = {'request_id': request_id,
+                               'last_time': pd.Timestamp(last_update).as_unit('ns').value,
+                               'state': json.loads(state)}
+            with self._lock:
+                for key, row in loaded.items():
+                    self._states[(stock_id, interval, key)] = row
+
+        with self._lock:
+            return {key: self._states[(stock_id, interval, key)] for key in keys}
+
+    def update(self, stock_id: int, interval: str = '1m', indicators: list = None) -> dict:
+        """Extend indicators with the bars stored since they were last updated
+
+        Bars written since the state's last request (request_id) with times
+        after the state's last bar are appended. If earlier bars were
+        rewritten, the indicator is recomputed from the first bar. Each
+        indicator has its own watermark, so only indicators without a state
+        (e.g. newly added) or with rewritten bars are computed from the first bar.
+
+        Parameters:
+        ----------
+        stock_id (int) : id of the stock
+        interval (str) : interval of the bars
+        indicators (list) : Indicator instances, defaults to default_indicators
+
+        Returns:
+        ----------
+        dict : indicator key: number of new bars computed
+        """
+
+        if indicators is None:
+            indicators = default_indicators
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            states = self.load_states(cursor, stock_id, interval, indicators)
+
+            # Earliest bar written after the watermark of each indicator, so
+            # an indicator added later does not make the others start over
+            watermarks = {key: (row['request_id'] or 0) if row else 0 for key, row in states.items()}
+            cursor.execute(f"""
+                    SELECT watermark, min(price.utc_time), max(price.request_id)
+                        FROM unnest(%s::integer[]) AS watermarks(watermark)
+                        LEFT JOIN {self.stock_price_table} AS price
+                            ON price.stock_id = %s AND price.interval = %s
+                            AND price.request_id > watermark
+                    GROUP BY watermark""",
+                           (sorted(set(watermarks.values())), stock_id, interval))
+            written = {watermark: (first_written, last_request_id)
+                       for watermark, first_written, last_request_id in cursor.fetchall()}
+            last_request_id = max((request_id for _, request_id in written.values()
+                                   if request_id is not None), default=None)
+            if last_request_id is None:
+                return {indicator.key: 0 for indicator in indicators}
+
+            # Time after which each indicator needs bars (None for every bar)
+            starts = dict()
+            for indicator in indicators:
+                row = states[indicator.key]
+                first_written = written[watermarks[indicator.key]][0]
+                if row is None:
+                    starts[indicator.key] = None
+                elif first_written is None:
+                    # Nothing written since the indicator was last updated
+                    starts[indicator.key] = last_time
+                elif pd.Timestamp(first_written).as_unit('ns').value <= row['last_time']:
+                    starts[indicator.key] = None
+                else:
+                    starts[indicator.key] = row['last_time']
+
+            first = min(0 if start is None else start + 1 for start in starts.values())
+            bars = load_bars(cursor, self.stock_price_table, stock_id, interval, first, last_time)
+
+            counts = dict()
+            value_frames = []
+            state_rows = []
+            for indicator in indicators:
+                start = starts[indicator.key]
+                if start is None:
+                    state = indicator.initial_state()
+                    position = 0
+                else:
+                    state = states[indicator.key]['state']
+                    position = np.searchsorted(bars['utc_time'], start, side='right')
+
+                new_bars = {column: values[position:] for column, values in bars.items()}
+                counts[indicator.key] = len(new_bars['utc_time'])
+                if not counts[indicator.key]:
+                    continue
+
+                outputs, state = indicator.update(new_bars, state)
+                times = pd.DatetimeIndex(new_bars['utc_time'], tz='UTC')
+                for output, series in zip(indicator.outputs, indicator.series()):
+                    value_frames.append(pd.DataFrame({'stock_id': stock_id,
+                                                      'interval': interval,
+                                                      'indicator': series,
+                                                      'utc_time': times,
+                                                      'value': outputs[output]}))
+
+                state_rows.append({'stock_id': stock_id,
+                                   'interval': interval,
+                                   'indicator': indicator.key,
+                                   'request_id': last_request_id,
+                                   'last_time': times[-1],
+                                   'state': json.dumps(state)})
+
+            if value_frames:
+                upsert_dataframe(cursor, pd.concat(value_frames, ignore_index=True),
+                                 self.indicator_table, ['stock_id', 'interval', 'indicator', 'utc_time'])
+            if state_rows:
+                upsert_dataframe(cursor, pd.DataFrame(state_rows), self.state_table,
+                                 ['stock_id', 'interval', 'indicator'])
+
+        # Cache the states once they are committed
+        with self._lock:
+            for row in state_rows:
+                self._states[(stock_id, interval, row['indicator'])] = {
+                    'request_id': row['request_id'],
+                    'last_time': row['last_time'].as_unit('ns').value,
+                    'state': json.loads(row['state'])}
+
+        return counts
+
+    def load(self, stock_id: int, indicator: Indicator, interval: str = '1m',
+             start=None, end=None) -> pd.DataFrame:
+        """Load the stored values of an indicator
+
+        Parameters:
+        ----------
+        stock_id (int) : id of the stock
+        indicator (Indicator) : indicator to load
+        interval (str) : interval of the bars
+        start, end : range of time to load (UTC), defaults to every value
+
+        Returns:
+        ----------
+        pd.DataFrame : one column per output, indexed by UTC time
+        """
+
+        start = to_utc(pd.Timestamp(0, tz='UTC') if start is None else start)
+        end = to_utc(pd.Timestamp(last_time, tz='UTC') if end is None else end)
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            frames = []
+            for output, series in zip(indicator.outputs, indicator.series()):
+                query = cursor.mogrify(f"""
+                        SELECT utc_time, COALESCE(value, 'NaN')
+                            FROM {self.indicator_table}
+                        WHERE stock_id = %s AND interval = %s AND indicator = %s
+                            AND utc_time >= %s AND utc_time < %s
+                        ORDER BY utc_time""",
+                                       (stock_id, interval, series,
+                                        start, end)).decode()
+                times, values = copy_to_arrays(cursor, query, ['timestamp with time zone',
+                                                               'double precision'])
+                frames.append(pd.Series(values, index=pd.DatetimeIndex(times, tz='UTC'), name=output))
+
+        return pd.concat(frames, axis=1)
+
+    def forget(self) -> None:
+        '''Clear the cached states (e.g. after the tables are dropped)'''
+        with self._lock:
+            self._states.clear()
+
+
+_engines = dict()
+_engines_lock = threading.Lock()
+
+def get_indicator_engine(stock_price_table: str = 'stock_price') -> IndicatorEngine:
+    '''Return the process-wide engine of a stock price table'''
+    with _engines_lock:
+        if stock_price_table not in _engines:
+            _engines[stock_price_table] = IndicatorEngine(stock_price_table)
+        return _engines[stock_price_table]
@@ -0,0 +1,347 @@
+import functools
+import http.server
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+# Created libraries
+from config import config
+
+# Instrumentation of the hot paths: download calls, SQL statements, rows
+# written and connections opened.
+#
+# Code records counts (count), durations (observe) and occurrences worth
+# reporting (event) here, and every configured sink receives them:
+# MemorySink keeps counters in process, LogSink writes structured log
+# records and PrometheusSink serves them in the Prometheus text format.
+# Sinks are read from the metrics section of database.ini on first use.
+# With no sinks, every hook returns after one check.
+
+logger = logging.getLogger('stocks')
+
+_sinks = []
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Sink:
+    '''
+    Receiver of metrics, ignoring everything by default
+    '''
+
+    def count(self, name: str, value: float, labels: dict) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float, labels: dict) -> None:
+        pass
+
+    def event(self, name: str, level: int, fields: dict) -> None:
+        pass
+
+
+class MemorySink(Sink):
+    '''
+    Counters, timings and recent events kept in process
+    '''
+
+    def __init__(self, max_events: int = 1000) -> None:
+        self._lock = threading.Lock()
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            # (name, labels): value
+            self.counters = dict()
+            # (name, labels): [count, total seconds, max seconds]
+            self.timings = dict()
+            self.events = deque(maxlen=self.max_events)
+
+    def count(self, name: str, value: float, labels: dict) -> None:
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict) -> None:
+        key = (name, label_key(labels))
+        with self._lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def event(self, name: str, level: int, fields: dict) -> None:
+        with self._lock:
+            self.events.append((time.time(), name, fields))
+
+    def total(self, name: str, **labels) -> float:
+        '''Sum of a counter over every label set matching labels'''
+        with self._lock:
+            return sum(value for (counter, key), value in self.counters.items()
+                       if counter == name and all(item in key for item in labels.items()))
+
+    def snapshot(self) -> dict:
+        """Copy the counters and timings
+
+        Returns:
+        ----------
+        dict : 'counters': [(name, labels, value)], 'timings':
+            [(name, labels, count, total seconds, max seconds)]
+        """
+
+        with self._lock:
+            return {'counters': [(name, dict(key), value)
+                                 for (name, key), value in sorted(self.counters.items())],
+                    'timings': [(name, dict(key), *timing)
+                                for (name, key), timing in sorted(self.timings.items())]}
+
+
+class LogSink(Sink):
+    '''
+    Structured (JSON) log records: events at their level, counts and
+    timings at DEBUG
+    '''
+
+    def __init__(self, logger: logging.Logger = logger) -> None:
+        self.logger = logger
+
+    def count(self, name: str, value: float, labels: dict) -> None:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps({'metric': name, 'value': value, **labels}, default=str))
+
+    def observe(self, name: str, seconds: float, labels: dict) -> None:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps({'metric': name, 'seconds': seconds, **labels}, default=str))
+
+    def event(self, name: str, level: int, fields: dict) -> None:
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, json.dumps({'event': name, **fields}, default=str))
+
+
+class PrometheusSink(MemorySink):
+    '''
+    In process counters exposed in the Prometheus text format
+    '''
+
+    def __init__(self, prefix: str = 'stocks') -> None:
+        super().__init__(max_events=0)
+        self.prefix = prefix
+        self._server = None
+
+    def event(self, name: str, level: int, fields: dict) -> None:
+        self.count('events', 1, {'event': name})
+
+    @staticmethod
+    def format_labels(labels: dict) -> str:
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for value in labels.values())
+        return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+    def exposition(self) -> str:
+        '''Render every counter and timing in the Prometheus text format'''
+        snapshot = self.snapshot()
+        lines = []
+
+        declared = set()
+        for name, labels, value in snapshot['counters']:
+            metric = f'{self.prefix}_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            lines.append(f'{metric}{self.format_labels(labels)} {value}')
+
+        for name, labels, count, total, _ in snapshot['timings']:
+            metric = f'{self.prefix}_{name}_seconds'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} summary')
+                declared.add(metric)
+            lines.append(f'{metric}_count{self.format_labels(labels)} {count}')
+            lines.append(f'{metric}_sum{self.format_labels(labels)} {total}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '') -> None:
+        '''Serve the exposition over HTTP (any path) from a daemon thread'''
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+
+
+def configure(filename: str = 'database.ini') -> None:
+    """Set the sinks from the metrics section of database.ini
+
+    sinks is a comma separated list of memory, log and prometheus (empty
+    or no section disables metrics). log_level sets the level of the
+    stocks logger and prometheus_port serves the Prometheus sink.
+    """
+
+    try:
+        params = config(filename, section='metrics')
+    except Exception:
+        params = dict()
+
+    sinks = []
+    for name in [name.strip() for name in params.get('sinks', '').split(',') if name.strip()]:
+        if name == 'memory':
+            sinks.append(MemorySink())
+        elif name == 'log':
+            sinks.append(LogSink())
+            # Show the records if the application has not configured logging
+            if not logger.handlers and not logging.getLogger().handlers:
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+                logger.addHandler(handler)
+        elif name == 'prometheus':
+            sink = PrometheusSink()
+            if params.get('prometheus_port'):
+                sink.serve(int(params['prometheus_port']))
+            sinks.append(sink)
+        else:
+            raise ValueError(f'{name} is not a metrics sink (sinks: memory, log, prometheus)')
+
+    if params.get('log_level'):
+        logger.setLevel(params['log_level'].upper())
+
+    set_sinks(sinks)
+
+def get_sinks() -> list:
+    '''Return the active sinks, configuring them on first use'''
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                configure()
+    return _sinks
+
+def set_sinks(sinks: list) -> None:
+    '''Replace the active sinks (an empty list disables metrics)'''
+    global _sinks, _configured
+    _sinks = list(sinks)
+    _configured = True
+
+def add_sink(sink: Sink) -> None:
+    set_sinks(get_sinks() + [sink])
+
+def remove_sink(sink: Sink) -> None:
+    set_sinks([active for active in get_sinks() if active is not sink])
+
+def enabled() -> bool:
+    return bool(get_sinks())
+
+def count(name: str, value: float = 1, **labels) -> None:
+    '''Add value to a counter'''
+    for sink in get_sinks():
+        sink.count(name, value, labels)
+
+def observe(name: str, seconds: float, **labels) -> None:
+    '''Record the duration of one occurrence'''
+    for sink in get_sinks():
+        sink.observe(name, seconds, labels)
+
+def event(name: str, level: int = logging.INFO, **fields) -> None:
+    '''Report an occurrence (e.g. a skipped download) with its details'''
+    for sink in get_sinks():
+        sink.event(name, level, fields)
+
+@contextmanager
+def timer(name: str, **labels):
+    '''Observe the duration of a with block'''
+    if not get_sinks():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def instrument(name: str):
+    """Decorate a function to count its calls and errors (<name>_calls,
+    <name>_errors) and observe its duration (<name>), labelled by method
+    """
+
+    def decorator(function):
+        method = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not get_sinks():
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                count(f'{name}_errors', method=method)
+                raise
+            finally:
+                count(f'{name}_calls', method=method)
+                observe(name, time.perf_counter() - start, method=method)
+
+        return wrapper
+    return decorator
+
+
+def statement_kind(query) -> str:
+    '''First keyword of a SQL statement (SELECT, INSERT, COPY, ...)'''
+    if isinstance(query, bytes):
+        query = query[:64].decode(errors='replace')
+    elif not isinstance(query, str):
+        # psycopg2.sql.Composed and similar
+        return 'OTHER'
+    words = query.lstrip(' \t\n(').split(None, 1)
+    return words[0].upper() if words else 'OTHER'
+
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    '''
+    Cursor counting and timing every statement (sql_statements and sql,
+    labelled by statement kind)
+    '''
+
+    def timed(self, query, run, statements: int = 1):
+        kind = statement_kind(query)
+        start = time.perf_counter()
+        try:
+            return run()
+        finally:
+            count('sql_statements', statements, kind=kind)
+            observe('sql', time.perf_counter() - start, kind=kind)
+
+    def execute(self, query, vars=None):
+        return self.timed(query, lambda: super(MetricsCursor, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        return self.timed(query, lambda: super(MetricsCursor, self).executemany(query, vars_list),
+                          statements=len(vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return self.timed(sql, lambda: super(MetricsCursor, self).copy_expert(sql, file, size))
+
+    def copy_from(self, file, table, *args, **kwargs):
+        return self.timed('COPY', lambda: super(MetricsCursor, self).copy_from(file, table, *args, **kwargs))
@@ -0,0 +1,365 @@
+import datetime
+import re
+import threading
+
+import pandas as pd
+from dateutil import tz
+
+# Created libraries
+from config import config
+from connect import connection
+import metrics
+
+# Declarative range partitioning of the stock price table by utc_time.
+#
+# Partitioning is optional: it is enabled by a partition section in
+# database.ini. Each partition holds one span (day, week, month, quarter
+# or year) of bars. Partitions are created ahead of the data they hold,
+# and ones older than the retention are detached or dropped.
+
+# Span: pandas period frequency
+span_frequencies = {'day': 'D',
+                    'week': 'W-SUN',
+                    'month': 'M',
+                    'quarter': 'Q',
+                    'year': 'Y'}
+
+expire_actions = ['detach', 'drop']
+
+bound_pattern = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+class PartitionManager:
+    '''
+    Creates, lists and expires the range partitions of a table
+    '''
+
+    def __init__(self, table: str = 'stock_price', column: str = 'utc_time',
+                 span: str = 'month', premake: int = 3, retention: int = None,
+                 expire: str = 'detach') -> None:
+        """Initialise instance of PartitionManager class
+
+        Parameters:
+        ----------
+        table (str) : name of the partitioned table
+        column (str) : timestamp with time zone column partitioned on
+        span (str) : time covered by each partition (key of span_frequencies)
+        premake (int) : number of future partitions created ahead of time
+        retention (int) : number of past partitions kept, None keeps every partition
+        expire (str) : 'detach' (keep expired partitions as tables named
+            <partition>_detached) or 'drop'
+
+        Raises:
+        ----------
+        ValueError : span or expire is not valid, or premake or retention is negative
+        """
+
+        if span not in span_frequencies:
+            raise ValueError(f'{span} is not a span (spans: {list(span_frequencies)})')
+        if expire not in expire_actions:
+            raise ValueError(f'{expire} is not an expire action (actions: {expire_actions})')
+        if premake < 0 or (retention is not None and retention < 0):
+            raise ValueError(f'premake and retention must not be negative ' \
+                             f'(premake: {premake}, retention: {retention})')
+
+        self.table = table
+        self.column = column
+        self.span = span
+        self.premake = premake
+        self.retention = retention
+        self.expire = expire
+
+        # Start of every partition known to exist
+        self._known = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, table: str = 'stock_price', filename: str = 'database.ini',
+                    section: str = 'partition'):
+        """Create a manager from a section of a config file
+
+        Returns:
+        ----------
+        PartitionManager : manager, or None if the section is missing or
+            its span is 'none'
+        """
+
+        try:
+            params = config(filename=filename, section=section)
+        except Exception:
+            return None
+
+        span = params.get('span', 'month')
+        if span == 'none':
+            return None
+
+        retention = params.get('retention')
+        return cls(table=table, span=span,
+                   premake=int(params.get('premake', 3)),
+                   retention=int(retention) if retention else None,
+                   expire=params.get('expire', 'detach'))
+
+    def span_start(self, timestamp) -> pd.Timestamp:
+        '''Start (UTC) of the span containing a timestamp'''
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tz is None:
+            timestamp = timestamp.tz_localize('UTC')
+        period = timestamp.tz_convert('UTC').tz_localize(None).to_period(span_frequencies[self.span])
+        return period.start_time.tz_localize('UTC')
+
+    def span_starts(self, start, end) -> list:
+        '''Starts of every span from the one containing start to the one containing end'''
+        first = self.span_start(start).tz_localize(None).to_period(span_frequencies[self.span])
+        last = self.span_start(end).tz_localize(None).to_period(span_frequencies[self.span])
+        return [period.start_time.tz_localize('UTC')
+                for period in pd.period_range(first, last)]
+
+    def span_end(self, start: pd.Timestamp) -> pd.Timestamp:
+        '''End (UTC, exclusive) of the span starting at start'''
+        period = start.tz_localize(None).to_period(span_frequencies[self.span])
+        return (period + 1).start_time.tz_localize('UTC')
+
+    def partition_name(self, start: pd.Timestamp) -> str:
+        return f'{self.table}_p{start:%Y%m%d}'
+
+    def is_partitioned(self, cursor) -> bool:
+        '''True if the table exists and is partitioned'''
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (self.table,))
+        row = cursor.fetchone()
+        return bool(row) and row[0] == 'p'
+
+    def partitions(self, cursor) -> dict:
+        """Get the partitions attached to the table
+
+        Returns:
+        ----------
+        dict : partition name: (start, end) UTC timestamps
+        """
+
+        cursor.execute("""
+                SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+                    FROM pg_inherits
+                    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = to_regclass(%s)""", (self.table,))
+
+        partitions = dict()
+        for name, bound in cursor.fetchall():
+            match = bound_pattern.search(bound)
+            if match:
+                partitions[name] = (pd.Timestamp(match.group(1)).tz_convert('UTC'),
+                                    pd.Timestamp(match.group(2)).tz_convert('UTC'))
+        return partitions
+
+    def create_partitions(self, cursor, start, end) -> list:
+        """Create the partitions covering start to end (inclusive)
+
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor
+        start, end : timestamps to cover
+
+        Returns:
+        ----------
+        list : names of the partitions created
+        """
+
+        if self._known is None:
+            self._known = {bounds[0] for bounds in self.partitions(cursor).values()}
+
+        created = []
+        for span_start in self.span_starts(start, end):
+            if span_start in self._known:
+                continue
+
+            name = self.partition_name(span_start)
+            cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {name}
+                        PARTITION OF {self.table}
+                        FOR VALUES FROM (%s) TO (%s)""",
+                           (span_start.to_pydatetime(), self.span_end(span_start).to_pydatetime()))
+            self._known.add(span_start)
+            created.append(name)
+
+        if created:
+            metrics.count('partitions_created', len(created), table=self.table)
+            metrics.event('partitions_created', table=self.table, partitions=created)
+
+        return created
+
+    def ensure_partitions(self, start, end) -> list:
+        """Create (and commit) the partitions covering start to end
+
+        Partitions already known to this process are skipped without
+        querying the database, so this is cheap to call before every write.
+
+        Returns:
+        ----------
+        list : names of the partitions created
+        """
+
+        with self._lock:
+            if self._known is not None and \
+                    all(span_start in self._known for span_start in self.span_starts(start, end)):
+                return []
+
+            try:
+                with connection() as conn:
+                    return self.create_partitions(conn.cursor(), start, end)
+            except Exception:
+                # The cache may hold partitions that were rolled back
+                self._known = None
+                raise
+
+    def forget(self) -> None:
+        '''Forget the partitions known to exist (e.g. after dropping the table)'''
+        with self._lock:
+            self._known = None
+
+    def convert(self, cursor) -> None:
+        """Convert the (unpartitioned) table to a partitioned table
+
+        The table is renamed, a partitioned table with the same columns,
+        defaults, keys and indexes is created in its place, partitions
+        covering its rows are created and the rows are moved across.
+        Rows without a utc_time cannot be routed to a partition and are
+        dropped.
+        """
+
+        table = self.table
+        old_table = f'{table}_unpartitioned'
+
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+        cursor.execute(f"ALTER TABLE {old_table} RENAME CONSTRAINT {table}_pkey TO {old_table}_pkey")
+        for index in ['stock_interval_time_key', 'request_id_idx']:
+            cursor.execute(f"ALTER INDEX IF EXISTS {table}_{index} RENAME TO {old_table}_{index}")
+
+        # Partition keys must be part of every unique index
+        cursor.execute(f"""
+                CREATE TABLE {table}
+                    (LIKE {old_table} INCLUDING DEFAULTS)
+                    PARTITION BY RANGE ({self.column})""")
+        cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {self.column})")
+        cursor.execute(f"""
+                CREATE UNIQUE INDEX {table}_stock_interval_time_key
+                    ON {table} (stock_id, interval, {self.column})""")
+        cursor.execute(f"CREATE INDEX {table}_request_id_idx ON {table} (request_id)")
+
+        # Copy the foreign keys of the old table
+        cursor.execute("""
+                SELECT pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid = to_regclass(%s) AND contype = 'f'""", (old_table,))
+        for (definition,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+
+        cursor.execute(f"SELECT min({self.column}), max({self.column}) FROM {old_table}")
+        first, last = cursor.fetchone()
+        if first is not None:
+            self._known = set()
+            self.create_partitions(cursor, first, last)
+
+        cursor.execute(f"""
+                INSERT INTO {table} SELECT * FROM {old_table}
+                WHERE {self.column} IS NOT NULL""")
+        metrics.event('rows_partitioned', table=table, rows=cursor.rowcount)
+
+        # Keep the id sequence when the old table is dropped
+        cursor.execute(f"ALTER SEQUENCE IF EXISTS {table}_id_seq OWNED BY {table}.id")
+        cursor.execute(f"DROP TABLE {old_table}")
+
+    def archive(self, cursor, name: str) -> None:
+        '''Make a detached partition independent of the sequence and
+        tables of the partitioned table, so they can be dropped'''
+        cursor.execute(f"ALTER TABLE {name} ALTER COLUMN id DROP DEFAULT")
+
+        cursor.execute("""
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = to_regclass(%s) AND contype = 'f'""", (name,))
+        for (constraint,) in cursor.fetchall():
+            cursor.execute(f'ALTER TABLE {name} DROP CONSTRAINT "{constraint}"')
+
+    def maintain(self, cursor, now: datetime.datetime = None) -> dict:
+        """Create the next premake partitions and expire old partitions
+
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor
+        now (datetime.datetime) : current time, defaults to now
+
+        Returns:
+        ----------
+        dict : names of partitions 'created' and 'expired'
+        """
+
+        now = pd.Timestamp(now or datetime.datetime.now(datetime.timezone.utc))
+        current = self.span_start(now)
+
+        # Start of the span premake spans ahead of now
+        future = current.tz_localize(None).to_period(span_frequencies[self.span]) + self.premake
+        created = self.create_partitions(cursor, current, future.start_time.tz_localize('UTC'))
+
+        expired = []
+        if self.retention is not None:
+            oldest = current.tz_localize(None).to_period(span_frequencies[self.span]) - self.retention
+            oldest = oldest.start_time.tz_localize('UTC')
+
+            for name, (start, end) in sorted(self.partitions(cursor).items()):
+                if end > oldest:
+                    continue
+
+                if self.expire == 'drop':
+                    cursor.execute(f"DROP TABLE {name}")
+                else:
+                    # Rename so a new partition can be created for the span
+                    cursor.execute(f"ALTER TABLE {self.table} DETACH PARTITION {name}")
+                    cursor.execute(f"ALTER TABLE {name} RENAME TO {name}_detached")
+                    self.archive(cursor, f'{name}_detached')
+                if self._known is not None:
+                    self._known.discard(start)
+                expired.append(name)
+
+            if expired:
+                metrics.count('partitions_expired', len(expired), table=self.table)
+                metrics.event('partitions_expired', table=self.table, mode=self.expire,
+                              partitions=expired)
+
+        return {'created': created, 'expired': expired}
+
+    def setup(self, cursor) -> None:
+        '''Partition the table if it is not already partitioned, then maintain it'''
+        if not self.is_partitioned(cursor):
+            self.convert(cursor)
+        self.maintain(cursor)
+
+
+_managers = dict()
+_managers_lock = threading.Lock()
+
+def get_partition_manager(table: str = 'stock_price') -> PartitionManager:
+    '''Return the process-wide manager of a table, or None if partitioning
+    is not enabled in the partition section of database.ini
+    '''
+    with _managers_lock:
+        if table not in _managers:
+            _managers[table] = PartitionManager.from_config(table=table)
+        return _managers[table]
+
+def prepare_partitions(table: str, timestamps: pd.DatetimeIndex) -> list:
+    """Create the partitions of a table needed to store rows with the given
+    timestamps, if the table is partitioned
+
+    Naive timestamps are taken to be local time, as in Stock.format_price_data.
+
+    Returns:
+    ----------
+    list : names of the partitions created
+    """
+
+    manager = get_partition_manager(table)
+    if manager is None or not len(timestamps):
+        return []
+
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is None:
+        timestamps = timestamps.tz_localize(tz.tzlocal())
+
+    return manager.ensure_partitions(timestamps.min(), timestamps.max())
@@ -0,0 +1,176 @@
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+from stock_market import default_exchange, get_market
+import time_tools
+
+# Plans downloads of stock price data so that only the bars missing
+# from the database are requested from yfinance
+
+
+class DownloadPlan:
+    '''
+    Ranges of bars to download for one ticker, period and interval
+    '''
+
+    def __init__(self, ticker: str, period: str, interval: str,
+                 expected: pd.DatetimeIndex, missing: pd.DatetimeIndex,
+                 missing_ranges: list) -> None:
+        """Initialise instance of DownloadPlan class
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        period (str) : period the data is requested for
+        interval (str) : interval between stock price data values
+        expected (pd.DatetimeIndex) : timestamps expected for the period
+        missing (pd.DatetimeIndex) : expected timestamps not in the database
+        missing_ranges (list) : (start, end) half open ranges covering missing
+        """
+
+        self.ticker = ticker
+        self.period = period
+        self.interval = interval
+        self.expected = expected
+        self.missing = missing
+        self.missing_ranges = missing_ranges
+
+    @property
+    def expected_bars(self) -> int:
+        return len(self.expected)
+
+    @property
+    def missing_bars(self) -> int:
+        return len(self.missing)
+
+    @property
+    def bars_saved(self) -> int:
+        '''Number of bars not downloaded because they are already stored'''
+        return self.expected_bars - self.missing_bars
+
+    @property
+    def requests(self) -> int:
+        '''Number of downloads the plan issues'''
+        return len(self.missing_ranges)
+
+    @property
+    def requests_saved(self) -> int:
+        '''Number of downloads avoided compared to downloading the whole
+        period (1 when every expected bar is stored)'''
+        return 1 if not self.missing_ranges else 0
+
+    @property
+    def is_full_period(self) -> bool:
+        '''True if nothing is stored, so the whole period must be downloaded'''
+        return self.missing_bars == self.expected_bars
+
+    def __repr__(self) -> str:
+        return f'DownloadPlan({self.ticker}, {self.period}, {self.interval}: ' \
+               f'{self.missing_bars}/{self.expected_bars} bars missing, ' \
+               f'{self.requests} requests)'
+
+
+_statistics = {'plans': 0,
+               'expected_bars': 0,
+               'bars_saved': 0,
+               'requests': 0,
+               'requests_saved': 0}
+_statistics_lock = threading.Lock()
+
+def planner_statistics() -> dict:
+    '''Return the totals of every plan made by this process'''
+    with _statistics_lock:
+        return dict(_statistics)
+
+def record_plan(plan: DownloadPlan) -> None:
+    '''Add a plan to the process totals'''
+    with _statistics_lock:
+        _statistics['plans'] += 1
+        _statistics['expected_bars'] += plan.expected_bars
+        _statistics['bars_saved'] += plan.bars_saved
+        _statistics['requests'] += plan.requests
+        _statistics['requests_saved'] += plan.requests_saved
+
+def missing_ranges(expected: pd.DatetimeIndex, stored: pd.DatetimeIndex,
+                   interval: str, max_requests: int = 3) -> tuple:
+    """Compute the ranges of expected timestamps missing from stored
+
+    Runs of consecutive missing timestamps become half open
+    [first, last + interval) ranges. If there are more runs than
+    max_requests, the runs separated by the smallest gaps are merged.
+
+    Parameters:
+    ----------
+    expected (pd.DatetimeIndex) : timestamps expected for the period
+    stored (pd.DatetimeIndex) : timestamps already stored
+    interval (str) : interval between timestamps (key of time_tools.interval_dict)
+    max_requests (int) : maximum number of ranges to return
+
+    Returns:
+    ----------
+    tuple : (missing timestamps (pd.DatetimeIndex), list of (start, end) ranges)
+    """
+
+    expected = expected.unique().sort_values()
+    is_missing = ~expected.isin(stored)
+    missing = expected[is_missing]
+
+    if not is_missing.any():
+        return missing, []
+
+    # Find the runs of missing timestamps in the expected grid
+    edges = np.diff(np.concatenate([[0], is_missing.astype(np.int8), [0]]))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1) - 1
+
+    # Merge the runs separated by the smallest gaps
+    if max_requests and len(run_starts) > max_requests:
+        gaps = (expected[run_starts[1:]] - expected[run_ends[:-1]]).asi8
+        keep = np.sort(np.argsort(gaps, kind='stable')[len(gaps) - (max_requests - 1):])
+        run_starts = np.concatenate([run_starts[:1], run_starts[keep + 1]])
+        run_ends = np.concatenate([run_ends[keep], run_ends[-1:]])
+
+    step = pd.Timedelta(seconds=time_tools.interval_dict[interval])
+    ranges = [(expected[start], expected[end] + step)
+              for start, end in zip(run_starts, run_ends)]
+
+    return missing, ranges
+
+def plan_download(ticker: str, period: str, interval: str, stored: pd.DatetimeIndex,
+                  expected: pd.DatetimeIndex = None, end: datetime.datetime = None,
+                  max_requests: int = 3, market=None) -> DownloadPlan:
+    """Plan the downloads needed to complete a period of stock price data
+
+    Compare the timestamps expected for the period (the completed bars of
+    the market's sessions, see stock_market.StockMarket.bar_timestamps)
+    with the timestamps already stored.
+
+    Parameters:
+    ----------
+    ticker (str) : name of the stock ticker
+    period (str) : period to download (key of time_tools.period_dict)
+    interval (str) : interval between values (key of time_tools.interval_dict)
+    stored (pd.DatetimeIndex) : timestamps already stored for ticker and interval
+    expected (pd.DatetimeIndex) : timestamps expected for the period, if already generated
+    end (datetime.datetime) : end of the period, defaults to now
+    max_requests (int) : maximum number of downloads to plan
+    market (stock_market.StockMarket) : exchange of the ticker, defaults to
+        stock_market.default_exchange
+
+    Returns:
+    ----------
+    DownloadPlan : the plan, also added to planner_statistics()
+    """
+
+    if expected is None:
+        market = market or get_market(default_exchange)
+        expected = time_tools.generate_timestamps(period, interval, end=end, market=market)
+    missing, ranges = missing_ranges(expected, stored, interval, max_requests=max_requests)
+
+    plan = DownloadPlan(ticker, period, interval, expected, missing, ranges)
+    record_plan(plan)
+
+    return plan
@@ -0,0 +1,408 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# Created libraries
+from config import config
+from stock_market import default_exchange, get_market
+import time_tools
+
+# Local columnar cache of stored stock price data.
+#
+# Each stock price table has its own cache (see get_price_cache), in which
+# each (ticker, interval) has a directory holding one raw binary file per
+# column (utc_time as int64 nanoseconds, prices and volume as float64) and
+# a meta.json recording the number of rows, the [start, end) range of
+# time the files hold every stored bar for and whether that range reached
+# the time it was loaded (so held every bar then stored after start). Reads memory map the files and
+# return views of the requested range, so no data is copied.
+#
+# Bars written by this process are added through update_price_cache: bars
+# following on from the cached range are appended in place, extending it to
+# the last bar written. Writes overlapping the cached bars, or leaving a gap
+# after the cached range that the exchange's sessions have bars of other
+# writers in, invalidate the entry. A range ending after the cached range of such an
+# entry is therefore served up to the cached end, as nothing newer was
+# written by this process.
+# The least recently used entries are evicted to keep the cache under max_bytes.
+
+# Column: dtype of its file
+cache_columns = {'utc_time': np.int64,
+                 'open': np.float64,
+                 'high': np.float64,
+                 'low': np.float64,
+                 'close': np.float64,
+                 'adj_close': np.float64,
+                 'volume': np.float64}
+
+meta_file = 'meta.json'
+
+
+class PriceCache:
+    '''
+    Size bounded, memory mapped cache of price data per (ticker, interval)
+    '''
+
+    def __init__(self, directory: str = 'price_cache', max_bytes: int = 512 * 2**20) -> None:
+        """Initialise instance of PriceCache class
+
+        Parameters:
+        ----------
+        directory (str) : directory the cache files are kept in
+        max_bytes (int) : size of the cache above which entries are evicted
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.RLock()
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'appends': 0,
+                       'invalidations': 0,
+                       'evictions': 0}
+
+    def entry_directory(self, ticker: str, interval: str) -> str:
+        return os.path.join(self.directory, interval, ticker)
+
+    def read_meta(self, ticker: str, interval: str) -> dict:
+        '''Return the meta data of an entry, or None if it is not cached'''
+        path = os.path.join(self.entry_directory(ticker, interval), meta_file)
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, ticker: str, interval: str, meta: dict) -> None:
+        # Replace atomically, so readers see the old or new meta data
+        path = os.path.join(self.entry_directory(ticker, interval), meta_file)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(meta, file)
+        os.replace(path + '.tmp', path)
+
+    def columns(self, ticker: str, interval: str, meta: dict) -> dict:
+        '''Memory map every column of an entry'''
+        directory = self.entry_directory(ticker, interval)
+        if not meta['length']:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in cache_columns.items()}
+        return {column: np.memmap(os.path.join(directory, f'{column}.bin'), dtype=dtype,
+                                  mode='r', shape=(meta['length'],))
+                for column, dtype in cache_columns.items()}
+
+    def get(self, ticker: str, interval: str, start: int, end: int = None) -> dict:
+        """Get the cached bars in [start, end), if the entry covers the range
+
+        If the entry was loaded up to the time it was loaded, an end after
+        the cached range is capped at its end, the bars after it not having
+        been written yet (see update).
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        interval (str) : interval between stock price data values
+        start (int) : start of the range, as UTC nanoseconds
+        end (int) : end (exclusive) of the range, as UTC nanoseconds,
+            None for every bar stored after start
+
+        Returns:
+        ----------
+        dict : column: np.ndarray view of the memory mapped file, or None
+            if the range is not cached
+        """
+
+        with self._lock:
+            meta = self.read_meta(ticker, interval)
+            end = meta['end'] if meta is not None and end is None else end
+            if meta is None or start < meta['start'] or (end > meta['end'] and not meta.get('current')):
+                self._stats['misses'] += 1
+                return None
+
+            self._stats['hits'] += 1
+            return self.view(ticker, interval, meta, start, min(end, meta['end']))
+
+    def view(self, ticker: str, interval: str, meta: dict, start: int, end: int) -> dict:
+        '''Return views of the bars of an entry in [start, end), marking it as used'''
+        os.utime(os.path.join(self.entry_directory(ticker, interval), meta_file))
+
+        columns = self.columns(ticker, interval, meta)
+        first, last = np.searchsorted(columns['utc_time'], [start, end])
+        return {column: values[first:last] for column, values in columns.items()}
+
+    def read(self, ticker: str, interval: str, start: int, end: int, load) -> dict:
+        """Get the bars in [start, end), loading and caching them on a miss
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        interval (str) : interval between stock price data values
+        start (int) : start of the range, as UTC nanoseconds
+        end (int) : end (exclusive) of the range, as UTC nanoseconds,
+            None for every bar stored after start
+        load (callable) : load(start, end) returning the stored bars as
+            column: np.ndarray, sorted by utc_time
+
+        Returns:
+        ----------
+        dict : column: np.ndarray view of the memory mapped file
+        """
+
+        with self._lock:
+            data = self.get(ticker, interval, start, end)
+            if data is None:
+                # Bars are labelled by their start, so none is stored after now
+                now = time.time_ns() // 1000 * 1000
+                end = now if end is None else end
+                self.put(ticker, interval, load(start, end), start, end, current=end >= now)
+                data = self.view(ticker, interval, self.read_meta(ticker, interval), start, end)
+            return data
+
+    def put(self, ticker: str, interval: str, data: dict, start: int, end: int,
+            current: bool = False) -> None:
+        """Replace an entry with the bars stored for [start, end)
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        interval (str) : interval between stock price data values
+        data (dict) : column: np.ndarray of every stored bar in the range,
+            sorted by utc_time
+        start (int) : start of the range, as UTC nanoseconds
+        end (int) : end (exclusive) of the range, as UTC nanoseconds
+        current (bool) : the range ends at or after the time the bars were
+            loaded, so holds every bar stored after start
+        """
+
+        with self._lock:
+            directory = self.entry_directory(ticker, interval)
+            os.makedirs(directory, exist_ok=True)
+
+            # Invalidate before rewriting the columns
+            path = os.path.join(directory, meta_file)
+            if os.path.exists(path):
+                os.remove(path)
+
+            # Write new files rather than truncating ones that may be mapped
+            length = len(data['utc_time'])
+            for column, dtype in cache_columns.items():
+                values = np.ascontiguousarray(data[column], dtype=dtype)
+                column_path = os.path.join(directory, f'{column}.bin')
+                values.tofile(column_path + '.tmp')
+                os.replace(column_path + '.tmp', column_path)
+
+            self.write_meta(ticker, interval, {'length': length, 'start': start, 'end': end,
+                                               'current': current})
+            self.evict(keep=(ticker, interval))
+
+    def update(self, ticker: str, interval: str, data: dict,
+               exchange: str = default_exchange) -> bool:
+        """Add newly stored bars to an entry
+
+        Bars following on from the cached range are appended to the files,
+        and the range extended to the last of them. Bars at or before the
+        last cached bar invalidate the entry instead, as the cached bars may
+        have been updated, as do bars leaving room for a bar of the
+        exchange's sessions between the cached range and the first of them
+        (e.g. one written by another process), which the entry would claim
+        did not exist.
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        interval (str) : interval between stock price data values
+        data (dict) : column: np.ndarray of the stored bars, sorted by utc_time
+        exchange (str) : exchange (section of exchanges.ini) whose sessions
+            the bars fall in
+
+        Returns:
+        ----------
+        bool : True if the bars were appended
+        """
+
+        times = np.asarray(data['utc_time'], dtype=np.int64)
+        if not len(times):
+            return False
+
+        with self._lock:
+            meta = self.read_meta(ticker, interval)
+            if meta is None:
+                return False
+
+            # Bars before the start or at or before the last cached bar may
+            # replace cached bars
+            cached_times = self.columns(ticker, interval, meta)['utc_time']
+            if times[0] < meta['start'] or (len(cached_times) and times[0] <= cached_times[-1]):
+                self.invalidate(ticker, interval)
+                return False
+            del cached_times
+
+            # A bar of the exchange's sessions between the cached range and
+            # the first new bar would be outside the range, so the entry cannot
+            # know whether it was stored (nights, weekends and holidays hold none)
+            step = time_tools.interval_dict[interval] * time_tools.second_ns
+            if times[0] - step >= meta['end'] and \
+                    len(get_market(exchange).bars_between(meta['end'], int(times[0]), interval)):
+                self.invalidate(ticker, interval)
+                return False
+
+            directory = self.entry_directory(ticker, interval)
+            for column, dtype in cache_columns.items():
+                values = np.ascontiguousarray(data[column], dtype=dtype)
+                with open(os.path.join(directory, f'{column}.bin'), 'r+b' if meta['length'] else 'wb') as file:
+                    # Overwrite anything past the recorded length (e.g. from an
+                    # interrupted append), never truncating below it
+                    file.seek(meta['length'] * values.itemsize)
+                    file.write(values.tobytes())
+                    file.truncate()
+
+            self.write_meta(ticker, interval, {'length': meta['length'] + len(times),
+                                               'start': meta['start'],
+                                               'end': max(meta['end'], int(times[-1]) + 1),
+                                               'current': meta.get('current', False)})
+            self._stats['appends'] += 1
+            self.evict(keep=(ticker, interval))
+            return True
+
+    def clear(self) -> None:
+        '''Remove every entry from the cache (e.g. after the table is dropped)'''
+        with self._lock:
+            entries = self.entries()
+            for _, _, ticker, interval in entries:
+                shutil.rmtree(self.entry_directory(ticker, interval), ignore_errors=True)
+            self._stats['invalidations'] += len(entries)
+
+    def invalidate(self, ticker: str, interval: str) -> None:
+        '''Remove an entry from the cache'''
+        with self._lock:
+            directory = self.entry_directory(ticker, interval)
+            if os.path.exists(directory):
+                shutil.rmtree(directory, ignore_errors=True)
+                self._stats['invalidations'] += 1
+
+    def entries(self) -> list:
+        """List the cached entries
+
+        Returns:
+        ----------
+        list : (last access time, bytes, ticker, interval) of every entry
+        """
+
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+
+        for interval in os.listdir(self.directory):
+            for ticker in os.listdir(os.path.join(self.directory, interval)):
+                directory = self.entry_directory(ticker, interval)
+                try:
+                    accessed = os.stat(os.path.join(directory, meta_file)).st_mtime
+                    size = sum(entry.stat().st_size for entry in os.scandir(directory))
+                except OSError:
+                    continue
+                entries.append((accessed, size, ticker, interval))
+
+        return entries
+
+    def size(self) -> int:
+        '''Total size of the cached files in bytes'''
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, keep: tuple = None) -> list:
+        """Remove the least recently used entries until the cache is under max_bytes
+
+        Parameters:
+        ----------
+        keep (tuple) : (ticker, interval) of an entry never to evict
+
+        Returns:
+        ----------
+        list : (ticker, interval) of the evicted entries
+        """
+
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(entry[1] for entry in entries)
+
+            evicted = []
+            for _, size, ticker, interval in entries:
+                if total <= self.max_bytes:
+                    break
+                if (ticker, interval) == keep:
+                    continue
+                shutil.rmtree(self.entry_directory(ticker, interval), ignore_errors=True)
+                total -= size
+                evicted.append((ticker, interval))
+
+            self._stats['evictions'] += len(evicted)
+            return evicted
+
+    def statistics(self) -> dict:
+        '''Return the cache counters and size'''
+        with self._lock:
+            stats = dict(self._stats)
+        stats['bytes'] = self.size()
+        return stats
+
+
+_caches = dict()
+_cache_lock = threading.Lock()
+
+def get_price_cache(stock_price_table: str = 'stock_price') -> PriceCache:
+    """Return the process-wide price cache of a stock price table, or None
+    if the price_cache section of database.ini is missing or disabled
+
+    Each table is cached in its own subdirectory of the configured
+    directory, with max_bytes applying to each table's cache.
+    """
+
+    with _cache_lock:
+        if stock_price_table not in _caches:
+            try:
+                params = config(section='price_cache')
+            except Exception:
+                return None
+            if params.get('enabled', 'true').lower() not in ['yes', 'true']:
+                return None
+
+            directory = os.path.join(params.get('directory', 'price_cache'), stock_price_table)
+            _caches[stock_price_table] = PriceCache(directory=directory,
+                                                    max_bytes=int(params.get('max_bytes', 512 * 2**20)))
+        return _caches[stock_price_table]
+
+def set_price_cache(cache: PriceCache, stock_price_table: str = 'stock_price') -> None:
+    '''Replace the process-wide price cache of a stock price table (None
+    reads database.ini again on next use)'''
+    with _cache_lock:
+        if cache is None:
+            _caches.pop(stock_price_table, None)
+        else:
+            _caches[stock_price_table] = cache
+
+def frame_columns(rows) -> dict:
+    """Convert rows of the stock price table (as made by
+    Stock.format_price_data) to cache columns, sorted by utc_time
+
+    Returns:
+    ----------
+    dict : column: np.ndarray
+    """
+
+    rows = rows.sort_values('utc_time')
+    columns = {'utc_time': pd.DatetimeIndex(rows['utc_time']).as_unit('ns').asi8}
+    for column, dtype in cache_columns.items():
+        if column != 'utc_time':
+            columns[column] = rows[column].to_numpy(dtype=dtype, na_value=np.nan)
+    return columns
+
+def update_price_cache(ticker: str, interval: str, rows,
+                       stock_price_table: str = 'stock_price',
+                       exchange: str = default_exchange) -> None:
+    '''Add rows just written to a stock price table to its cache, if enabled'''
+    cache = get_price_cache(stock_price_table)
+    if cache is not None and len(rows.index):
+        cache.update(ticker, interval, frame_columns(rows), exchange)
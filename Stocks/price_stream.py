@@ -0,0 +1,170 @@
+import datetime
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+import pytz
+from dateutil import tz
+
+# Created libraries
+from connect import connection
+from schema import ensure_schema
+
+# Streams stored price data in fixed size chunks, for scans of more
+# history than fits in memory. A background thread fetches the next
+# chunks from a server-side cursor while the caller processes the
+# current one, holding at most prefetch chunks in memory.
+
+price_columns = ['open', 'high', 'low', 'close', 'adj_close', 'volume']
+
+_done = object()
+
+
+def to_utc(timestamp) -> datetime.datetime:
+    '''Convert a timestamp (naive timestamps are local time) to a UTC datetime'''
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tz is None:
+        timestamp = timestamp.tz_localize(tz.tzlocal())
+    return timestamp.tz_convert(pytz.UTC).to_pydatetime()
+
+def fetch_chunks(chunks: queue.Queue, stop: threading.Event, query: str,
+                 params: tuple, chunk_size: int, column_count: int) -> None:
+    '''Put every chunk of the query on chunks (then _done, or the error raised)'''
+
+    def put(item) -> bool:
+        # Wait for space, giving up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        with connection() as conn:
+            cursor = conn.cursor(name=f'price_stream_{threading.get_ident()}')
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+
+            while not stop.is_set():
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                # Every value is a number, so the rows convert in one call
+                values = np.array(rows, dtype=np.float64).reshape(-1, column_count)
+                del rows
+                if not put(values):
+                    break
+
+            cursor.close()
+        put(_done)
+    except Exception as error:
+        put(error)
+
+def iter_price_chunks(tickers: list, interval: str = '1m', start=None, end=None,
+                      columns: list = None, chunk_size: int = 100000,
+                      prefetch: int = 2, as_frame: bool = True,
+                      stock_table: str = 'stock', stock_price_table: str = 'stock_price'):
+    """Iterate over the stored price data of one or more tickers in chunks
+
+    Rows are read in (ticker, utc_time) order through a named server-side
+    cursor, so only the chunks in flight are held in memory however long
+    the history is. A chunk may hold the end of one ticker and the start
+    of the next.
+
+    Parameters:
+    ----------
+    tickers (list) : names of the stock tickers (or a single ticker)
+    interval (str) : interval between stock price data values
+    start (datetime.datetime) : start of the range, defaults to the first bar
+    end (datetime.datetime) : end (exclusive) of the range, defaults to after the last bar
+    columns (list) : price columns to read, defaults to every price column
+    chunk_size (int) : number of rows per chunk
+    prefetch (int) : number of chunks fetched ahead of the consumer
+    as_frame (bool) : yield DataFrames rather than dicts of arrays
+    stock_table (str) : name of the stock table
+    stock_price_table (str) : name of the stock price table
+
+    Yields:
+    ----------
+    pd.DataFrame : ticker and columns, indexed by UTC time, if as_frame
+    dict : 'ticker', 'utc_time' (UTC nanoseconds) and every column: np.ndarray, otherwise
+
+    Raises:
+    ----------
+    ValueError : a column is not a price column, or chunk_size or prefetch is not positive
+    """
+
+    if isinstance(tickers, str):
+        tickers = [tickers]
+    if columns is None:
+        columns = price_columns
+    for column in columns:
+        if column not in price_columns:
+            raise ValueError(f'{column} is not a price column (columns: {price_columns})')
+    if chunk_size < 1 or prefetch < 1:
+        raise ValueError(f'chunk_size and prefetch must be positive ' \
+                         f'(chunk_size: {chunk_size}, prefetch: {prefetch})')
+
+    ensure_schema({'stock': stock_table, 'stock_price': stock_price_table})
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, ticker FROM {stock_table} WHERE ticker = ANY(%s)", (list(tickers),))
+        stock_tickers = dict(cursor.fetchall())
+
+    if not stock_tickers:
+        return
+
+    # Numbers only: epoch microseconds (exact in a double) and NaN for NULL
+    selected = ['stock_id', '(extract(epoch FROM utc_time) * 1000000)::bigint'] + \
+               [f"COALESCE({column}::double precision, 'NaN')" for column in columns]
+    query = f"""
+            SELECT {', '.join(selected)}
+                FROM {stock_price_table}
+            WHERE stock_id = ANY(%s)
+                AND interval = %s
+                AND (%s::timestamptz IS NULL OR utc_time >= %s::timestamptz)
+                AND (%s::timestamptz IS NULL OR utc_time < %s::timestamptz)
+            ORDER BY stock_id, utc_time"""
+
+    start = None if start is None else to_utc(start)
+    end = None if end is None else to_utc(end)
+    params = (list(stock_tickers), interval, start, start, end, end)
+
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=fetch_chunks, name='price_stream', daemon=True,
+                               args=(chunks, stop, query, params, chunk_size, len(selected)))
+    fetcher.start()
+
+    ticker_array = np.array(list(stock_tickers.values()), dtype=object)
+    stock_ids = np.array(list(stock_tickers.keys()))
+    order = np.argsort(stock_ids)
+
+    try:
+        while True:
+            values = chunks.get()
+            if values is _done:
+                break
+            if isinstance(values, Exception):
+                raise values
+
+            positions = np.searchsorted(stock_ids[order], values[:, 0].astype(np.int64))
+            data = {'ticker': ticker_array[order][positions],
+                    'utc_time': values[:, 1].astype(np.int64) * 1000}
+            for position, column in enumerate(columns):
+                data[column] = values[:, position + 2]
+            del values
+
+            if as_frame:
+                index = pd.DatetimeIndex(data.pop('utc_time'), tz=pytz.UTC, name='utc_time')
+                yield pd.DataFrame(data, index=index, columns=['ticker'] + columns)
+            else:
+                yield data
+    finally:
+        # Stop the fetcher if the consumer stopped early
+        stop.set()
+        fetcher.join()
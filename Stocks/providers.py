@@ -0,0 +1,380 @@
+import abc
+import hashlib
+import os
+import pickle
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+# Created libraries
+from config import config
+from stock_market import default_exchange, get_market
+import time_tools
+
+# Sources of upstream data for Stock.
+#
+# A provider answers fetch(ticker, endpoint, **params) with what yfinance
+# would return: 'download' is yf.download of the ticker (with params) and
+# every other endpoint is an attribute of yf.Ticker ('info', 'financials',
+# 'actions', 'institutional_holders', 'mutualfund_holders').
+#
+# YFinanceProvider calls yfinance. SyntheticProvider generates the same
+# shapes deterministically at a configurable scale, for running the
+# pipeline offline (e.g. in benchmarks). RecordingProvider saves the
+# responses of another provider to files that ReplayProvider serves.
+#
+# Downloads of a range are planned from the current time (see
+# Stock.download_stock_price_data), so their start and end differ on every
+# run. Recordings of downloads are therefore keyed without them: the bars
+# recorded for a ticker and interval are merged, and a replayed range is
+# sliced from them.
+
+endpoints = ['download', 'info', 'financials', 'actions',
+             'institutional_holders', 'mutualfund_holders']
+
+
+class Provider(abc.ABC):
+    '''
+    Interface of a source of upstream data
+    '''
+
+    name = 'provider'
+
+    @abc.abstractmethod
+    def fetch(self, ticker: str, endpoint: str, **params):
+        """Get data for a ticker
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        endpoint (str) : one of endpoints
+        params : keyword arguments of yf.download (for 'download')
+
+        Returns:
+        ----------
+        data in the form returned by yfinance
+        """
+
+    def download_group(self, tickers: list, **params) -> pd.DataFrame:
+        """Download the price data of many tickers
+
+        Parameters:
+        ----------
+        tickers (list) : names of the stock tickers
+        params : keyword arguments of yf.download
+
+        Returns:
+        ----------
+        pd.DataFrame : frame with (ticker, field) columns, as returned by
+            yf.download with group_by='ticker'
+        """
+        frames = {ticker: self.fetch(ticker, 'download', **params) for ticker in tickers}
+        return pd.concat(frames, axis=1)
+
+
+class YFinanceProvider(Provider):
+    '''
+    Data from yfinance
+    '''
+
+    name = 'yfinance'
+
+    def __init__(self) -> None:
+        self._tickers = dict()
+        self._lock = threading.Lock()
+
+    def ticker(self, ticker: str) -> yf.Ticker:
+        '''yfinance ticker object, created on first use'''
+        with self._lock:
+            if ticker not in self._tickers:
+                self._tickers[ticker] = yf.Ticker(ticker)
+            return self._tickers[ticker]
+
+    def fetch(self, ticker: str, endpoint: str, **params):
+        if endpoint == 'download':
+            return yf.download(tickers=ticker, **params)
+        return getattr(self.ticker(ticker), endpoint)
+
+    def download_group(self, tickers: list, **params) -> pd.DataFrame:
+        # One call for the whole group
+        return yf.download(tickers=tickers, group_by='ticker', **params)
+
+
+def to_utc(timestamp) -> pd.Timestamp:
+    '''Convert a timestamp (naive timestamps are UTC) to UTC'''
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize('UTC') if timestamp.tz is None else timestamp.tz_convert('UTC')
+
+def unit_noise(keys: np.ndarray, seed: int) -> np.ndarray:
+    '''Deterministic uniform values in [0, 1), one per key (splitmix64 hash)'''
+    with np.errstate(over='ignore'):
+        values = np.asarray(keys).astype(np.uint64) ^ np.uint64(seed)
+        values = values + np.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        values = values ^ (values >> np.uint64(31))
+    return (values >> np.uint64(11)).astype(np.float64) / float(2**53)
+
+
+class SyntheticProvider(Provider):
+    '''
+    Deterministic generated data in the shapes returned by yfinance
+    '''
+
+    name = 'synthetic'
+
+    def __init__(self, seed: int = 0, info_fields: int = 40, financial_items: int = 20,
+                 reports: int = 4, action_count: int = 8, holder_count: int = 10,
+                 exchange: str = default_exchange, end=None) -> None:
+        """Initialise instance of SyntheticProvider class
+
+        The same seed, ticker and request always give the same data, and
+        a bar has the same values whichever request it is downloaded by.
+
+        Parameters:
+        ----------
+        seed (int) : seed of the generated values
+        info_fields (int) : number of numeric fields of info (besides symbol)
+        financial_items (int) : number of line items of financials
+        reports (int) : number of financial reports (columns of financials)
+        action_count (int) : number of dividends and splits
+        holder_count (int) : number of institutional (and of mutual fund) holders
+        exchange (str) : exchange (section of exchanges.ini) whose sessions
+            the bars fall in
+        end : clock of the generated data: the end of downloads given no
+            end, and the time report, action and holding dates count back
+            from. Defaults to now, so a fixed end gives the same data on
+            every run
+        """
+
+        self.seed = seed
+        self.info_fields = info_fields
+        self.financial_items = financial_items
+        self.reports = reports
+        self.action_count = action_count
+        self.holder_count = holder_count
+        self.exchange = exchange
+        self.end = end
+
+    def now(self, end=None) -> pd.Timestamp:
+        '''UTC end of the generated data: end, else the provider's end, else now'''
+        end = self.end if end is None else end
+        return pd.Timestamp.now(tz='UTC') if end is None else to_utc(end)
+
+    def ticker_seed(self, ticker: str, endpoint: str) -> int:
+        return zlib.crc32(f'{self.seed}:{ticker}:{endpoint}'.encode())
+
+    def rng(self, ticker: str, endpoint: str) -> np.random.Generator:
+        return np.random.default_rng(self.ticker_seed(ticker, endpoint))
+
+    def download_timestamps(self, period: str = None, interval: str = '1m',
+                            start=None, end=None) -> pd.DatetimeIndex:
+        '''Completed bars of the exchange's sessions in a period, or in [start, end)'''
+        market = get_market(self.exchange)
+        if start is None:
+            return market.bar_timestamps(period or '1mo', interval, end=self.now(end))
+
+        return market.bars_between(start, self.now(end), interval)
+
+    def download(self, ticker: str, period: str = None, interval: str = '1m',
+                 start=None, end=None, **params) -> pd.DataFrame:
+        timestamps = self.download_timestamps(period, interval, start, end).sort_values().unique()
+        times = timestamps.as_unit('ns').asi8
+        seed = self.ticker_seed(ticker, 'download')
+
+        # Smooth monthly cycle around a per ticker base price, with per bar noise
+        base = 10 + 490 * unit_noise(np.array([seed]), self.seed)[0]
+        days = times / time_tools.day_ns
+        close = base * np.exp(0.1 * np.sin(2 * np.pi * days / 30)
+                              + 0.02 * (unit_noise(times, seed) - 0.5))
+        open_ = close * (1 + 0.002 * (unit_noise(times, seed + 1) - 0.5))
+        high = np.maximum(open_, close) * (1 + 0.001 * unit_noise(times, seed + 2))
+        low = np.minimum(open_, close) * (1 - 0.001 * unit_noise(times, seed + 3))
+        volume = (1e4 + 1e6 * unit_noise(times, seed + 4)).astype(np.int64)
+
+        return pd.DataFrame({'Open': open_, 'High': high, 'Low': low, 'Close': close,
+                             'Adj Close': close, 'Volume': volume},
+                            index=pd.DatetimeIndex(timestamps, name='Datetime'))
+
+    def info(self, ticker: str) -> dict:
+        rng = self.rng(ticker, 'info')
+        info = {'symbol': ticker,
+                'shortName': f'{ticker} Synthetic Inc.',
+                'currency': 'USD'}
+        for field, value in enumerate(rng.random(self.info_fields) * 1e6):
+            info[f'field{field}'] = float(value)
+        return info
+
+    def financials(self, ticker: str, end=None) -> pd.DataFrame:
+        # Line items (rows) by report date (columns), latest first
+        rng = self.rng(ticker, 'financials')
+        today = self.now(end).tz_localize(None).normalize()
+        dates = pd.DatetimeIndex([today - pd.DateOffset(years=year + 1) for year in range(self.reports)])
+        items = [f'Item {item}' for item in range(self.financial_items)]
+        return pd.DataFrame(rng.normal(1e8, 5e7, (self.financial_items, self.reports)),
+                            index=items, columns=dates)
+
+    def actions(self, ticker: str, end=None) -> pd.DataFrame:
+        rng = self.rng(ticker, 'actions')
+        today = self.now(end).tz_localize(None).normalize()
+        dates = pd.DatetimeIndex([today - pd.DateOffset(months=3 * (action + 1))
+                                  for action in range(self.action_count)][::-1], name='Date')
+        splits = np.where(rng.random(self.action_count) < 0.1, 2.0, 0.0)
+        return pd.DataFrame({'Dividends': np.round(rng.random(self.action_count), 2),
+                             'Stock Splits': splits}, index=dates)
+
+    def holder_frame(self, ticker: str, endpoint: str, end=None) -> pd.DataFrame:
+        rng = self.rng(ticker, endpoint)
+        shares = rng.integers(10**5, 10**8, self.holder_count)
+        today = self.now(end).tz_localize(None).normalize()
+        reported = today - pd.to_timedelta(rng.integers(0, 90, self.holder_count), unit='D')
+        return pd.DataFrame({'Holder': [f'{endpoint} holder {holder}' for holder in range(self.holder_count)],
+                             'Shares': shares,
+                             'Date Reported': reported,
+                             '% Out': np.round(rng.random(self.holder_count) / 10, 4),
+                             'Value': shares * 100})
+
+    def fetch(self, ticker: str, endpoint: str, **params):
+        if endpoint == 'download':
+            return self.download(ticker, **params)
+        if endpoint == 'info':
+            return self.info(ticker)
+        if endpoint == 'financials':
+            return self.financials(ticker, **params)
+        if endpoint == 'actions':
+            return self.actions(ticker, **params)
+        if endpoint in ['institutional_holders', 'mutualfund_holders']:
+            return self.holder_frame(ticker, endpoint, **params)
+        raise ValueError(f'{endpoint} is not an endpoint (endpoints: {endpoints})')
+
+
+# Parameters of a download that depend on when it was planned
+range_params = ['start', 'end']
+
+def recording_path(directory: str, ticker: str, endpoint: str, params: dict) -> str:
+    '''File of a recorded response (downloads of a range share one file)'''
+    key = repr(sorted((name, str(value)) for name, value in params.items()
+                      if name not in range_params))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(directory, ticker, f'{endpoint}-{digest}.pkl.gz')
+
+def read_recording(path: str):
+    with open(path, 'rb') as file:
+        return pickle.loads(zlib.decompress(file.read()))
+
+def slice_range(data: pd.DataFrame, start=None, end=None) -> pd.DataFrame:
+    '''Rows of a download in [start, end)'''
+    index = pd.DatetimeIndex(data.index)
+    index = index.tz_localize('UTC') if index.tz is None else index.tz_convert('UTC')
+    selected = np.ones(len(index), dtype=bool)
+    if start is not None:
+        selected &= index >= to_utc(start)
+    if end is not None:
+        selected &= index < to_utc(end)
+    return data[selected]
+
+
+class RecordingProvider(Provider):
+    '''
+    Saves every response of another provider for ReplayProvider
+    '''
+
+    name = 'record'
+
+    def __init__(self, provider: Provider, directory: str = 'recordings') -> None:
+        self.provider = provider
+        self.directory = directory
+
+    def fetch(self, ticker: str, endpoint: str, **params):
+        response = self.provider.fetch(ticker, endpoint, **params)
+
+        path = recording_path(self.directory, ticker, endpoint, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        recorded = response
+        if endpoint == 'download' and os.path.exists(path) and \
+                any(params.get(name) is not None for name in range_params):
+            # Add the bars of the range to those recorded before
+            recorded = pd.concat([read_recording(path), response])
+            recorded = recorded[~recorded.index.duplicated(keep='last')].sort_index()
+
+        with open(path + '.tmp', 'wb') as file:
+            file.write(zlib.compress(pickle.dumps(recorded, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(path + '.tmp', path)
+
+        return response
+
+
+class ReplayProvider(Provider):
+    '''
+    Serves the responses saved by RecordingProvider, never calling upstream
+    '''
+
+    name = 'replay'
+
+    def __init__(self, directory: str = 'recordings') -> None:
+        self.directory = directory
+
+    def fetch(self, ticker: str, endpoint: str, **params):
+        """Get a recorded response
+
+        A download of a range is served the recorded bars in the range.
+
+        Raises:
+        ----------
+        KeyError : the request was not recorded
+        """
+
+        path = recording_path(self.directory, ticker, endpoint, params)
+        try:
+            response = read_recording(path)
+        except FileNotFoundError:
+            raise KeyError(f'No recording of {endpoint} for {ticker} with {params} in {self.directory}')
+
+        if endpoint == 'download':
+            return slice_range(response, params.get('start'), params.get('end'))
+        return response
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_provider() -> Provider:
+    """Return the process-wide provider, creating it on first use
+
+    Read from the optional provider section of database.ini: name is
+    yfinance (default), synthetic (generated from seed, up to end if set),
+    record (yfinance responses recorded to directory) or replay (responses
+    served from directory).
+    """
+    global _provider
+
+    with _provider_lock:
+        if _provider is None:
+            try:
+                params = config(section='provider')
+            except Exception:
+                params = dict()
+
+            name = params.get('name', 'yfinance')
+            directory = params.get('directory', 'recordings')
+            if name == 'synthetic':
+                _provider = SyntheticProvider(seed=int(params.get('seed', 0)),
+                                              end=params.get('end') or None)
+            elif name == 'record':
+                _provider = RecordingProvider(YFinanceProvider(), directory)
+            elif name == 'replay':
+                _provider = ReplayProvider(directory)
+            else:
+                _provider = YFinanceProvider()
+        return _provider
+
+def set_provider(provider: Provider) -> None:
+    '''Replace the process-wide provider (None reads database.ini again on next use)'''
+    global _provider
+
+    with _provider_lock:
+        _provider = provider
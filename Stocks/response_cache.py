@@ -0,0 +1,294 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+# Created libraries
+from config import config
+
+# Persistent cache of yfinance responses, kept in the local SQLite
+# database (request.db) so that repeated runs do not call upstream again.
+#
+# Responses are keyed by (ticker, endpoint, params), pickled and zlib
+# compressed. Each endpoint has its own TTL (0 never caches it). A running
+# total of the stored payload sizes is kept, and only once it exceeds
+# max_bytes are the expired, then the least recently used, responses evicted.
+
+# Endpoint: seconds a response is reused. Downloads of a relative period
+# change every bar, so they are only reused briefly.
+default_ttls = {'info': 86400,
+                'financials': 86400,
+                'actions': 86400,
+                'institutional_holders': 86400,
+                'mutualfund_holders': 86400,
+                'download': 60}
+
+cache_table = 'response_cache'
+
+
+class ResponseCache:
+    '''
+    Size bounded SQLite cache of upstream responses with per endpoint TTLs
+    '''
+
+    def __init__(self, path: str = 'request.db', max_bytes: int = 256 * 2**20,
+                 ttls: dict = None, level: int = 6) -> None:
+        """Initialise instance of ResponseCache class
+
+        Parameters:
+        ----------
+        path (str) : path of the SQLite database
+        max_bytes (int) : size of the stored payloads above which responses are evicted
+        ttls (dict) : endpoint: seconds a response is reused, defaults to default_ttls
+        level (int) : zlib compression level
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(default_ttls, **(ttls or {}))
+        self.level = level
+
+        self._lock = threading.RLock()
+        self._conn = None
+        # Size of the stored payloads, read on first store
+        self._bytes = None
+        self._stats = {'hits': 0,
+                       'misses': 0,
+                       'expired': 0,
+                       'corrupt': 0,
+                       'stores': 0,
+                       'evictions': 0}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        '''Connection to the database, creating the cache table on first use'''
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {cache_table}
+                (
+                    ticker VARCHAR(255) NOT NULL,
+                    endpoint VARCHAR(255) NOT NULL,
+                    params TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (ticker, endpoint, params)
+                )""")
+            conn.execute(f"""CREATE INDEX IF NOT EXISTS {cache_table}_accessed_at_idx
+                             ON {cache_table} (accessed_at)""")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def params_key(params: dict) -> str:
+        '''Canonical text of request parameters'''
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def ttl(self, endpoint: str) -> float:
+        return float(self.ttls.get(endpoint, 0))
+
+    def get(self, ticker: str, endpoint: str, params: dict = None):
+        """Get a cached response, if stored within the endpoint's TTL
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        endpoint (str) : endpoint of the request (see Stock.fetch)
+        params (dict) : parameters of the request
+
+        Returns:
+        ----------
+        tuple : (True, response) on a hit, (False, None) on a miss (an
+            unreadable response is deleted and counts as a miss)
+        """
+
+        ttl = self.ttl(endpoint)
+        if ttl <= 0:
+            return False, None
+
+        key = (ticker, endpoint, self.params_key(params or {}))
+        now = time.time()
+
+        with self._lock:
+            row = self.conn.execute(f"""SELECT payload, fetched_at FROM {cache_table}
+                                        WHERE ticker = ? AND endpoint = ? AND params = ?""",
+                                    key).fetchone()
+            if row is None or row[1] + ttl <= now:
+                self._stats['misses'] += 1
+                if row is not None:
+                    self._stats['expired'] += 1
+                return False, None
+
+            try:
+                response = pickle.loads(zlib.decompress(row[0]))
+            except (zlib.error, pickle.UnpicklingError, EOFError, ValueError,
+                    AttributeError, ImportError):
+                # Truncated or corrupt payload, or one pickled by code that
+                # has since changed: drop it and fetch again
+                self.conn.execute(f"""DELETE FROM {cache_table}
+                                      WHERE ticker = ? AND endpoint = ? AND params = ?""", key)
+                if self._bytes is not None:
+                    self._bytes -= len(row[0])
+                self._stats['corrupt'] += 1
+                self._stats['misses'] += 1
+                return False, None
+
+            self.conn.execute(f"""UPDATE {cache_table} SET accessed_at = ?
+                                  WHERE ticker = ? AND endpoint = ? AND params = ?""",
+                              (now,) + key)
+            self._stats['hits'] += 1
+
+        return True, response
+
+    def put(self, ticker: str, endpoint: str, params: dict, response) -> None:
+        """Store a response, evicting responses if the stored payloads
+        are then over max_bytes
+
+        Parameters:
+        ----------
+        ticker (str) : name of the stock ticker
+        endpoint (str) : endpoint of the request
+        params (dict) : parameters of the request
+        response : data returned by upstream (any picklable object)
+        """
+
+        if self.ttl(endpoint) <= 0:
+            return
+
+        payload = zlib.compress(pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL), self.level)
+        now = time.time()
+
+        key = (ticker, endpoint, self.params_key(params or {}))
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self.size()
+            replaced = self.conn.execute(f"""SELECT size FROM {cache_table}
+                                             WHERE ticker = ? AND endpoint = ? AND params = ?""",
+                                         key).fetchone()
+
+            self.conn.execute(f"""INSERT OR REPLACE INTO {cache_table}
+                                  (ticker, endpoint, params, payload, size, fetched_at, accessed_at)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                              key + (payload, len(payload), now, now))
+            self._stats['stores'] += 1
+            self._bytes += len(payload) - (replaced[0] if replaced else 0)
+
+            if self._bytes > self.max_bytes:
+                self.evict()
+
+    def fetch(self, ticker: str, endpoint: str, params: dict, load):
+        '''Get a cached response, calling load() and storing its result on a miss'''
+        hit, response = self.get(ticker, endpoint, params)
+        if not hit:
+            response = load()
+            self.put(ticker, endpoint, params, response)
+        return response
+
+    def size(self) -> int:
+        '''Total size of the stored payloads in bytes'''
+        return self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {cache_table}").fetchone()[0]
+
+    def evict(self) -> int:
+        """Remove expired responses, then the least recently used until
+        the stored payloads are under max_bytes
+
+        Returns:
+        ----------
+        int : number of responses removed
+        """
+
+        with self._lock:
+            removed = self.remove_stale(time.time())
+            self._stats['evictions'] += removed
+            # Also picks up responses stored by other processes
+            self._bytes = self.size()
+        return removed
+
+    def remove_stale(self, now: float) -> int:
+        '''Delete expired and least recently used responses in one transaction'''
+        conn = self.conn
+        removed = 0
+
+        conn.execute('BEGIN')
+        try:
+            for endpoint in conn.execute(f"SELECT DISTINCT endpoint FROM {cache_table}").fetchall():
+                removed += conn.execute(f"DELETE FROM {cache_table} WHERE endpoint = ? AND fetched_at <= ?",
+                                        (endpoint[0], now - self.ttl(endpoint[0]))).rowcount
+
+            total = self.size()
+            if total > self.max_bytes:
+                rows = conn.execute(f"""SELECT rowid, size FROM {cache_table}
+                                        ORDER BY accessed_at""").fetchall()
+                stale = []
+                for rowid, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((rowid,))
+                    total -= size
+                conn.executemany(f"DELETE FROM {cache_table} WHERE rowid = ?", stale)
+                removed += len(stale)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        return removed
+
+    def clear(self, ticker: str = None) -> None:
+        '''Remove every cached response (of one ticker, if given)'''
+        with self._lock:
+            self._bytes = None
+            if ticker is None:
+                self.conn.execute(f"DELETE FROM {cache_table}")
+            else:
+                self.conn.execute(f"DELETE FROM {cache_table} WHERE ticker = ?", (ticker,))
+
+    def statistics(self) -> dict:
+        '''Return the cache counters, stored responses and size'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['responses'] = self.conn.execute(f"SELECT COUNT(*) FROM {cache_table}").fetchone()[0]
+            stats['bytes'] = self.size()
+        return stats
+
+
+_cache = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    '''Return the process-wide response cache, or None if the
+    response_cache section of database.ini is missing or disabled
+    (database.ini is read on first use only)
+    '''
+    global _cache, _cache_loaded
+
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache_loaded = True
+            try:
+                params = config(section='response_cache')
+            except Exception:
+                return None
+            if params.get('enabled', 'true').lower() not in ['yes', 'true']:
+                return None
+
+            ttls = {endpoint: float(params[f'ttl_{endpoint}'])
+                    for endpoint in default_ttls if f'ttl_{endpoint}' in params}
+            _cache = ResponseCache(path=params.get('path', 'request.db'),
+                                   max_bytes=int(params.get('max_bytes', 256 * 2**20)),
+                                   ttls=ttls)
+        return _cache
+
+def set_response_cache(cache: ResponseCache) -> None:
+    '''Replace the process-wide response cache (None reads database.ini again on next use)'''
+    global _cache, _cache_loaded
+
+    with _cache_lock:
+        _cache = cache
+        _cache_loaded = cache is not None
@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+
+# Created libraries
+from connect import connection
+from db_tools import copy_to_arrays, upsert_dataframe
+from stock_market import default_exchange, get_market
+import time_tools
+
+# Derives coarser bars from stored finer bars, so that coarser intervals
+# need not be downloaded (or stored) separately. Rolled up bars are kept
+# in the <stock_price>_rollup table. After an insert, only the buckets
+# containing the new bars are recomputed. By default buckets are aligned
+# to the open of the exchange's sessions (e.g. 13:30 UTC for the NYSE in
+# summer), so hourly buckets start on the hour of trading and a daily
+# bucket holds exactly one session.
+
+# Source interval: intervals rolled up from it
+rollup_intervals = {'1m': ['5m', '15m', '1h', '1d']}
+
+# Column: how the bars of a bucket are combined
+rollup_aggregations = {'open': 'first',
+                       'high': 'max',
+                       'low': 'min',
+                       'close': 'last',
+                       'adj_close': 'last',
+                       'volume': 'sum'}
+
+rollup_key = ['stock_id', 'interval', 'utc_time']
+
+
+def bucket_offsets(times: np.ndarray, offset: int = None,
+                   exchange: str = default_exchange) -> np.ndarray:
+    '''Nanoseconds the buckets of every timestamp are shifted by from the
+    epoch: offset if given, else the open of the timestamp's session'''
+    if offset is not None:
+        return offset
+    return get_market(exchange).session_opens(times)
+
+def bucket_starts(times: np.ndarray, interval: str, offset: int = None,
+                  exchange: str = default_exchange) -> np.ndarray:
+    """Compute the start of the bucket of every timestamp
+
+    Buckets are interval long and aligned to the UTC epoch plus offset,
+    by default the open of each timestamp's session, so daily buckets are
+    sessions.
+
+    Parameters:
+    ----------
+    times (np.ndarray) : UTC nanoseconds (int64)
+    interval (str) : interval of the buckets (key of time_tools.interval_dict)
+    offset (int) : nanoseconds the buckets are shifted by from the epoch,
+        defaults to the session opens of the exchange
+    exchange (str) : exchange (section of exchanges.ini) whose sessions
+        the buckets are aligned to
+
+    Returns:
+    ----------
+    np.ndarray : UTC nanoseconds of the start of every timestamp's bucket
+    """
+
+    times = np.asarray(times, dtype=np.int64)
+    offset = bucket_offsets(times, offset, exchange)
+    step = time_tools.interval_dict[interval] * time_tools.second_ns
+    return (times - offset) // step * step + offset
+
+def rollup_arrays(data: dict, interval: str, offset: int = None,
+                  exchange: str = default_exchange) -> dict:
+    """Combine bars into buckets of an interval
+
+    Each aggregation is one reduceat over the bucket boundaries. Missing
+    highs and lows are ignored and missing volumes count as zero.
+
+    Parameters:
+    ----------
+    data (dict) : 'utc_time' (UTC nanoseconds) and every column of
+        rollup_aggregations: np.ndarray, sorted by utc_time
+    interval (str) : interval of the buckets
+    offset (int) : nanoseconds the buckets are shifted by from the epoch,
+        defaults to the session opens of the exchange
+    exchange (str) : exchange whose sessions the buckets are aligned to
+
+    Returns:
+    ----------
+    dict : 'utc_time' (bucket starts), the rollup_aggregations columns
+        and 'bar_count': np.ndarray
+    """
+
+    times = np.asarray(data['utc_time'], dtype=np.int64)
+    if not len(times):
+        empty = {column: np.empty(0) for column in rollup_aggregations}
+        return dict(utc_time=np.empty(0, dtype=np.int64), bar_count=np.empty(0, dtype=np.int64), **empty)
+
+    buckets = bucket_starts(times, interval, offset, exchange)
+    firsts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    lasts = np.concatenate([firsts[1:], [len(times)]]) - 1
+
+    rolled = {'utc_time': buckets[firsts]}
+    for column, aggregation in rollup_aggregations.items():
+        values = np.asarray(data[column], dtype=np.float64)
+        if aggregation == 'first':
+            rolled[column] = values[firsts]
+        elif aggregation == 'last':
+            rolled[column] = values[lasts]
+        elif aggregation == 'max':
+            rolled[column] = np.fmax.reduceat(values, firsts)
+        elif aggregation == 'min':
+            rolled[column] = np.fmin.reduceat(values, firsts)
+        elif aggregation == 'sum':
+            rolled[column] = np.add.reduceat(np.nan_to_num(values), firsts)
+    rolled['bar_count'] = lasts - firsts + 1
+
+    return rolled
+
+def load_bars(cursor, table: str, stock_id: int, interval: str, start: int, end: int) -> dict:
+    '''Load the bars of a stock stored for [start, end) (UTC nanoseconds)'''
+    columns = list(rollup_aggregations)
+    selected = ['utc_time'] + [f"COALESCE({column}::double precision, 'NaN')" for column in columns]
+
+    query = cursor.mogrify(f"""
+            SELECT {', '.join(selected)}
+                FROM {table}
+            WHERE stock_id = %s
+                AND interval = %s
+                AND utc_time >= %s
+                AND utc_time < %s
+            ORDER BY utc_time""",
+                           (stock_id, interval,
+                            pd.Timestamp(start, tz='UTC').to_pydatetime(),
+                            pd.Timestamp(end, tz='UTC').to_pydatetime())).decode()
+
+    arrays = copy_to_arrays(cursor, query, ['timestamp with time zone'] +
+                            ['double precision'] * len(columns))
+    return dict(zip(['utc_time'] + columns, arrays))
+
+def update_rollups(stock_id: int, source_interval: str, start: int, end: int,
+                   stock_price_table: str = 'stock_price', intervals: list = None,
+                   offset: int = None, exchange: str = default_exchange, cursor=None) -> dict:
+    """Recompute the rolled up buckets touched by bars stored in [start, end]
+
+    For every interval rolled up from source_interval, only the source bars
+    of the buckets containing start to end are loaded, and those buckets
+    are upserted into the rollup table.
+
+    Parameters:
+    ----------
+    stock_id (int) : id of the stock
+    source_interval (str) : interval of the stored bars
+    start (int) : first new bar, as UTC nanoseconds
+    end (int) : last new bar, as UTC nanoseconds
+    stock_price_table (str) : name of the stock price table
+    intervals (list) : intervals to update, defaults to rollup_intervals[source_interval]
+    offset (int) : nanoseconds the buckets are shifted by from the epoch,
+        defaults to the session opens of the exchange
+    exchange (str) : exchange whose sessions the buckets are aligned to
+    cursor : psycopg2 cursor to use (e.g. inside the inserting transaction),
+        defaults to a new pooled connection
+
+    Returns:
+    ----------
+    dict : interval: number of buckets updated
+    """
+
+    if intervals is None:
+        intervals = rollup_intervals.get(source_interval, [])
+    if not intervals:
+        return dict()
+
+    if cursor is None:
+        with connection() as conn:
+            return update_rollups(stock_id, source_interval, start, end,
+                                  stock_price_table=stock_price_table, intervals=intervals,
+                                  offset=offset, exchange=exchange, cursor=conn.cursor())
+
+    rollup_table = f'{stock_price_table}_rollup'
+
+    # Load the source bars of the widest touched range once
+    step = {interval: time_tools.interval_dict[interval] * time_tools.second_ns
+            for interval in intervals}
+    ranges = {interval: (int(bucket_starts(np.array([start]), interval, offset, exchange)[0]),
+                         int(bucket_starts(np.array([end]), interval, offset, exchange)[0]) + step[interval])
+              for interval in intervals}
+    first = min(bounds[0] for bounds in ranges.values())
+    last = max(bounds[1] for bounds in ranges.values())
+    bars = load_bars(cursor, stock_price_table, stock_id, source_interval, first, last)
+
+    updated = dict()
+    for interval in intervals:
+        bucket_start, bucket_end = ranges[interval]
+        first_bar, last_bar = np.searchsorted(bars['utc_time'], [bucket_start, bucket_end])
+        rolled = rollup_arrays({column: values[first_bar:last_bar] for column, values in bars.items()},
+                               interval, offset, exchange)
+
+        # A session opening less than an interval after the last touched
+        # bucket (e.g. a day shortened by daylight saving) is not touched,
+        # and only some of its bars were loaded
+        touched = rolled['utc_time'] <= bucket_end - step[interval]
+        rolled = {column: values[touched] for column, values in rolled.items()}
+
+        rows = pd.DataFrame({'stock_id': stock_id,
+                             'interval': interval,
+                             'utc_time': pd.DatetimeIndex(rolled.pop('utc_time'), tz='UTC'),
+                             **rolled})
+        rows['volume'] = rows['volume'].round().astype('Int64')
+
+        updated[interval] = upsert_dataframe(cursor, rows, rollup_table, rollup_key) if len(rows.index) else 0
+
+    return updated
+
+def rebuild_rollups(stock_id: int, source_interval: str = '1m',
+                    stock_price_table: str = 'stock_price', intervals: list = None,
+                    offset: int = None, exchange: str = default_exchange) -> dict:
+    '''Recompute every rolled up bucket of a stock from all its stored bars'''
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""SELECT min(utc_time), max(utc_time) FROM {stock_price_table}
+                           WHERE stock_id = %s AND interval = %s""", (stock_id, source_interval))
+        first, last = cursor.fetchone()
+        if first is None:
+            return dict()
+
+        return update_rollups(stock_id, source_interval,
+                              pd.Timestamp(first).as_unit('ns').value,
+                              pd.Timestamp(last).as_unit('ns').value,
+                              stock_price_table=stock_price_table, intervals=intervals,
+                              offset=offset, exchange=exchange, cursor=cursor)
@@ -0,0 +1,287 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+# Created libraries
+from connect import get_pool
+import metrics
+
+# Runs the download jobs of many stocks concurrently: yfinance calls
+# share a token bucket rate limit, database writes share a bounded
+# number of slots and failed jobs are retried with backoff
+
+# Download jobs, as the name of the Stock.download_* method
+stock_jobs = ['stock_info', 'stock_financials', 'stock_actions',
+              'stock_holders', 'stock_price_data']
+
+# Connections a job may check out while holding its write connection
+# (e.g. the catalog reloading the columns of a table being written)
+nested_checkouts = 1
+
+
+def write_slot_limit(maxconn: int, db_concurrency: int) -> int:
+    '''Number of write slots that cannot exhaust a pool of maxconn
+    connections, even if every write makes its nested checkouts at once'''
+    return max(1, min(db_concurrency, maxconn // (1 + nested_checkouts)))
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket rate limiter
+    '''
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        """Initialise instance of TokenBucket class
+
+        Parameters:
+        ----------
+        rate (float) : tokens added per second
+        capacity (int) : maximum number of tokens (burst size)
+
+        Raises:
+        ----------
+        ValueError : rate or capacity is not positive
+        """
+
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f'Invalid token bucket (rate: {rate}, capacity: {capacity})')
+
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self, tokens: int = 1) -> None:
+        '''Take tokens from the bucket, waiting until they are available'''
+        waited = False
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                delay = (tokens - self._tokens) / self.rate
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self.wait_time += delay
+
+            time.sleep(delay)
+
+
+class IngestionScheduler:
+    '''
+    Runs download jobs on a thread pool with a global rate limit,
+    retries with exponential backoff and bounded database writes
+    '''
+
+    def __init__(self, max_workers: int = 8, rate: float = 2.0, burst: int = 5,
+                 max_retries: int = 3, backoff: float = 1.0, max_backoff: float = 30.0,
+                 db_concurrency: int = 2) -> None:
+        """Initialise instance of IngestionScheduler class
+
+        Parameters:
+        ----------
+        max_workers (int) : number of jobs run at once
+        rate (float) : upstream (yfinance) calls allowed per second
+        burst (int) : upstream calls allowed at once after being idle
+        max_retries (int) : times a failed job is retried
+        backoff (float) : seconds before the first retry, doubled after each retry
+        max_backoff (float) : maximum seconds between retries
+        db_concurrency (int) : number of database writes run at once, at
+            most the pool's maxconn // (1 + nested_checkouts) (see write_slot_limit)
+        """
+
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.db_concurrency = db_concurrency
+
+        self.rate_limiter = TokenBucket(rate, burst)
+        # Created on the first schedule, when the pool size is known
+        self.write_slots = None
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='ingest')
+        self._futures = []
+        self._lock = threading.Lock()
+        self._started = None
+
+        self._stats = {'submitted': 0,
+                       'started': 0,
+                       'completed': 0,
+                       'failed': 0,
+                       'retries': 0,
+                       'max_queue_depth': 0}
+
+    def _run(self, name: str, func, args: tuple, kwargs: dict, counted: bool = True):
+        if counted:
+            with self._lock:
+                self._stats['started'] += 1
+
+        attempt = 0
+        while True:
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.max_retries:
+                    if counted:
+                        with self._lock:
+                            self._stats['failed'] += 1
+                    metrics.event('job_failed', logging.ERROR, job=name,
+                                  attempts=attempt + 1, error=str(error))
+                    raise
+
+                # Exponential backoff with jitter
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay = delay * random.uniform(0.5, 1.0)
+                attempt += 1
+                with self._lock:
+                    self._stats['retries'] += 1
+                metrics.count('job_retries')
+                metrics.event('job_retry', logging.WARNING, job=name, attempt=attempt,
+                              delay=delay, error=str(error))
+                time.sleep(delay)
+            else:
+                if counted:
+                    with self._lock:
+                        self._stats['completed'] += 1
+                return result
+
+    def submit(self, name: str, func, *args, **kwargs):
+        """Submit a job to be run with retries
+
+        Parameters:
+        ----------
+        name (str) : name of the job, used in messages
+        func (callable) : job to run
+        args, kwargs : arguments of func
+
+        Returns:
+        ----------
+        concurrent.futures.Future : future of the job's result
+        """
+
+        return self._submit(name, func, args, kwargs)
+
+    def _submit(self, name: str, func, args: tuple, kwargs: dict, counted: bool = True):
+        '''Submit a job, leaving it out of the statistics unless counted
+        (e.g. the internal jobs submitting the jobs of a stock)'''
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            if counted:
+                self._stats['submitted'] += 1
+                queue_depth = self._stats['submitted'] - self._stats['started']
+                self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], queue_depth)
+
+        future = self._executor.submit(self._run, name, func, args, kwargs, counted)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _schedule_stock(self, stock, jobs: list, price_params: dict) -> None:
+        # Resolve the stock id once, before the jobs share the stock
+        stock.stock_id
+
+        for job in jobs:
+            method = getattr(stock, f'download_{job}')
+            params = price_params if job == 'stock_price_data' else {}
+            self.submit(f'{stock.ticker} {job}', method, **params)
+
+    def schedule(self, stocks: list, jobs: list = None, **price_params) -> None:
+        """Schedule the download jobs of many stocks
+
+        Every stock is given the scheduler's rate limiter and write slots,
+        so its yfinance calls and database writes are limited globally.
+        Only the download jobs are counted in the statistics, not the
+        internal job submitting them for each stock.
+
+        Parameters:
+        ----------
+        stocks (list) : Stock instances
+        jobs (list) : jobs to run for every stock (names in stock_jobs)
+        price_params : keyword arguments of download_stock_price_data
+        """
+
+        jobs = stock_jobs if jobs is None else jobs
+        for job in jobs:
+            if job not in stock_jobs:
+                raise ValueError(f'{job} is not a job (jobs: {stock_jobs})')
+
+        if self.write_slots is None:
+            self.db_concurrency = write_slot_limit(get_pool().maxconn, self.db_concurrency)
+            self.write_slots = threading.BoundedSemaphore(self.db_concurrency)
+
+        for stock in stocks:
+            stock.rate_limiter = self.rate_limiter
+            stock.write_slots = self.write_slots
+            self._submit(f'{stock.ticker} schedule', self._schedule_stock,
+                         (stock, jobs, price_params), {}, counted=False)
+
+    def wait(self) -> dict:
+        """Wait for every submitted job (including those submitted by
+        running jobs) to finish
+
+        Returns:
+        ----------
+        dict : statistics of the scheduler
+        """
+
+        while True:
+            with self._lock:
+                pending = [future for future in self._futures if not future.done()]
+            if not pending:
+                break
+            wait_futures(pending)
+
+        return self.statistics()
+
+    def run(self, stocks: list, jobs: list = None, **price_params) -> dict:
+        '''Schedule the jobs of many stocks and wait for them to finish'''
+        self.schedule(stocks, jobs, **price_params)
+        statistics = self.wait()
+        metrics.event('jobs_ran', completed=statistics['completed'], failed=statistics['failed'],
+                      retries=statistics['retries'], throughput=statistics['throughput'])
+        return statistics
+
+    def statistics(self) -> dict:
+        '''Return a snapshot of the scheduler counters, throughput and queue depth'''
+        with self._lock:
+            stats = dict(self._stats)
+            started = self._started
+
+        elapsed = time.monotonic() - started if started is not None else 0.0
+        finished = stats['completed'] + stats['failed']
+
+        stats['queue_depth'] = stats['submitted'] - stats['started']
+        stats['running'] = stats['started'] - finished
+        stats['elapsed'] = elapsed
+        stats['throughput'] = stats['completed'] / elapsed if elapsed else 0.0
+        stats['rate_limit_waits'] = self.rate_limiter.waits
+        stats['rate_limit_wait_time'] = self.rate_limiter.wait_time
+        return stats
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
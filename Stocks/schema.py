@@ -0,0 +1,423 @@
+import threading
+
+from catalog import get_catalog
+from connect import connection
+import metrics
+from partitions import get_partition_manager
+
+# Creates and migrates the database tables once per process.
+#
+# Each set of table names has a row in the schema_version table holding
+# the number of migrations applied to it. The first check in a process
+# is one SELECT; once the schema is current it is remembered and later
+# checks do no I/O. If partitioning is enabled, the first check also
+# partitions the price table and creates its upcoming partitions.
+
+# Table role: default table name
+default_tables = {'stock': 'stock',
+                  'request': 'request',
+                  'stock_price': 'stock_price',
+                  'stock_financials': 'stock_financials',
+                  'stock_actions': 'stock_actions',
+                  'stock_holders': 'stock_holders'}
+
+version_table = 'schema_version'
+
+
+def create_tables(tables: dict) -> list:
+    '''
+    Migration 1: create the stock, request, price, financials,
+    actions and holders tables
+    '''
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {tables['stock']}
+        (
+            id serial PRIMARY KEY,
+            ticker VARCHAR (255) UNIQUE NOT NULL
+        );
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {tables['request']}
+        (
+            id serial PRIMARY KEY,
+            stock_id integer,
+            utc_time timestamp with time zone,
+            request_type varchar(255),
+            period varchar(255),
+            interval varchar(255),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """,
+        # Request tables created before period and interval were logged
+        f"""
+        ALTER TABLE {tables['request']}
+            ADD COLUMN IF NOT EXISTS period varchar(255),
+            ADD COLUMN IF NOT EXISTS interval varchar(255);
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {tables['stock_price']}
+        (
+            id serial PRIMARY KEY,
+            request_id integer,
+            utc_time timestamp with time zone,
+            open double precision,
+            high double precision,
+            low double precision,
+            close double precision,
+            adj_close double precision,
+            volume bigint,
+            FOREIGN KEY (request_id)
+                REFERENCES {tables['request']} (id)
+                ON DELETE CASCADE
+        );
+        """
+    ] + [
+        f"""
+        CREATE TABLE IF NOT EXISTS {tables[role]}
+        (
+            id serial PRIMARY KEY,
+            stock_id integer,
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """
+        for role in ['stock_financials', 'stock_actions', 'stock_holders']
+    ]
+
+def add_price_key(tables: dict) -> list:
+    '''
+    Migration 2: store stock_id and interval on every price row, unique
+    by (stock_id, interval, utc_time), removing duplicated bars
+    '''
+    stock_price = tables['stock_price']
+    request = tables['request']
+
+    return [
+        f"""
+        ALTER TABLE {stock_price}
+            ADD COLUMN IF NOT EXISTS stock_id integer
+                REFERENCES {tables['stock']} (id) ON DELETE CASCADE,
+            ADD COLUMN IF NOT EXISTS interval varchar(255);
+        """,
+        f"""
+        UPDATE {stock_price}
+            SET stock_id = {request}.stock_id, interval = {request}.interval
+            FROM {request}
+            WHERE {request}.id = {stock_price}.request_id
+                AND {stock_price}.stock_id IS NULL;
+        """,
+        # Keep the most recently downloaded copy of each bar
+        f"""
+        DELETE FROM {stock_price} AS old
+            USING {stock_price} AS new
+            WHERE old.stock_id = new.stock_id
+                AND old.interval = new.interval
+                AND old.utc_time = new.utc_time
+                AND old.id < new.id;
+        """,
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {stock_price}_stock_interval_time_key
+            ON {stock_price} (stock_id, interval, utc_time);
+        """,
+        f"""
+        CREATE INDEX IF NOT EXISTS {stock_price}_request_id_idx
+            ON {stock_price} (request_id);
+        """,
+        f"""
+        CREATE INDEX IF NOT EXISTS {request}_stock_id_idx
+            ON {request} (stock_id, request_type);
+        """
+    ]
+
+def create_rollup_table(tables: dict) -> list:
+    '''
+    Migration 3: create the table of bars rolled up from finer stored bars
+    '''
+    rollup = f"{tables['stock_price']}_rollup"
+
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {rollup}
+        (
+            stock_id integer NOT NULL,
+            interval varchar(255) NOT NULL,
+            utc_time timestamp with time zone NOT NULL,
+            open double precision,
+            high double precision,
+            low double precision,
+            close double precision,
+            adj_close double precision,
+            volume bigint,
+            bar_count integer,
+            PRIMARY KEY (stock_id, interval, utc_time),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """
+    ]
+
+def create_indicator_tables(tables: dict) -> list:
+    '''
+    Migration 4: create the tables of indicator values and of the state
+    needed to extend them
+    '''
+    indicator = f"{tables['stock_price']}_indicator"
+
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {indicator}
+        (
+            stock_id integer NOT NULL,
+            interval varchar(255) NOT NULL,
+            indicator varchar(255) NOT NULL,
+            utc_time timestamp with time zone NOT NULL,
+            value double precision,
+            PRIMARY KEY (stock_id, interval, indicator, utc_time),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {indicator}_state
+        (
+            stock_id integer NOT NULL,
+            interval varchar(255) NOT NULL,
+            indicator varchar(255) NOT NULL,
+            request_id integer,
+            last_time timestamp with time zone,
+            state text,
+            PRIMARY KEY (stock_id, interval, indicator),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """
+    ]
+
+def create_freshness_table(tables: dict) -> list:
+    '''
+    Migration 5: create the table of the last successful fetch of every
+    stock and request type, filled from the requests already logged
+    '''
+    request = tables['request']
+    freshness = f'{request}_freshness'
+
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {freshness}
+        (
+            stock_id integer NOT NULL,
+            request_type varchar(255) NOT NULL,
+            scope varchar(255) NOT NULL DEFAULT '',
+            utc_time timestamp with time zone NOT NULL,
+            PRIMARY KEY (stock_id, request_type, scope),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """,
+        # Price fetches are scoped by period and interval (see freshness.price_scope)
+        f"""
+        INSERT INTO {freshness} (stock_id, request_type, scope, utc_time)
+        SELECT stock_id, request_type,
+               CASE WHEN request_type = 'stock_price'
+                    THEN COALESCE(period, '') || '/' || COALESCE(interval, '')
+                    ELSE '' END,
+               max(utc_time)
+            FROM {request}
+        WHERE stock_id IS NOT NULL
+            AND request_type IS NOT NULL
+            AND utc_time IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING;
+        """
+    ]
+
+def create_document_tables(tables: dict) -> list:
+    '''
+    Migration 6: create the JSONB document tables of stock info and
+    financials, with a few fields promoted to generated columns
+    '''
+    info = f"{tables['stock']}_info_document"
+    financials = f"{tables['stock_financials']}_document"
+
+    # Fields of another JSON type than expected are NULL rather than failing the cast
+    def number(field):
+        return (f"CASE WHEN jsonb_typeof(payload->'{field}') = 'number' "
+                f"THEN (payload->>'{field}')::double precision END")
+
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {info}
+        (
+            stock_id integer PRIMARY KEY,
+            utc_time timestamp with time zone NOT NULL,
+            payload jsonb NOT NULL,
+            short_name text GENERATED ALWAYS AS (payload->>'shortName') STORED,
+            sector text GENERATED ALWAYS AS (payload->>'sector') STORED,
+            industry text GENERATED ALWAYS AS (payload->>'industry') STORED,
+            currency text GENERATED ALWAYS AS (payload->>'currency') STORED,
+            market_cap double precision GENERATED ALWAYS AS ({number('marketCap')}) STORED,
+            beta double precision GENERATED ALWAYS AS ({number('beta')}) STORED,
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """,
+        f"""
+        CREATE INDEX IF NOT EXISTS {info}_payload_idx
+            ON {info} USING gin (payload jsonb_path_ops);
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {financials}
+        (
+            stock_id integer NOT NULL,
+            date varchar(255) NOT NULL,
+            utc_time timestamp with time zone NOT NULL,
+            payload jsonb NOT NULL,
+            total_revenue double precision GENERATED ALWAYS AS ({number('total_revenue')}) STORED,
+            net_income double precision GENERATED ALWAYS AS ({number('net_income')}) STORED,
+            gross_profit double precision GENERATED ALWAYS AS ({number('gross_profit')}) STORED,
+            operating_income double precision GENERATED ALWAYS AS ({number('operating_income')}) STORED,
+            PRIMARY KEY (stock_id, date),
+            FOREIGN KEY (stock_id)
+                REFERENCES {tables['stock']} (id)
+                ON DELETE CASCADE
+        );
+        """,
+        f"""
+        CREATE INDEX IF NOT EXISTS {financials}_payload_idx
+            ON {financials} USING gin (payload jsonb_path_ops);
+        """
+    ]
+
+# (description, function of the table names returning SQL statements),
+# in the order they are applied. Only ever append to this list.
+migrations = [
+    ('create tables', create_tables),
+    ('add stock price key', add_price_key),
+    ('create rollup table', create_rollup_table),
+    ('create indicator tables', create_indicator_tables),
+    ('create freshness table', create_freshness_table),
+    ('create document tables', create_document_tables),
+]
+
+schema_version = len(migrations)
+
+
+_ensured = set()
+_lock = threading.Lock()
+
+def schema_name(tables: dict) -> str:
+    '''
+    Name of the schema_version row of a set of table names
+    '''
+    return ','.join(tables[role] for role in sorted(tables))
+
+def get_version(cursor, name: str) -> int:
+    """Get the number of migrations applied to a set of tables
+
+    Returns:
+    ----------
+    int : applied migrations, or None if there is no schema_version table
+    """
+
+    cursor.execute(f"SELECT to_regclass('{version_table}') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+
+    cursor.execute(f"SELECT version FROM {version_table} WHERE name = %s", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def ensure_schema(tables: dict = None) -> None:
+    """Create or migrate the tables, once per process
+
+    Parameters:
+    ----------
+    tables (dict) : table role: table name, defaults to default_tables
+    """
+
+    tables = dict(default_tables, **(tables or {}))
+    name = schema_name(tables)
+
+    if name in _ensured:
+        return
+
+    with _lock:
+        if name in _ensured:
+            return
+
+        migrated = False
+        with connection() as conn:
+            cursor = conn.cursor()
+
+            version = get_version(cursor, name)
+
+            if version is None or version < schema_version:
+                # Serialise migrations between processes
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (version_table,))
+
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {version_table}
+                    (
+                        name varchar(1024) PRIMARY KEY,
+                        version integer NOT NULL
+                    );
+                """)
+                version = get_version(cursor, name)
+
+                for number in range(version + 1, schema_version + 1):
+                    description, migration = migrations[number - 1]
+                    for statement in migration(tables):
+                        cursor.execute(statement)
+                    metrics.event('migration_applied', version=number,
+                                  description=description, tables=name)
+
+                cursor.execute(f"""
+                    INSERT INTO {version_table} (name, version) VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version
+                """, (name, schema_version))
+                migrated = True
+
+            # Partition the price table, if enabled in database.ini
+            manager = get_partition_manager(tables['stock_price'])
+            if manager is not None:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (manager.table,))
+                manager.setup(cursor)
+
+        # The migrations created or altered tables
+        if migrated:
+            get_catalog().forget()
+        _ensured.add(name)
+
+def forget_schema(tables: dict = None) -> None:
+    """Remove the version row of a set of tables (e.g. after dropping
+    them) so that the next ensure_schema creates them again
+
+    Parameters:
+    ----------
+    tables (dict) : table role: table name, defaults to default_tables
+    """
+
+    tables = dict(default_tables, **(tables or {}))
+    name = schema_name(tables)
+
+    with _lock:
+        _ensured.discard(name)
+        get_catalog().forget()
+
+        manager = get_partition_manager(tables['stock_price'])
+        if manager is not None:
+            manager.forget()
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            if get_version(cursor, name) is not None:
+                cursor.execute(f"DELETE FROM {version_table} WHERE name = %s", (name,))
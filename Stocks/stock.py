@@ -1,7 +1,8 @@
 from os.path import exists
 from functools import cached_property
+from contextlib import contextmanager
 import datetime
-from dateutil import parser
+from dateutil import parser, tz
 
 import yfinance as yf
 import pandas as pd
@@ -10,17 +11,39 @@ import pytz
 import sys
 import psycopg2
 import time
+import logging
 
 # Created libraries
-from connect import connect
-import time_tools
+from connect import connection
+from documents import get_storage_mode, storage_modes, write_documents
+import metrics
+from freshness import get_freshness_cache, load_ttls, price_scope
+from indicators import get_indicator_engine
+from partitions import prepare_partitions
+from planner import DownloadPlan, plan_download
+from providers import get_provider
+from price_stream import iter_price_chunks
+from price_cache import get_price_cache, update_price_cache
+from response_cache import get_response_cache
+from rollups import update_rollups
+from schema import ensure_schema, forget_schema
+from stock_market import default_exchange, get_market
 # Refactor: just import db_tools and call functions as methods
-from db_tools import get_postgres_type, get_column_types, convert_type, get_compatible_types, adjust_database_columns
+from db_tools import adjust_database_columns, upsert_dataframe, copy_to_arrays, write_dataframe
 
 # Issue: stop using f strings
 # Issue: timestamps saved as utc + 1
-# Issue: rollback not possible on requests when in separate function
-# (for log_request_to_database)
+
+# yfinance price column: stock price table column
+stock_price_columns = {'Open': 'open',
+                       'High': 'high',
+                       'Low': 'low',
+                       'Close': 'close',
+                       'Adj Close': 'adj_close',
+                       'Volume': 'volume'}
+
+# Columns identifying a row of the stock price table
+stock_price_key = ['stock_id', 'interval', 'utc_time']
 
 class Stock:
     '''
@@ -32,12 +55,15 @@ class Stock:
                  stock_financials_table : str = 'stock_financials',
                  stock_actions_table : str = 'stock_actions',
                  stock_holders_table : str = 'stock_holders',
-                 update_info_delta : datetime.timedelta = datetime.timedelta(days=0)) -> None:
+                 update_info_delta : datetime.timedelta = None,
+                 freshness_ttls : dict = None,
+                 storage : str = None,
+                 exchange : str = default_exchange) -> None:
         """Initialise instance of Stock class
 
-        Validate and set parameters.
-
-        Create (if not already created) request, stock, and stock_data databases.
+        Validate and set parameters. No database or network I/O is done:
+        the tables are created (if not already created) by schema.ensure_schema
+        on first use of the database.
 
         Parameters:
         ----------
@@ -46,7 +72,16 @@ class Stock:
         stock_price_table (str) : name of the stock price table
         stock_table (str) : name of the stock table
         stock_financials_table (str) : name of the stock financials table
-        update_info_delta (datetime.timedelta) : time within which to not update stock info
+        update_info_delta (datetime.timedelta) : time within which to not update stock info,
+            defaults to the stock_info TTL of freshness_ttls
+        freshness_ttls (dict) : request type: datetime.timedelta within which
+            to not download it again, defaults to freshness.load_ttls()
+        storage (str) : 'columns' to store stock info and financials as table
+            columns (added as new fields appear), or 'jsonb' to store them as
+            JSONB documents (see documents), defaults to the storage section
+            of database.ini
+        exchange (str) : exchange the stock trades on (section of
+            exchanges.ini), whose sessions price data is expected in
 
         Returns:
         ---------
@@ -60,17 +95,22 @@ class Stock:
 
         string_parameters = [ticker, request_table, stock_price_table, 
                              stock_table, stock_financials_table, stock_actions_table,
-                             stock_holders_table]
+                             stock_holders_table, exchange]
 
         # Check types of parameters
         for string_param in string_parameters:
             if not isinstance(string_param, str):
                 raise TypeError(f'{string_param} is not a string (type: {type(string_param)})')
         
-        if not isinstance(update_info_delta, datetime.timedelta):
+        if update_info_delta is not None and not isinstance(update_info_delta, datetime.timedelta):
             raise TypeError(f'{update_info_delta} is not an instance of class datetime.timedelta' \
                             f'(type: {type(update_info_delta)})')
         
+        if storage is None:
+            storage = get_storage_mode()
+        if storage not in storage_modes:
+            raise ValueError(f'{storage} is not a storage mode (modes: {storage_modes})')
+
         # Check that parameters are not empty strings
         for string_param in string_parameters:
             if not string_param:
@@ -78,7 +118,8 @@ class Stock:
 
         # Set fixed (or not changed by program) attributes
         self._ticker = ticker
-        self._stock = yf.Ticker(self._ticker)
+        # yfinance ticker object, created on first use
+        self._stock = None
 
         # Set attributes
         self.request_table = request_table
@@ -87,114 +128,22 @@ class Stock:
         self.stock_financials_table = stock_financials_table
         self.stock_actions_table = stock_actions_table
         self.stock_holders_table = stock_holders_table
-        self.update_info_delta = update_info_delta
-
-        conn = None
-        
-        try:
-            # Connect to db
-            conn = connect()
-            cursor = conn.cursor()
-
-            # Create stock table
-            stock_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.stock_table}
-                        (
-                            id serial PRIMARY KEY,
-                            ticker VARCHAR (255) UNIQUE NOT NULL
-                        );
-            """
-            cursor.execute(stock_table_query)
-            print(f'Created {stock_table} table (if not exists)')
-
-            # Create requests table
-            request_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.request_table}
-                        (
-                            id serial PRIMARY KEY,
-                            stock_id integer,
-                            utc_time timestamp with time zone,
-                            request_type varchar(255),
-                            FOREIGN KEY (stock_id)
-                                REFERENCES {self.stock_table} (id)
-                                ON DELETE CASCADE
-                        );
-            """
-            cursor.execute(request_table_query)
-            print(f'Created {request_table} table (if not exists)')
-
-            
-            # Create stock price table
-            stock_price_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.stock_price_table}
-                        (
-                            id serial PRIMARY KEY,
-                            request_id integer,
-                            utc_time timestamp with time zone,
-                            open double precision,
-                            high double precision,
-                            low double precision,
-                            close double precision,
-                            adj_close double precision,
-                            volume bigint,
-                            FOREIGN KEY (request_id)
-                                REFERENCES {self.request_table} (id)
-                                ON DELETE CASCADE
-                        );
-            """
-            cursor.execute(stock_price_table_query)
-            print(f'Created {stock_price_table} table (if not exists)')
-
-            # Create stock financials table
-            stock_financials_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.stock_financials_table}
-                        (
-                            id serial PRIMARY KEY,
-                            stock_id integer,
-                            FOREIGN KEY (stock_id)
-                                REFERENCES {self.stock_table} (id)
-                                ON DELETE CASCADE
-                        );
-            """
-            cursor.execute(stock_financials_table_query)
-            print(f'Created {self.stock_financials_table} table (if not exists)')
-
-            stock_actions_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.stock_actions_table}
-                        (
-                            id serial PRIMARY KEY,
-                            stock_id integer,
-                            FOREIGN KEY (stock_id)
-                                REFERENCES {self.stock_table} (id)
-                                ON DELETE CASCADE
-                        );
-            """
-            cursor.execute(stock_actions_table_query)
-            print(f'Created {self.stock_actions_table} table (if not exists')
-
-            stock_holders_table_query = f"""
-                        CREATE TABLE IF NOT EXISTS {self.stock_holders_table}
-                        (
-                            id serial PRIMARY KEY,
-                            stock_id integer,
-                            FOREIGN KEY (stock_id)
-                                REFERENCES {self.stock_table} (id)
-                                ON DELETE CASCADE
-                        )
-            """
-            cursor.execute(stock_holders_table_query)
-            print(f'Create {self.stock_holders_table} table (if not exists)')
-
-        except (Exception, psycopg2.DatabaseError) as error:
-            # Rollback changes if an error occurs
-            conn.rollback()
-            raise Exception(error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.commit()
-                conn.close()
-                print('Database connection is closed')
+        self.storage = storage
+        self.exchange = exchange
+        self.freshness_ttls = dict(load_ttls(), **(freshness_ttls or {}))
+        if update_info_delta is not None:
+            self.freshness_ttls['stock_info'] = update_info_delta
+
+        # Optional limits set by an ingestion scheduler: a rate limiter
+        # (with an acquire method) for yfinance calls and a semaphore
+        # bounding concurrent database writes
+        self.rate_limiter = None
+        self.write_slots = None
+
+        # Persistent cache of yfinance responses (None to always call upstream)
+        self.response_cache = get_response_cache()
+        # Source of upstream data (see providers), defaults to get_provider()
+        self.provider = None
 
     @property
     def ticker(self) -> str:
@@ -229,6 +178,7 @@ class Stock:
 
         # Set _ticker property
         self._ticker = new_ticker
+        self._stock = None
 
     @property
     def stock(self) -> yf.Ticker:
@@ -238,8 +188,82 @@ class Stock:
         ----------
         yf.Ticker : yfinance ticker object
         """
+        if self._stock is None:
+            self._stock = yf.Ticker(self._ticker)
         return self._stock
 
+    @property
+    def tables(self) -> dict:
+        """Getter method for tables
+
+        Returns:
+        ----------
+        dict : table role: table name, as used by schema.ensure_schema
+        """
+        return {'stock': self.stock_table,
+                'request': self.request_table,
+                'stock_price': self.stock_price_table,
+                'stock_financials': self.stock_financials_table,
+                'stock_actions': self.stock_actions_table,
+                'stock_holders': self.stock_holders_table}
+
+    def fetch(self, endpoint: str, **params):
+        """Get data from yfinance
+
+        Every upstream call goes through this method, so that it can be
+        rate limited. Responses are served from the response_cache while
+        within their endpoint's TTL, without calling upstream.
+
+        Parameters:
+        ----------
+        endpoint (str) : 'download' (yf.download of the ticker, with params),
+            or an attribute of the yfinance ticker ('info', 'financials',
+            'actions', 'institutional_holders', 'mutualfund_holders')
+        params : keyword arguments of yf.download
+
+        Returns:
+        ----------
+        data returned by yfinance
+        """
+
+        if self.response_cache is not None:
+            return self.response_cache.fetch(self.ticker, endpoint, params,
+                                             lambda: self.fetch_upstream(endpoint, **params))
+        return self.fetch_upstream(endpoint, **params)
+
+    def fetch_upstream(self, endpoint: str, **params):
+        '''Get data from the provider, bypassing the response cache (see fetch)'''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        provider = self.provider or get_provider()
+        return provider.fetch(self.ticker, endpoint, **params)
+
+    def connection(self):
+        """Check out a pooled connection, creating the tables first if
+        this process has not yet checked them
+        """
+
+        ensure_schema(self.tables)
+        return connection()
+
+    @contextmanager
+    def write_connection(self):
+        """Check out a pooled connection for writing
+
+        Waits for one of the write_slots first, if they are set.
+        """
+
+        ensure_schema(self.tables)
+
+        if self.write_slots is None:
+            with connection() as conn:
+                yield conn
+        else:
+            with self.write_slots:
+                with connection() as conn:
+                    yield conn
+
     @staticmethod
     def time_to_utc(time: datetime.datetime) -> datetime.datetime:
         ''' Convert datetime to string of utc time
@@ -247,48 +271,77 @@ class Stock:
         utc_time = time.astimezone(pytz.UTC)
         return utc_time
 
-    @cached_property
+    @property
+    def update_info_delta(self) -> datetime.timedelta:
+        return self.freshness_ttls['stock_info']
+
+    @update_info_delta.setter
+    def update_info_delta(self, delta: datetime.timedelta) -> None:
+        self.freshness_ttls['stock_info'] = delta
+
+    @property
+    def market(self):
+        '''Trading calendar of the stock's exchange (see stock_market.get_market)'''
+        return get_market(self.exchange)
+
+    @property
+    def freshness(self):
+        '''Process-wide freshness cache of the request table'''
+        return get_freshness_cache(self.request_table)
+
+    @property
     def last_stock_info_update(self) -> datetime.datetime:
         """Getter method for last_stock_info_update
-        
-        Determine when the stock_info was last updated, using the 
-        requests database.
+
+        Determine when the stock_info was last updated, using the
+        freshness table (through its cache).
 
         Returns:
         ----------
         last_update (datetime.datetime) : datetime object of last update
         """
 
-        conn = None
-        last_update = None
+        # Check that stock exists in the database
+        if not self.stock_id:
+            return None
 
-        try:
-            # Connect to db
-            conn = connect()
-            cursor = conn.cursor()
+        ensure_schema(self.tables)
+        return self.freshness.last_update(self.stock_id, 'stock_info')
 
-            # Check that stock exists in the database
-            if not self.stock_id:
-                raise Exception('stock_id not found')
-            
-            # Query db for utc_time of last update
-            stock_update_query = f"SELECT utc_time FROM {self.request_table} WHERE stock_id = {self.stock_id};"
-            cursor.execute(stock_update_query)
+    def is_fresh(self, request_type: str, scope: str = '') -> bool:
+        """Check whether a request type was fetched within its TTL
 
-            return_value = cursor.fetchall()
-            
-            if return_value:
-                last_update = return_value[0][0]
+        Parameters:
+        ----------
+        request_type (str) : type of the request (key of freshness_ttls)
+        scope (str) : scope of the fetch (see freshness.price_scope)
+
+        Returns:
+        ----------
+        bool : True if the download can be skipped
+        """
+
+        ttl = self.freshness_ttls.get(request_type)
+        if not ttl or not self.stock_id:
+            return False
+
+        ensure_schema(self.tables)
+        if not self.freshness.is_fresh(self.stock_id, request_type, ttl, scope=scope):
+            return False
+
+        last_update = self.freshness.last_update(self.stock_id, request_type, scope)
+        metrics.count('downloads_skipped', request_type=request_type, reason='fresh')
+        metrics.event('download_skipped', ticker=self.ticker, request_type=request_type,
+                      reason='fresh', last_update=last_update, next_update=last_update + ttl)
+        return True
+
+    def mark_fresh(self, request_type: str, scope: str = '') -> None:
+        '''Record a successful fetch that stored nothing new (the data was already stored)'''
+        # Resolve the id before taking a write connection (no nested checkout)
+        stock_id = self.stock_id
+        with self.write_connection() as conn:
+            self.freshness.record(conn.cursor(), stock_id, request_type, scope=scope)
 
-        except (Exception, psycopg2.DatabaseError) as error:
-            raise Exception(error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.commit()
-                conn.close()
-            return last_update
-    
     @cached_property
     def stock_id(self) -> int:
         """Getter method for stock_id
@@ -308,43 +361,33 @@ class Stock:
         """
 
         stock_id = None
-        conn = None
 
         try:
-            # Connect to db
-            conn = connect()
-            cursor = conn.cursor()
+            with self.connection() as conn:
+                cursor = conn.cursor()
 
-            # Get stock id from database
-            stock_id_query = f"SELECT id FROM {self.stock_table} WHERE {self.stock_table}.ticker = '{self.ticker}';"
-            cursor.execute(stock_id_query)
-            returned_data = cursor.fetchall()
+                # Get stock id from database
+                stock_id_query = f"SELECT id FROM {self.stock_table} WHERE {self.stock_table}.ticker = '{self.ticker}';"
+                cursor.execute(stock_id_query)
+                returned_data = cursor.fetchall()
 
-            # If data is returned, set stock_id
-            if returned_data:
-                stock_id = returned_data[0][0]
+                # If data is returned, set stock_id
+                if returned_data:
+                    stock_id = returned_data[0][0]
 
-            # Insert row into stock database ----------
+                # Insert row into stock database ----------
 
-            # Add stock to db
-            if not returned_data:
                 # Add stock to db
-                add_stock_query = f"INSERT INTO {self.stock_table} (ticker) VALUES ('{self.ticker}')"
-                cursor.execute(add_stock_query)
-                conn.commit()
-                # Get id of added stock
-                stock_id_query = f"SELECT currval(pg_get_serial_sequence('{self.stock_table}','id'));"
-                cursor.execute(stock_id_query)
-                stock_id = cursor.fetchone()[0]
+                if not returned_data:
+                    # Add stock to db and get id of added stock
+                    add_stock_query = f"INSERT INTO {self.stock_table} (ticker) VALUES ('{self.ticker}') RETURNING id"
+                    cursor.execute(add_stock_query)
+                    stock_id = cursor.fetchone()[0]
 
-        except (Exception, psycopg2.DatabaseError) as Error:
-            raise Exception(error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.commit()
-                conn.close()
-            return stock_id
+        except (Exception, psycopg2.DatabaseError) as error:
+            metrics.event('database_error', logging.ERROR, ticker=self.ticker, error=str(error))
+
+        return stock_id
 
     @cached_property
     def financials_reports_dates(self) -> list:
@@ -355,29 +398,25 @@ class Stock:
         list : list of dates of financial reports
         """
 
-        conn = None
         financial_reports = None
 
         try:
-            # Connect to db
-            conn = connect()
-            cursor = conn.cursor()
+            with self.connection() as conn:
+                cursor = conn.cursor()
 
-            reports_dates_query = f"""SELECT date
-                                      FROM {self.stock_financials_table}
-                                      WHERE "stock_id" = {self.stock_id}"""
-            cursor.execute(reports_dates_query)
-            return_values = cursor.fetchall()
-            if return_values:
-                financial_reports = [parser.parse(date[0]) for date in return_values]
+                reports_dates_query = f"""SELECT date
+                                          FROM {self.stock_financials_table}
+                                          WHERE "stock_id" = {self.stock_id}"""
+                cursor.execute(reports_dates_query)
+                return_values = cursor.fetchall()
+                if return_values:
+                    financial_reports = [parser.parse(date[0]) for date in return_values]
 
         except (Exception, psycopg2.DatabaseError) as error:
-            raise Exception(error)
-        finally:
-            if conn:
-                conn.commit()
-                conn.close()
-            return financial_reports
+            # The date column only exists once financials have been added
+            metrics.event('database_error', logging.ERROR, ticker=self.ticker, error=str(error))
+
+        return financial_reports
     
     @cached_property
     def actions_dates(self) -> list:
@@ -388,81 +427,246 @@ class Stock:
         list : list of dates of actions in database
         """
         
-        conn = None
         actions_dates = None
 
         try:
-            conn = connect()
-            cursor = conn.cursor()
+            with self.connection() as conn:
+                cursor = conn.cursor()
 
-            actions_dates_query = f"""SELECT date 
-                                      FROM {self.stock_actions_table}
-                                      WHERE "stock_id" = {self.stock_id}"""
-            cursor.execute(actions_dates_query)
+                actions_dates_query = f"""SELECT date 
+                                          FROM {self.stock_actions_table}
+                                          WHERE "stock_id" = {self.stock_id}"""
+                cursor.execute(actions_dates_query)
 
-            return_values = cursor.fetchall()
-            if return_values:
-                actions_dates = [parser.parse(date[0]) for date in return_values]
+                return_values = cursor.fetchall()
+                if return_values:
+                    actions_dates = [parser.parse(date[0]) for date in return_values]
 
         except (Exception, psycopg2.DatabaseError) as error:
-            raise Exception(error)
-        finally:
-            if conn:
-                conn.commit()
-                conn.close()
-            return actions_dates
+            # The date column only exists once actions have been added
+            metrics.event('database_error', logging.ERROR, ticker=self.ticker, error=str(error))
+
+        return actions_dates
     
-    def get_available_stock_timestamps(self):
-        '''
-        '''
+    def get_available_stock_timestamps(self, interval: str,
+                                       start: datetime.datetime = None) -> pd.DatetimeIndex:
+        """Get the timestamps of the stock price data stored for an interval
 
-        conn = None
-        timestamps = None
+        Parameters:
+        ----------
+        interval (str) : interval between stock price data values
+        start (datetime.datetime) : only return timestamps from this time on
 
-        try:
-            # Connect to db
-            conn = connect()
+        Returns:
+        ----------
+        pd.DatetimeIndex : sorted UTC timestamps
+        """
+
+        prices = self.load_prices(start=start, interval=interval, columns=[])
+        return prices.index.rename(None)
+
+    @staticmethod
+    def to_utc_ns(timestamp) -> int:
+        '''Convert a timestamp (naive timestamps are local time) to UTC nanoseconds'''
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tz is None:
+            timestamp = timestamp.tz_localize(tz.tzlocal())
+        return timestamp.tz_convert(pytz.UTC).as_unit('ns').value
+
+    def load_prices(self, start: datetime.datetime = None, end: datetime.datetime = None,
+                    interval: str = '1m', columns: list = None,
+                    as_frame: bool = True, rollup: bool = False):
+        """Load stored price data from the stock price table
+
+        The rows are streamed with a binary COPY and parsed straight into
+        typed numpy arrays, without a Python object per row or value.
+        Missing prices and volumes are NaN.
+
+        Parameters:
+        ----------
+        start (datetime.datetime) : start of the range, defaults to the first bar
+        end (datetime.datetime) : end (exclusive) of the range, defaults to after the last bar
+        interval (str) : interval between stock price data values
+        columns (list) : price columns to load (values of stock_price_columns),
+            defaults to every price column
+        as_frame (bool) : return a DataFrame rather than a dict of arrays
+        rollup (bool) : load bars rolled up from finer bars (see rollups)
+            rather than downloaded bars
+
+        Returns:
+        ----------
+        pd.DataFrame : columns indexed by UTC time, if as_frame
+        dict : 'utc_time' (UTC nanoseconds) and every column: np.ndarray, otherwise
+
+        Raises:
+        ----------
+        ValueError : a column is not a price column
+        """
+
+        if columns is None:
+            columns = list(stock_price_columns.values())
+        for column in columns:
+            if column not in stock_price_columns.values():
+                raise ValueError(f'{column} is not a price column ' \
+                                 f'(columns: {list(stock_price_columns.values())})')
+
+        start = None if start is None else pd.Timestamp(self.to_utc_ns(start), tz=pytz.UTC).to_pydatetime()
+        end = None if end is None else pd.Timestamp(self.to_utc_ns(end), tz=pytz.UTC).to_pydatetime()
+
+        table = f'{self.stock_price_table}_rollup' if rollup else self.stock_price_table
+
+        # NULLs would change the size of a binary row, so load them as NaN
+        selected = ['utc_time'] + [f"COALESCE({column}::double precision, 'NaN')" for column in columns]
+        types = ['timestamp with time zone'] + ['double precision'] * len(columns)
+
+        with self.connection() as conn:
             cursor = conn.cursor()
 
-            # Set query to get timestamps for given ticker
-            query = f"""
-                    SELECT {self.stock_price_table}.utc_time 
-                        FROM {self.stock_price_table}
-                        LEFT JOIN {self.request_table}
-                        ON {self.request_table}.id = {self.stock_price_table}.request_id
-                    WHERE {self.request_table}.ticker = '{self.ticker}'"""
-
-            # Execute and retrieve data
-            cursor.execute(query)
-            timestamps = cursor.fetchall()
-
-        except sqlite3.Error as error:
-            print('Failed to create SQLite table', error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.close()
-                print('Database connection is closed')
-                return timestamps
-
-    def download_stock_price_data(self, period : str="1d", interval : str = "1m") -> None:
+            # Bounds on utc_time let the index range scan (and partition pruning) apply
+            query = cursor.mogrify(f"""
+                    SELECT {', '.join(selected)}
+                        FROM {table}
+                    WHERE stock_id = %s
+                        AND interval = %s
+                        AND (%s::timestamptz IS NULL OR utc_time >= %s::timestamptz)
+                        AND (%s::timestamptz IS NULL OR utc_time < %s::timestamptz)
+                    ORDER BY utc_time""",
+                                   (self.stock_id, interval, start, start, end, end)).decode()
+            arrays = copy_to_arrays(cursor, query, types)
+
+        data = dict(zip(['utc_time'] + columns, arrays))
+        if not as_frame:
+            return data
+
+        index = pd.DatetimeIndex(data.pop('utc_time'), tz=pytz.UTC, name='utc_time')
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def iter_prices(self, interval: str = '1m', start: datetime.datetime = None,
+                    end: datetime.datetime = None, columns: list = None,
+                    chunk_size: int = 100000, prefetch: int = 2, as_frame: bool = True):
+        """Iterate over the stored price data of the stock in chunks
+
+        See price_stream.iter_price_chunks.
+        """
+
+        return iter_price_chunks([self.ticker], interval=interval, start=start, end=end,
+                                 columns=columns, chunk_size=chunk_size, prefetch=prefetch,
+                                 as_frame=as_frame, stock_table=self.stock_table,
+                                 stock_price_table=self.stock_price_table)
+
+    def update_indicators(self, interval: str = '1m', indicators: list = None) -> dict:
+        """Extend the stock's indicators with the bars stored since their last update
+
+        See indicators.IndicatorEngine.update.
+        """
+
+        ensure_schema(self.tables)
+        return get_indicator_engine(self.stock_price_table).update(self.stock_id, interval, indicators)
+
+    def load_indicator(self, indicator, interval: str = '1m',
+                       start: datetime.datetime = None, end: datetime.datetime = None) -> pd.DataFrame:
+        """Load the stored values of an indicator of the stock
+
+        See indicators.IndicatorEngine.load.
+        """
+
+        ensure_schema(self.tables)
+        return get_indicator_engine(self.stock_price_table).load(self.stock_id, indicator,
+                                                                 interval, start, end)
+
+    def price_history(self, interval: str = '1m', start: datetime.datetime = None,
+                      end: datetime.datetime = None) -> dict:
+        """Get the stored price data of an interval, reading through the price cache
+
+        A range the cache holds is returned as views of its memory mapped
+        files; otherwise the range is loaded from the stock price table and
+        cached. A range ending after the cached range (e.g. the default
+        end, now) ends at the last bar the cache knows of, as every bar
+        written by this process since is added to the cache.
+
+        Parameters:
+        ----------
+        interval (str) : interval between stock price data values
+        start (datetime.datetime) : start of the range, defaults to the first bar
+        end (datetime.datetime) : end (exclusive) of the range, defaults to now
+
+        Returns:
+        ----------
+        dict : column (key of price_cache.cache_columns): np.ndarray, sorted
+            by utc_time (UTC nanoseconds)
+        """
+
+        start = 0 if start is None else self.to_utc_ns(start)
+        end = None if end is None else self.to_utc_ns(end)
+
+        cache = get_price_cache(self.stock_price_table)
+
+        def load(start: int, end: int) -> dict:
+            return self.load_prices(pd.Timestamp(start, tz=pytz.UTC),
+                                    pd.Timestamp(end, tz=pytz.UTC),
+                                    interval, as_frame=False)
+
+        if cache is None:
+            return load(start, self.to_utc_ns(datetime.datetime.now(pytz.UTC)) if end is None else end)
+        return cache.read(self.ticker, interval, start, end, load)
+
+    @metrics.instrument('download')
+    def download_stock_price_data(self, period : str="1d", interval : str = "1m",
+                                  max_requests : int = 3) -> DownloadPlan:
         """Download stock price data for given period
 
-        Use yfinance retrieve stock price data and then store it in the stock_price_table
+        Plan the download against the data already stored: only the
+        ranges of the period missing from the stock_price_table are
+        retrieved from yfinance and stored.
 
         Parameters:
         ----------
         period (str) : period over which to retrieve data
         interval (str) : interval between stock price data values
+        max_requests (int) : maximum number of downloads for the missing ranges
+
+        Returns:
+        ----------
+        DownloadPlan : plan of the download, with the bars and requests saved,
+            or None if the period and interval were fetched within the
+            stock_price TTL
         """
         # Need to validate parameters
 
+        if self.is_fresh('stock_price', price_scope(period, interval)):
+            return None
+
+        # Compare the completed bars of the exchange's sessions with those stored
+        expected = self.market.bar_timestamps(period, interval)
+        stored = self.get_available_stock_timestamps(interval, start=expected.min()) \
+            if len(expected) else pd.DatetimeIndex([], tz=pytz.UTC)
+        plan = plan_download(self.ticker, period, interval, stored,
+                             expected=expected, max_requests=max_requests)
+
+        if not plan.missing_ranges:
+            metrics.count('downloads_skipped', request_type='stock_price', reason='stored')
+            metrics.event('download_skipped', ticker=self.ticker, request_type='stock_price',
+                          reason='stored', plan=str(plan))
+            return plan
+
         # Get data from yfinance api
-        data = yf.download(
-            tickers=self.ticker,
-            period=period,
-            interval=interval
-        )
+        if plan.is_full_period:
+            data = self.fetch('download', period=period, interval=interval)
+        else:
+            data = pd.concat([self.fetch('download', start=start, end=end, interval=interval)
+                              for start, end in plan.missing_ranges])
+            data = data[~data.index.duplicated()]
+
+        # Remove rows already in database
+        utc_index = pd.DatetimeIndex(data.index)
+        if utc_index.tz is not None:
+            data = data[~utc_index.tz_convert(pytz.UTC).isin(stored)]
+
+        metrics.event('download_planned', ticker=self.ticker, plan=str(plan))
+
+        if data.empty:
+            self.mark_fresh('stock_price', price_scope(period, interval))
+            return plan
 
         # Set datatypes for columns
         column_dtypes = {'Open': float, 
@@ -479,6 +683,9 @@ class Stock:
         # Insert data into database
         self.insert_stock_price_to_database(data, period, interval)
 
+        return plan
+
+    @metrics.instrument('download')
     def download_stock_info(self) -> None:
         """Download stock info data
 
@@ -488,36 +695,39 @@ class Stock:
         """
 
         # Check if stock was recently updated
-        if self.last_stock_info_update:
-            next_update_available = self.last_stock_info_update + self.update_info_delta
-            current_utc_time = datetime.datetime.now(datetime.timezone.utc)
-
-            if next_update_available > current_utc_time:
-                print(f"\n{self.ticker} data recently updated in database")
-                print(f"Last update: {self.last_stock_info_update}")
-                print(f"Next update available at: {self.last_stock_info_update + self.update_info_delta}")
-                return
-        
+        if self.is_fresh('stock_info'):
+            return
+
         # Get stock info
-        data = self.stock.info
+        data = self.fetch('info')
 
+        # Stored as ticker in both storage modes
         data['ticker'] = data['symbol']
         del data['symbol']    
 
+        if self.storage == 'jsonb':
+            self.add_documents_to_database('stock_info', [((self.stock_id,), data)],
+                                           request_type='stock_info')
+            return
+
         data = pd.DataFrame([data])
 
         update_dict = {'column': 'id', 'value': self.stock_id}
 
-        # adjust_database_columns_2(data, self.stock_table)
-
         # Insert to db
         self.add_dataframe_to_database(data, self.stock_table,
-                                       name='update', identifier=update_dict)
-        self.log_request_to_database('stock_info')
+                                       name='update', identifier=update_dict,
+                                       request_type='stock_info')
     
+    @metrics.instrument('download')
     def download_stock_financials(self) -> None:
+        """Download stock financials, unless fetched within the stock_financials TTL
+        """
+
+        if self.is_fresh('stock_financials'):
+            return
 
-        financials_df = self.stock.financials
+        financials_df = self.fetch('financials')
 
         # Transpose dataframe
         financials_df = financials_df.transpose()
@@ -527,6 +737,16 @@ class Stock:
         financials_df.columns = financials_df.columns.str.replace(" ", "_")
 
         financials_df['date'] = financials_df.index.astype(str)
+
+        # Documents replace those of the same report, so none are filtered out
+        if self.storage == 'jsonb':
+            rows = [((self.stock_id, date), report)
+                    for date, report in zip(financials_df['date'],
+                                            financials_df.drop(columns='date').to_dict('records'))]
+            self.add_documents_to_database('stock_financials', rows,
+                                           request_type='stock_financials')
+            return
+
         financials_df['stock_id'] = [self.stock_id] * len(financials_df.index)
 
         # Remove any rows already in database
@@ -535,7 +755,8 @@ class Stock:
                 financials_df = financials_df[financials_df['date'] != str(date.date())]   
             # If all rows are removed, return
             if financials_df.empty:
-                print("Financials retrieved already exist in database")
+                metrics.event('download_unchanged', ticker=self.ticker, request_type='stock_financials')
+                self.mark_fresh('stock_financials')
                 return
         
         # Remove rows where all values are None
@@ -546,26 +767,26 @@ class Stock:
 
         # financials_df.replace("'", "")
 
-        # adjust_database_columns_2(financials_df, self.stock_financials_table)
-
-        self.add_dataframe_to_database(financials_df, self.stock_financials_table)
-        self.log_request_to_database('stock_financials')
+        self.add_dataframe_to_database(financials_df, self.stock_financials_table,
+                                       request_type='stock_financials')
 
+    @metrics.instrument('download')
     def download_stock_actions(self) -> None:
-        """Download stock actions
+        """Download stock actions, unless fetched within the stock_actions TTL
         """
 
-        actions = self.stock.actions
+        if self.is_fresh('stock_actions'):
+            return
 
-        dates = actions.index.tolist()
-        # dates = [parser.parse(date) for date in dates]
+        actions = self.fetch('actions')
 
         # Remove already downloaded dates
         if self.actions_dates:
             for action_date in self.actions_dates:
                 actions = actions[actions.index != action_date]
             if actions.empty:
-                print('Actions retrieved already exist in database')
+                metrics.event('download_unchanged', ticker=self.ticker, request_type='stock_actions')
+                self.mark_fresh('stock_actions')
                 return
         
         # Convert column names to lowercase
@@ -576,14 +797,19 @@ class Stock:
         actions['stock_id'] = [self.stock_id] * len(actions.index)
         actions['date'] = actions.index.astype(str)
 
-        self.add_dataframe_to_database(actions, self.stock_actions_table)
-        self.log_request_to_database('stock_actions')
+        self.add_dataframe_to_database(actions, self.stock_actions_table,
+                                       request_type='stock_actions')
     
+    @metrics.instrument('download')
     def download_stock_holders(self) -> None:
-        # Need caching system for holders
+        """Download stock holders, unless fetched within the stock_holders TTL
+        """
 
-        institutional_holders = self.stock.institutional_holders
-        mutualfund_holders = self.stock.mutualfund_holders
+        if self.is_fresh('stock_holders'):
+            return
+
+        institutional_holders = self.fetch('institutional_holders')
+        mutualfund_holders = self.fetch('mutualfund_holders')
 
         # Check that columns names are the same
         if list(institutional_holders.columns) != list(mutualfund_holders.columns):
@@ -596,7 +822,7 @@ class Stock:
         mutualfund_holders['type'] = ['mutual'] * len(mutualfund_holders.index)
 
         # Join dataframes
-        holders = institutional_holders.append(mutualfund_holders, ignore_index=True)
+        holders = pd.concat([institutional_holders, mutualfund_holders], ignore_index=True)
         # Convert column names to lowercase
         holders.columns = holders.columns.str.lower()
         # Replace spaces with underscore in column names
@@ -605,213 +831,225 @@ class Stock:
         holders['date_reported'] = holders['date_reported'].astype(str)
         holders['stock_id'] = [self.stock_id] * len(holders.index)
         
-        self.add_dataframe_to_database(holders, self.stock_holders_table)
-        self.log_request_to_database('stock_holders')
+        self.add_dataframe_to_database(holders, self.stock_holders_table,
+                                       request_type='stock_holders')
     
+    @staticmethod
+    def format_price_data(data: pd.DataFrame, request_id: int,
+                          stock_id: int, interval: str) -> pd.DataFrame:
+        """Convert yfinance price data to rows of the stock price table
+
+        The index is converted to UTC in one vectorized operation (naive
+        timestamps are taken to be local time, as datetime.astimezone does).
+
+        Parameters:
+        ----------
+        data (pd.DataFrame) : price data indexed by time, as returned by yf.download
+        request_id (int) : id of the request the data was downloaded by
+        stock_id (int) : id of the stock the data is for
+        interval (str) : interval between stock price data values
+
+        Returns:
+        ----------
+        pd.DataFrame : data with key and request_id columns followed by
+            columns in stock_price_columns order
+        """
+
+        index = pd.DatetimeIndex(data.index)
+        if index.tz is None:
+            index = index.tz_localize(tz.tzlocal())
+        utc_time = index.tz_convert(pytz.UTC)
+
+        rows = data.reindex(columns=list(stock_price_columns.keys()))
+        rows.columns = list(stock_price_columns.values())
+        rows.index = utc_time
+
+        # Volume is a bigint column, but is float when it contains NaN
+        rows['volume'] = rows['volume'].round().astype('Int64')
+
+        rows.insert(0, 'request_id', request_id)
+        rows.insert(0, 'utc_time', utc_time)
+        rows.insert(0, 'interval', interval)
+        rows.insert(0, 'stock_id', stock_id)
+
+        return rows
+
     def insert_stock_price_to_database(self, data: pd.DataFrame, 
-                                       period: str, interval: str) -> None:
+                                       period: str, interval: str,
+                                       batch_size: int = None) -> dict:
+        """Insert stock price data into the stock price table
 
-        # Change download_stock_price_data so that this function
-        # can be replaced by calling add_dataframe_to_database
-        
-        # Get time
-        time = datetime.datetime.now()
-        time = self.time_to_utc(time)
-        time = str(time)
+        Log the request and upsert every row by stock_price_key (bulk
+        loaded with COPY), all inside a single transaction. Bars already
+        stored are updated rather than duplicated.
 
-        conn = None
+        Parameters:
+        ----------
+        data (pd.DataFrame) : price data indexed by time, as returned by yf.download
+        period (str) : period the data was downloaded for
+        interval (str) : interval between stock price data values
+        batch_size (int) : number of rows per COPY, defaults to a single COPY
 
-        # Insert request
-        try:
-            # Make connection
-            conn = connect()
-            cursor = conn.cursor()
+        Returns:
+        ----------
+        dict : number of rows inserted or updated, seconds taken and rows per second
+        """
 
-            # Insert row into stock database ----------
+        # Get time
+        request_time = datetime.datetime.now()
+        request_time = self.time_to_utc(request_time)
 
-            # Check if stock already in database
-            stock_id = self.stock_id
+        start = time.perf_counter()
 
-            # Add stock to db
-            if not stock_id:
-                # Add stock to db
-                add_stock_query = f"INSERT INTO {self.stock_table} (ticker) VALUES ('{self.ticker}')"
-                cursor.execute(add_stock_query)
-                conn.commit()
-                # Get id of added stock
-                stock_id_query = f"SELECT currval(pg_get_serial_sequence('{self.stock_table}','id'));"
-                cursor.execute(stock_id_query)
-                stock_id = cursor.fetchone()[0]
+        # Check if stock already in database
+        stock_id = self.stock_id
 
-            # Insert row into request database ---------
+        # Create the partitions the rows fall in, if partitioned
+        prepare_partitions(self.stock_price_table, data.index)
 
-            # Add request to db
-            request_type = 'stock_price'
-            row = (time, stock_id, period, interval, request_type)
-            columns = '(utc_time, stock_id, period, interval, request_type)'
-            request_query = f"INSERT INTO {self.request_table}{columns} VALUES {row}"
+        with self.write_connection() as conn:
+            cursor = conn.cursor()
 
-            cursor.execute(request_query)
-            print(f'Inserted row into {self.request_table}')
+            # Insert row into request database ---------
 
-            # Get row id for next query
-            get_request_id_query = f"SELECT currval(pg_get_serial_sequence('{self.request_table}','id'));"
-            cursor.execute(get_request_id_query)
+            request_query = f"""INSERT INTO {self.request_table}
+                                (utc_time, stock_id, period, interval, request_type)
+                                VALUES (%s, %s, %s, %s, %s)
+                                RETURNING id"""
+            cursor.execute(request_query, (request_time, stock_id, period, interval, 'stock_price'))
             request_id = cursor.fetchone()[0]
-
-            conn.commit()
+            self.freshness.record(cursor, stock_id, 'stock_price', request_time,
+                                  scope=price_scope(period, interval))
+            metrics.count('rows_written', table=self.request_table)
 
             # Insert rows into stock table -----------
 
-            columns_to_insert = '(request_id, utc_time, open, high, low, close, adj_close, volume)'
+            rows = self.format_price_data(data, request_id, stock_id, interval)
+            row_count = upsert_dataframe(cursor, rows, self.stock_price_table,
+                                         stock_price_key, batch_size=batch_size)
 
-            # Add rows into table
+            # Recompute the rolled up buckets containing the new bars
+            times = pd.DatetimeIndex(rows['utc_time']).as_unit('ns').asi8
+            update_rollups(stock_id, interval, times.min(), times.max(),
+                           stock_price_table=self.stock_price_table, exchange=self.exchange,
+                           cursor=cursor)
 
-            for row in data.iterrows():
-                
-                # Convert time to UTC and to string
-                local_time = row[0]
-                utc_time = self.time_to_utc(local_time)
-                string_time = str(utc_time)
+        # Append the new bars to (or invalidate) the cached history
+        update_price_cache(self.ticker, interval, rows, self.stock_price_table, self.exchange)
 
-                # Separate series object at index 1
-                row = row[1].values
+        seconds = time.perf_counter() - start
+        rows_per_second = row_count / seconds if seconds else 0.0
 
-                # Concatenate required values
-                values = [request_id, string_time] + list(row)
-                values = tuple(values)
+        metrics.event('prices_upserted', ticker=self.ticker, interval=interval, rows=row_count,
+                      seconds=seconds, rows_per_second=rows_per_second)
 
-                # Execute
-                cursor.execute(f'INSERT INTO {self.stock_price_table}{columns_to_insert} VALUES {values};')
-                conn.commit()
-            
-            print(f'Inserted #{len(data)} rows into {self.stock_price_table}')
-
-        except (Exception, psycopg2.DatabaseError) as error:
-            # Rollback changes if an error occurs
-            conn.rollback()
-            raise Exception(error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.commit()
-                conn.close()
-                print('Database closed')
+        return {'rows': row_count, 'seconds': seconds, 'rows_per_second': rows_per_second}
 
     def add_dataframe_to_database(self, df: pd.DataFrame, table_name: str, 
-                                  name : str = 'insert', identifier : dict = {}) -> None:
-        """
-        Dataframe must have same column names as database
+                                  name : str = 'insert', identifier : dict = {},
+                                  request_type: str = None) -> None:
+        """Write a dataframe to a table (see db_tools.write_dataframe)
+
+        Dataframe must have same column names as database. New columns
+        are added to the table and existing columns widened first.
+
+        Parameters:
+        ----------
+        df (pd.DataFrame) : data to write
+        table_name (str) : name of the table
+        name (str) : 'insert' the rows, or 'update' the row given by identifier
+        identifier (dict) : 'column' and 'value' of the row to update
+        request_type (str) : type of the request the data was fetched by,
+            logged (with its freshness) in the same transaction as the rows
         """
 
-        for index, row in df.iterrows():
-            row = row.to_dict()
-            row = {key: value for key, value in row.items() if value}
-            adjust_database_columns(row, table_name)
+        # Reconcile the table schema with the whole dataframe once
+        adjust_database_columns(df, table_name)
 
-        conn = None
+        # Resolve the id before taking a write connection (no nested checkout)
+        stock_id = self.stock_id if request_type else None
 
-        try:
-            # Connect to db
-            conn = connect()
+        with self.write_connection() as conn:
             cursor = conn.cursor()
+            write_dataframe(cursor, df, table_name, mode=name, identifier=identifier)
+            if request_type:
+                self.log_request(cursor, stock_id, request_type)
 
-            columns = list(df.columns)
-            columns = f"{tuple(columns)}"
-            columns = columns.replace("'", '"')
+    def add_documents_to_database(self, kind: str, rows: list, request_type: str = None) -> None:
+        """Write payloads as JSONB documents (see documents.write_documents)
 
-            for index, row in df.iterrows():
-                row = row.to_dict()
-                row = {key: value for key, value in row.items() if value}
+        Unlike add_dataframe_to_database, new fields never alter the table.
 
-                # adjust_database_columns(row, table_name)
+        Parameters:
+        ----------
+        kind (str) : 'stock_info' or 'stock_financials'
+        rows (list) : (tuple of key values, payload dict) of every document
+        request_type (str) : type of the request the payloads were fetched by,
+            logged (with its freshness) in the same transaction as the documents
+        """
 
-                values = f"{tuple(row.values())}"
-                columns = f"{tuple(row.keys())}"
+        stock_id = self.stock_id if request_type else None
 
-                columns = columns.replace("'", '"')
+        with self.write_connection() as conn:
+            cursor = conn.cursor()
+            write_documents(cursor, kind, rows, tables=self.tables)
+            if request_type:
+                self.log_request(cursor, stock_id, request_type)
 
-                query = ""
+    def log_request(self, cursor, stock_id: int, request_type: str) -> None:
+        """Log a request and record its freshness, in the transaction of cursor
 
-                if name == 'insert':
-                    query = f"INSERT INTO {table_name}{columns} VALUES {values};"
-                if name == 'update':
-                    query = f"""UPDATE {table_name}
-                                SET {columns} = {values}
-                                WHERE {identifier['column']} = {identifier['value']}"""
-                
-                if query:
-                    cursor.execute(query)
-            
-            print(f"Inserted {len(df.index)} rows into {table_name}")
-            
-        except (Exception, psycopg2.DatabaseError) as error:
-            conn.rollback()
-            raise Exception(error)
-        finally:
-            if conn:
-                conn.commit()
-                conn.close()
-                
-    def log_request_to_database(self, request_type: str) -> None:
-        """
+        Parameters:
+        ----------
+        cursor : psycopg2 cursor of the transaction storing the fetched data
+        stock_id (int) : id of the stock
+        request_type (str) : type of the request
         """
 
-        conn = None
+        utc_time = datetime.datetime.now(datetime.timezone.utc)
 
-        try:
-            # Connect to db
-            conn = connect()
-            cursor = conn.cursor()
-            
-            utc_time = datetime.datetime.now(datetime.timezone.utc)
-            utc_time = str(utc_time)
+        cursor.execute(f"""INSERT INTO {self.request_table} (stock_id, utc_time, request_type)
+                           VALUES (%s, %s, %s)""", (stock_id, utc_time, request_type))
+        self.freshness.record(cursor, stock_id, request_type, utc_time)
 
-            columns = "(stock_id, utc_time, request_type)"
-            values = (self.stock_id, utc_time, request_type)
+        metrics.count('rows_written', table=self.request_table)
 
-            request_query = f"INSERT INTO {self.request_table}{columns} VALUES {values};"
-            cursor.execute(request_query)
+    def log_request_to_database(self, request_type: str) -> None:
+        """Log a request in its own transaction (see log_request)
+        """
 
-            print(f"Inserted row into {self.request_table}")
+        # Resolve the id before taking a write connection (no nested checkout)
+        stock_id = self.stock_id
 
-        except (Exception, psycopg2.DatabaseError) as error:
-            conn.rollback()
-            raise Exception(error)
-        finally:
-            # Commiy and close
-            if conn:
-                conn.commit()
-                conn.close()
+        with self.write_connection() as conn:
+            self.log_request(conn.cursor(), stock_id, request_type)
 
     def delete_all_tables(self) -> None:
         """Delete all tables from db"""
 
         # In order of deletion
-        tables = [self.stock_financials_table, self.stock_actions_table,
-                  self.stock_holders_table, self.stock_price_table, 
+        tables = [f'{self.request_table}_freshness',
+                  f'{self.stock_table}_info_document',
+                  f'{self.stock_financials_table}_document',
+                  self.stock_financials_table, self.stock_actions_table,
+                  self.stock_holders_table, f'{self.stock_price_table}_rollup',
+                  f'{self.stock_price_table}_indicator_state',
+                  f'{self.stock_price_table}_indicator',
+                  self.stock_price_table, 
                   self.request_table, self.stock_table]
 
-        conn = None
-
-        try:
-            conn = connect()
+        with connection() as conn:
             cursor = conn.cursor()
 
             for table in tables:
                 query = f"DROP TABLE IF EXISTS {table}"
                 cursor.execute(query)
-                print(f"Deleted table {table}")
-            
-            print(f"\nDeleted all tables")
-
-        except (Exception, psycopg2.DatabaseError) as error:
-            # Rollback changes if an error occurs
-            conn.rollback()
-            raise Exception(error)
-        finally:
-            # Commit and close
-            if conn:
-                conn.commit()
-                conn.close()
-                print("Database closed")
+                metrics.event('table_dropped', table=table)
+
+        # Recreate the tables on next use
+        forget_schema(self.tables)
+        cache = get_price_cache(self.stock_price_table)
+        if cache is not None:
+            cache.clear()
+        self.freshness.forget()
+        get_indicator_engine(self.stock_price_table).forget()
@@ -1,8 +1,515 @@
+import datetime
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from config import config
+import time_tools
+
+
+def easter(year: int) -> datetime.date:
+    '''Easter Sunday of a year (anonymous Gregorian algorithm)'''
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+def nth_weekday(year: int, month: int, weekday: int, n: int) -> datetime.date:
+    '''n-th (1 based, -1 for the last) weekday (Monday 0) of a month'''
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+def observed(day: datetime.date) -> datetime.date:
+    '''US observance: Saturday holidays move to Friday, Sunday holidays to Monday'''
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+def substitutes(days: list) -> list:
+    '''UK substitute days: holidays on a weekend (or on an earlier
+    holiday) move to the next free weekday'''
+    taken = []
+    for day in days:
+        while day.weekday() >= 5 or day in taken:
+            day += datetime.timedelta(days=1)
+        taken.append(day)
+    return taken
+
+def nyse_holidays(year: int) -> tuple:
+    """Holidays and early closes of a year under the NYSE rules
+
+    Returns:
+    ----------
+    tuple : (list of holidays, dict of early close date: local close time)
+    """
+
+    holidays = []
+    new_year = datetime.date(year, 1, 1)
+    # A Saturday New Year's Day is not observed (it would fall in the previous year)
+    if new_year.weekday() != 5:
+        holidays.append(observed(new_year))
+    holidays += [nth_weekday(year, 1, 0, 3),
+                 nth_weekday(year, 2, 0, 3),
+                 easter(year) - datetime.timedelta(days=2),
+                 nth_weekday(year, 5, 0, -1)]
+    if year >= 2022:
+        holidays.append(observed(datetime.date(year, 6, 19)))
+    thanksgiving = nth_weekday(year, 11, 3, 4)
+    holidays += [observed(datetime.date(year, 7, 4)),
+                 nth_weekday(year, 9, 0, 1),
+                 thanksgiving,
+                 observed(datetime.date(year, 12, 25))]
+
+    early_close = datetime.time(13, 0)
+    early_closes = {thanksgiving + datetime.timedelta(days=1): early_close}
+    # The days before Independence Day and Christmas, when Monday to Thursday
+    for day in [datetime.date(year, 7, 3), datetime.date(year, 12, 24)]:
+        if day.weekday() < 4:
+            early_closes[day] = early_close
+
+    return holidays, early_closes
+
+def lse_holidays(year: int) -> tuple:
+    """Holidays (England and Wales bank holidays) and early closes of a
+    year under the LSE rules
+
+    Returns:
+    ----------
+    tuple : (list of holidays, dict of early close date: local close time)
+    """
+
+    holidays = substitutes([datetime.date(year, 1, 1)])
+    holidays += [easter(year) - datetime.timedelta(days=2),
+                 easter(year) + datetime.timedelta(days=1),
+                 nth_weekday(year, 5, 0, 1),
+                 nth_weekday(year, 5, 0, -1),
+                 nth_weekday(year, 8, 0, -1)]
+    holidays += substitutes([datetime.date(year, 12, 25), datetime.date(year, 12, 26)])
+
+    early_close = datetime.time(12, 30)
+    early_closes = {day: early_close for day in [datetime.date(year, 12, 24), datetime.date(year, 12, 31)]
+                    if day.weekday() < 5}
+
+    return holidays, early_closes
+
+# Exchange of a stock when none is given (section of exchanges.ini)
+default_exchange = 'NYSE'
+
+# Name: function of a year returning its holidays and early closes
+holiday_rules = {'nyse': nyse_holidays,
+                 'lse': lse_holidays}
+
+
 class StockMarket:
+    '''
+    Trading calendar of a stock exchange
+
+    Holds the exchange timezone, session hours, early closes and holidays,
+    and answers calendar questions from memoized session tables: sorted
+    arrays of session open and close times (UTC, int64 nanoseconds), one
+    table per calendar year, kept in a per exchange LRU cache.
+    '''
+
+    # Number of yearly session tables kept per exchange
+    session_cache_size = 16
+
+    def __init__(self, name: str, timezone: str = 'UTC',
+                 open_time: datetime.time = datetime.time(9, 30),
+                 close_time: datetime.time = datetime.time(16, 0),
+                 holidays: list = None, early_closes: dict = None,
+                 weekmask: str = '1111100', rules: str = None) -> None:
+        """Initialise instance of StockMarket class
+
+        Parameters:
+        ----------
+        name (str) : name of the exchange
+        timezone (str) : timezone the session hours are given in
+        open_time (datetime.time) : local time the session opens
+        close_time (datetime.time) : local time the session closes
+        holidays (list) : dates (datetime.date or ISO strings) the exchange is
+            closed, besides those of the rules
+        early_closes (dict) : date: local close time of shortened sessions,
+            besides those of the rules
+        weekmask (str) : open days of the week, Monday first (numpy busday format)
+        rules (str) : key of holiday_rules generating the holidays and early
+            closes of every year, None for only the listed ones
+
+        Raises:
+        ----------
+        Exception : name is not a string
+        ValueError : rules is not a key of holiday_rules
+        """
 
-    def __init__(self, name: str):
         if type(name) != str:
             raise Exception(f'Type {type(name)} is not a string')
+        if rules is not None and rules not in holiday_rules:
+            raise ValueError(f'{rules} is not a holiday rule (rules: {list(holiday_rules)})')
         self.name = name
-    
-    
\ No newline at end of file
+        self.rules = rules
+
+        self.timezone = pytz.timezone(timezone)
+        self.open_time = open_time
+        self.close_time = close_time
+        self.weekmask = weekmask
+
+        self.holidays = np.array(sorted(str(day) for day in holidays or []),
+                                 dtype='datetime64[D]')
+        self.early_closes = {np.datetime64(str(day), 'D'): close
+                             for day, close in (early_closes or {}).items()}
+
+        self._session_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, name: str, filename: str = 'exchanges.ini') -> 'StockMarket':
+        """Create a StockMarket from its section of the exchanges file
+
+        Parameters:
+        ----------
+        name (str) : name of the exchange (section of the file)
+        filename (str) : name of the exchanges file
+
+        Returns:
+        ----------
+        StockMarket : exchange described by the section
+        """
+
+        params = config(filename=filename, section=name)
+
+        parse_time = lambda value: datetime.datetime.strptime(value.strip(), '%H:%M').time()
+        split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+
+        early_closes = dict()
+        for item in split(params.get('early_closes', '')):
+            day, close = item.split()
+            early_closes[day] = parse_time(close)
+
+        return cls(name,
+                   timezone=params.get('timezone', 'UTC'),
+                   open_time=parse_time(params.get('open_time', '09:30')),
+                   close_time=parse_time(params.get('close_time', '16:00')),
+                   holidays=split(params.get('holidays', '')),
+                   early_closes=early_closes,
+                   weekmask=params.get('weekmask', '1111100'),
+                   rules=params.get('rules') or None)
+
+    def _local_to_utc(self, days: np.ndarray, times: np.ndarray) -> np.ndarray:
+        '''
+        Convert local dates and times of day (timedelta64) to UTC nanoseconds
+        '''
+        local = pd.DatetimeIndex(days.astype('datetime64[ns]') + times.astype('timedelta64[ns]'))
+        return local.tz_localize(self.timezone).tz_convert(pytz.UTC).asi8
+
+    def _build_session_table(self, year: int) -> dict:
+        '''
+        Compute the sessions of one calendar year (local dates)
+        '''
+        # Holidays and early closes of the rules, then the listed ones
+        holidays = self.holidays
+        early_closes = dict()
+        if self.rules is not None:
+            rule_holidays, rule_early_closes = holiday_rules[self.rules](year)
+            holidays = np.concatenate([holidays, np.array([str(day) for day in rule_holidays],
+                                                          dtype='datetime64[D]')])
+            early_closes = {np.datetime64(str(day), 'D'): close
+                            for day, close in rule_early_closes.items()}
+        early_closes.update(self.early_closes)
+
+        days = np.arange(np.datetime64(f'{year}-01-01'), np.datetime64(f'{year + 1}-01-01'),
+                         dtype='datetime64[D]')
+        days = days[np.is_busday(days, weekmask=self.weekmask, holidays=holidays)]
+
+        to_delta = lambda time: np.timedelta64(time.hour * 60 + time.minute, 'm')
+
+        open_times = np.full(len(days), to_delta(self.open_time))
+        close_times = np.full(len(days), to_delta(self.close_time))
+        for day, close in early_closes.items():
+            close_times[days == day] = to_delta(close)
+
+        return {'date': days,
+                'open': self._local_to_utc(days, open_times),
+                'close': self._local_to_utc(days, close_times)}
+
+    def session_table(self, year: int) -> dict:
+        """Get the memoized session table of a calendar year
+
+        Parameters:
+        ----------
+        year (int) : calendar year (of the exchange's local dates)
+
+        Returns:
+        ----------
+        dict : 'date' (datetime64[D]), 'open' and 'close' (UTC int64 ns) arrays,
+            sorted by date
+        """
+
+        with self._cache_lock:
+            table = self._session_cache.get(year)
+            if table is not None:
+                self._session_cache.move_to_end(year)
+                return table
+
+        table = self._build_session_table(year)
+
+        with self._cache_lock:
+            self._session_cache[year] = table
+            self._session_cache.move_to_end(year)
+            while len(self._session_cache) > self.session_cache_size:
+                self._session_cache.popitem(last=False)
+
+        return table
+
+    def sessions_table(self, first_year: int, last_year: int) -> dict:
+        '''
+        Concatenate the session tables of a range of years
+        '''
+        tables = [self.session_table(year) for year in range(first_year, last_year + 1)]
+        if len(tables) == 1:
+            return tables[0]
+        return {key: np.concatenate([table[key] for table in tables]) for key in tables[0]}
+
+    def _local_year(self, timestamp: pd.Timestamp) -> int:
+        return timestamp.tz_convert(self.timezone).year
+
+    @staticmethod
+    def _to_utc(timestamp) -> pd.Timestamp:
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tz is None:
+            return timestamp.tz_localize(pytz.UTC)
+        return timestamp.tz_convert(pytz.UTC)
+
+    def is_trading_minute(self, timestamp) -> bool:
+        """Determine whether the exchange is open at a timestamp
+
+        Binary search of the session table of the timestamp's year.
+
+        Parameters:
+        ----------
+        timestamp : datetime or pd.Timestamp (naive timestamps are UTC)
+
+        Returns:
+        ----------
+        bool : True if the timestamp is within a session
+        """
+
+        timestamp = self._to_utc(timestamp)
+        table = self.session_table(self._local_year(timestamp))
+
+        value = timestamp.value
+        position = np.searchsorted(table['open'], value, side='right') - 1
+        return bool(position >= 0 and value < table['close'][position])
+
+    def is_trading_minutes(self, timestamps) -> np.ndarray:
+        """Vectorized is_trading_minute
+
+        Parameters:
+        ----------
+        timestamps : DatetimeIndex or array-like of timestamps (naive timestamps are UTC)
+
+        Returns:
+        ----------
+        np.ndarray : boolean mask, True where the exchange is open
+        """
+
+        timestamps = pd.DatetimeIndex(timestamps)
+        if timestamps.tz is None:
+            timestamps = timestamps.tz_localize(pytz.UTC)
+        if timestamps.empty:
+            return np.zeros(0, dtype=bool)
+
+        local_years = timestamps.tz_convert(self.timezone).year
+        table = self.sessions_table(local_years.min(), local_years.max())
+
+        values = timestamps.as_unit('ns').asi8
+        positions = np.searchsorted(table['open'], values, side='right') - 1
+        valid = positions >= 0
+        return valid & (values < table['close'][np.maximum(positions, 0)])
+
+    def session_opens(self, times: np.ndarray) -> np.ndarray:
+        """Find the open of the latest session opening at or before each time
+
+        Parameters:
+        ----------
+        times (np.ndarray) : UTC nanoseconds (int64)
+
+        Returns:
+        ----------
+        np.ndarray : UTC nanoseconds of the open, 0 (the epoch) for times
+            before the first session of the year before the earliest time
+        """
+
+        times = np.asarray(times, dtype=np.int64)
+        if not len(times):
+            return np.zeros(0, dtype=np.int64)
+
+        years = pd.DatetimeIndex([times.min(), times.max()], tz=pytz.UTC).tz_convert(self.timezone).year
+        table = self.sessions_table(years[0] - 1, years[1])
+
+        positions = np.searchsorted(table['open'], times, side='right') - 1
+        return np.where(positions >= 0, table['open'][np.maximum(positions, 0)], 0)
+
+    def sessions_between(self, start, end) -> pd.DataFrame:
+        """List the sessions overlapping a time range
+
+        Parameters:
+        ----------
+        start : start of the range (naive timestamps are UTC)
+        end : end of the range, exclusive
+
+        Returns:
+        ----------
+        pd.DataFrame : one row per session with date, open and close (UTC) columns
+        """
+
+        start = self._to_utc(start)
+        end = self._to_utc(end)
+
+        table = self.sessions_table(self._local_year(start), self._local_year(end))
+
+        # Sessions closing after the start and opening before the end
+        first = np.searchsorted(table['close'], start.value, side='right')
+        last = np.searchsorted(table['open'], end.value, side='left')
+
+        return pd.DataFrame({
+            'date': table['date'][first:last],
+            'open': pd.DatetimeIndex(table['open'][first:last], tz=pytz.UTC),
+            'close': pd.DatetimeIndex(table['close'][first:last], tz=pytz.UTC)
+        })
+
+    def bar_labels(self, dates: np.ndarray, interval: str) -> np.ndarray:
+        '''
+        Local dates labelling the bars of an interval of a day or more
+        that sessions on dates (datetime64[D]) fall in: the session date
+        for 1d, the Monday for 5d and 1wk, the first day of the month or quarter
+        '''
+        if interval == '1d':
+            return dates
+        if interval in ['5d', '1wk']:
+            # 1970-01-01 was a Thursday (weekday 3)
+            return dates - (dates.astype(np.int64) + 3) % 7
+        months = dates.astype('datetime64[M]')
+        if interval == '3mo':
+            months = months - months.astype(np.int64) % 3
+        return months.astype('datetime64[D]')
+
+    def bar_timestamps(self, period: str, interval: str, end=None) -> pd.DatetimeIndex:
+        """Start times of the completed bars of a period, as labelled by yfinance
+
+        Intraday bars start at the session open and every interval after it
+        until the close. Bars of a day or more are labelled with local
+        midnight of their (first) session date. Only bars finished by end
+        are included, so a range of stored bars is complete at any time of day.
+
+        Periods of one to five days count sessions (as yfinance does), longer
+        periods calendar time.
+
+        Parameters:
+        ----------
+        period (str) : period of the bars (key of time_tools.period_dict)
+        interval (str) : interval between bars (key of time_tools.interval_dict)
+        end : end of the period (naive timestamps are UTC), defaults to now
+
+        Returns:
+        ----------
+        pd.DatetimeIndex : sorted UTC start times
+        """
+
+        end = pd.Timestamp.now(tz=pytz.UTC) if end is None else self._to_utc(end)
+        period_seconds = time_tools.period_dict[period]
+        interval_seconds = time_tools.interval_dict[interval]
+        interval_ns = interval_seconds * time_tools.second_ns
+
+        if time_tools.day_denom <= period_seconds < 7 * time_tools.day_denom:
+            days = period_seconds // time_tools.day_denom
+            # Sessions opened by the end (its own may still be running)
+            sessions = self.sessions_between(end - pd.Timedelta(days=2 * days + 10), end)
+            sessions = sessions.iloc[-days:]
+            start = sessions['open'].iloc[0] if len(sessions) else end
+        else:
+            start = end - pd.Timedelta(seconds=period_seconds)
+            sessions = self.sessions_between(start, end)
+
+        if interval_seconds < time_tools.day_denom:
+            opens = sessions['open'].array.asi8
+            closes = sessions['close'].array.asi8
+            counts = -((opens - closes) // interval_ns)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            bars = np.repeat(opens, counts) + offsets * interval_ns
+            # The last bar of a session ends at the close
+            bar_ends = np.minimum(bars + interval_ns, np.repeat(closes, counts))
+            bars = bars[(bars >= start.value) & (bar_ends <= end.value)]
+            return pd.DatetimeIndex(bars, tz=pytz.UTC)
+
+        midnight = lambda days: self._local_to_utc(days, np.zeros(len(days), dtype='timedelta64[m]'))
+        dates = sessions['date'].to_numpy().astype('datetime64[D]')
+
+        if interval == '1d':
+            # A daily bar is complete once its session has closed
+            labels = dates[sessions['close'].array.asi8 <= end.value]
+        else:
+            # A longer bar is complete once the next one has begun
+            labels = np.unique(self.bar_labels(dates, interval))
+            step = {'5d': 7, '1wk': 7, '1mo': 31, '3mo': 92}[interval]
+            next_labels = self.bar_labels(labels + np.timedelta64(step, 'D'), interval)
+            labels = labels[midnight(next_labels) <= end.value]
+
+        return pd.DatetimeIndex(midnight(labels), tz=pytz.UTC)
+
+    def bars_between(self, start, end, interval: str) -> pd.DatetimeIndex:
+        """Start times of the completed bars starting in [start, end)
+
+        Parameters:
+        ----------
+        start : start of the range (naive timestamps are UTC)
+        end : end of the range, exclusive
+        interval (str) : interval between bars (key of time_tools.interval_dict)
+
+        Returns:
+        ----------
+        pd.DatetimeIndex : sorted UTC start times
+        """
+
+        start = self._to_utc(start)
+        end = self._to_utc(end)
+
+        # Smallest period reaching back to start
+        seconds = (end - start).total_seconds() + time_tools.day_denom
+        covering = [name for name, length in time_tools.period_dict.items() if length >= seconds]
+        period = min(covering, key=time_tools.period_dict.get) if covering else '10y'
+
+        timestamps = self.bar_timestamps(period, interval, end=end)
+        return timestamps[(timestamps >= start) & (timestamps < end)]
+
+
+_markets = dict()
+_markets_lock = threading.Lock()
+
+def get_market(name: str, filename: str = 'exchanges.ini') -> StockMarket:
+    '''
+    Get the shared StockMarket of an exchange, so every caller
+    uses the same memoized session tables (the exchanges file is
+    looked up next to this module if not in the working directory)
+    '''
+    if not os.path.exists(filename):
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+    with _markets_lock:
+        if name not in _markets:
+            _markets[name] = StockMarket.from_config(name, filename=filename)
+        return _markets[name]
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the package are imported by name, as when run from Stocks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+
+@pytest.fixture(autouse=True, scope='session')
+def isolated(tmp_path_factory):
+    '''Run from an empty directory, so no database.ini is read (every
+    optional section takes its default) and no cache files are left behind'''
+    directory = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('stocks'))
+    metrics.set_sinks([])
+    yield
+    os.chdir(directory)
+
+@pytest.fixture(scope='session')
+def postgres():
+    """Process-wide pool connected to a throwaway PostgreSQL server
+    (skips the test if neither initdb nor pgserver is available)
+    """
+
+    import connect
+    from benchmark import throwaway_postgres
+
+    server = throwaway_postgres()
+    try:
+        params = server.__enter__()
+    except Exception as error:
+        pytest.skip(f'No throwaway PostgreSQL server: {error}')
+
+    # Statements are counted whenever a test adds a sink
+    connect.set_pool(connect.ConnectionPool(minconn=1, maxconn=8,
+                                            cursor_factory=metrics.MetricsCursor, **params))
+    try:
+        yield params
+    finally:
+        connect.close_pool()
+        server.__exit__(None, None, None)
+
+@pytest.fixture
+def sink():
+    """MemorySink receiving the metrics recorded during the test"""
+    sink = metrics.MemorySink()
+    metrics.add_sink(sink)
+    yield sink
+    metrics.remove_sink(sink)
@@ -0,0 +1,92 @@
+import pytest
+
+from catalog import Catalog, column_type
+from connect import connection
+
+
+def execute(query: str, params: tuple = None) -> list:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall() if cursor.description else []
+
+@pytest.fixture
+def table(postgres, request):
+    '''Name of a table dropped after the test'''
+    name = f'test_{request.node.name}'.lower()[:60]
+    execute(f'DROP TABLE IF EXISTS {name}')
+    yield name
+    execute(f'DROP TABLE IF EXISTS {name}')
+
+
+def test_column_types_are_written_as_created():
+    assert column_type('character varying', 255) == 'varchar(255)'
+    assert column_type('character varying', None) is None
+    assert column_type('double precision', None) == 'double precision'
+
+def test_columns_match_the_information_schema(table, sink):
+    execute(f'CREATE TABLE {table} (id serial, name varchar(255), note varchar, price double precision)')
+    catalog = Catalog(max_age=None)
+
+    sink.reset()
+    # Unbounded varchar is left out, as the writer never creates one
+    assert catalog.column_types(table) == {'id': 'integer', 'name': 'varchar(255)',
+                                           'price': 'double precision'}
+    assert sink.total('catalog_loads', scope='all') == 1
+    rows = execute("""SELECT column_name, data_type, character_maximum_length
+                      FROM information_schema.columns WHERE table_name = %s
+                      ORDER BY ordinal_position""", (table,))
+    assert [(column, column_type(data_type, length)) for column, data_type, length in rows] == \
+        [('id', 'integer'), ('name', 'varchar(255)'), ('note', None), ('price', 'double precision')]
+
+    # Cached until forgotten
+    assert list(catalog.column_types(table)) == ['id', 'name', 'price']
+    assert sink.total('catalog_loads') == 1 and sink.total('catalog_hits') == 1
+
+    execute(f'ALTER TABLE {table} ADD COLUMN volume bigint')
+    assert 'volume' not in catalog.column_types(table)
+    catalog.forget(table)
+    assert catalog.column_types(table)['volume'] == 'bigint'
+    assert sink.total('catalog_loads') == 2
+
+def test_expired_catalog_is_read_again(table, sink):
+    execute(f'CREATE TABLE {table} (id integer)')
+    catalog = Catalog(max_age=0)
+    catalog.column_types(table)
+
+    # Another process altering the table is seen once max_age has passed
+    execute(f'ALTER TABLE {table} ADD COLUMN price real')
+    sink.reset()
+    assert catalog.column_types(table) == {'id': 'integer', 'price': 'real'}
+    assert sink.total('catalog_loads') == 1
+
+def test_own_ddl_updates_the_cache_without_reading_it(table, sink):
+    execute(f'CREATE TABLE {table} (id integer)')
+    catalog = Catalog(max_age=None)
+    catalog.column_types(table)
+
+    execute(f'ALTER TABLE {table} ADD COLUMN price double precision')
+    catalog.update(table, {'price': 'double precision'})
+    sink.reset()
+    assert catalog.column_types(table) == {'id': 'integer', 'price': 'double precision'}
+    assert sink.total('catalog_loads') == 0
+
+def test_reload_reads_one_table_in_the_callers_transaction(table, sink):
+    catalog = Catalog(max_age=None)
+    catalog.load()
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'CREATE TABLE {table} (id integer)')
+        sink.reset()
+        assert catalog.reload(cursor, table) == {'id': 'integer'}
+        assert sink.total('catalog_loads', scope='table') == 1
+
+    sink.reset()
+    assert catalog.column_types(table) == {'id': 'integer'}
+    assert sink.total('catalog_loads') == 0
+
+    # A dropped table is removed from the cache
+    execute(f'DROP TABLE {table}')
+    with connection() as conn:
+        assert catalog.reload(conn.cursor(), table) == {}
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import connect
+from connect import ConnectionPool, PoolTimeout
+
+
+def test_connection_commits_and_rolls_back(postgres):
+    pool = ConnectionPool(minconn=0, maxconn=2, **postgres)
+    try:
+        with pool.connection() as conn:
+            conn.cursor().execute('CREATE TABLE IF NOT EXISTS pool_test (value integer)')
+        with pytest.raises(RuntimeError):
+            with pool.connection() as conn:
+                conn.cursor().execute('INSERT INTO pool_test VALUES (1)')
+                raise RuntimeError('rolled back')
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT count(*) FROM pool_test')
+            assert cursor.fetchone()[0] == 0
+            cursor.execute('DROP TABLE pool_test')
+
+        statistics = pool.statistics()
+        assert statistics['connections_created'] == 1
+        assert statistics['checkouts'] == 3
+        assert statistics['in_use'] == 0
+    finally:
+        pool.closeall()
+
+def test_exhausted_pool_times_out(postgres):
+    pool = ConnectionPool(minconn=0, maxconn=1, timeout=0.1, **postgres)
+    try:
+        conn = pool.getconn()
+        with pytest.raises(PoolTimeout):
+            pool.getconn()
+        pool.putconn(conn)
+        pool.putconn(pool.getconn())
+        assert pool.statistics()['timeouts'] == 1
+    finally:
+        pool.closeall()
+
+def test_checkouts_do_not_wait_behind_a_connect(postgres, monkeypatch):
+    pool = ConnectionPool(minconn=1, maxconn=2, **postgres)
+    idle = pool.getconn()
+
+    connecting = threading.Event()
+    slow_connect = psycopg2.connect
+
+    def connect_slowly(**params):
+        connecting.set()
+        time.sleep(0.5)
+        return slow_connect(**params)
+
+    monkeypatch.setattr(connect.psycopg2, 'connect', connect_slowly)
+    opened = []
+    opener = threading.Thread(target=lambda: opened.append(pool.getconn()))
+    opener.start()
+    try:
+        assert connecting.wait(5)
+
+        # Returning and checking out the idle connection need not wait
+        start = time.monotonic()
+        pool.putconn(idle)
+        conn = pool.getconn()
+        assert time.monotonic() - start < 0.25
+        pool.putconn(conn)
+    finally:
+        opener.join()
+        pool.putconn(opened[0])
+        pool.closeall()
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from connect import connection
+from db_tools import copy_dataframe
+
+
+def fetch(query: str, params: tuple = None) -> list:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+@pytest.fixture
+def table(postgres, request):
+    '''Name of a table dropped after the test'''
+    name = f'test_{request.node.name}'.lower()[:60]
+    with connection() as conn:
+        conn.cursor().execute(f'DROP TABLE IF EXISTS {name}')
+    yield name
+    with connection() as conn:
+        conn.cursor().execute(f'DROP TABLE IF EXISTS {name}')
+
+
+def test_copy_writes_missing_values_as_null(table):
+    with connection() as conn:
+        conn.cursor().execute(f'CREATE TABLE {table} (name text, price double precision, volume bigint)')
+
+    df = pd.DataFrame({'name': ['a', 'b,"quoted"', None],
+                       'price': [1.5, np.nan, 3.0],
+                       'volume': pd.array([10, 20, None], dtype='Int64')})
+    with connection() as conn:
+        assert copy_dataframe(conn.cursor(), df, table, batch_size=2) == 3
+
+    assert fetch(f'SELECT name, price, volume FROM {table} ORDER BY volume NULLS LAST') == \
+        [('a', 1.5, 10), ('b,"quoted"', None, 20), (None, 3.0, None)]
+
+def test_copy_batches_share_the_transaction(table):
+    with connection() as conn:
+        conn.cursor().execute(f'CREATE TABLE {table} (value integer NOT NULL)')
+
+    # The second batch fails, so the first is rolled back with it
+    df = pd.DataFrame({'value': pd.array([1, 2, None], dtype='Int64')})
+    with pytest.raises(Exception):
+        with connection() as conn:
+            copy_dataframe(conn.cursor(), df, table, batch_size=2)
+
+    assert fetch(f'SELECT count(*) FROM {table}') == [(0,)]
+
+def column_types(table: str) -> dict:
+    from catalog import column_type
+    rows = fetch("""SELECT column_name, data_type, character_maximum_length
+                    FROM information_schema.columns WHERE table_name = %s""", (table,))
+    return {column: column_type(data_type, length) for column, data_type, length in rows}
+
+def test_adjust_adds_and_widens_columns_in_one_alter(table, sink):
+    from catalog import get_catalog
+    from db_tools import adjust_database_columns
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""CREATE TABLE {table} (volume smallint, price real,
+                                                 empty integer, label integer)""")
+        cursor.execute(f"INSERT INTO {table} VALUES (1, 1.5, NULL, 7)")
+    get_catalog().forget(table)
+
+    df = pd.DataFrame({'volume': [100000],            # widened to integer
+                       'price': [0.1],                # widened to double precision
+                       'empty': ['text'],             # only nulls: takes the data's type
+                       'label': ['name'],             # holds data: falls back to text
+                       'added': [True]})              # added
+    sink.reset()
+    adjust_database_columns(df, table)
+
+    assert column_types(table) == {'volume': 'integer', 'price': 'double precision',
+                                   'empty': 'varchar(255)', 'label': 'text', 'added': 'boolean'}
+    assert sink.total('sql_statements', kind='ALTER') == 1
+
+    # The data fits the table now, so adjusting again runs no query
+    sink.reset()
+    adjust_database_columns(df, table)
+    assert sink.total('sql_statements') == 0
+
+def test_inferred_types_hold_the_data(table):
+    from db_tools import get_dataframe_types
+
+    df = pd.DataFrame({'small': [1, -2],
+                       'large': [1, 2**40],
+                       'single': np.array([0.5, 1.25], dtype=np.float64),
+                       'double': [0.1, 1.0],
+                       'flag': [True, False],
+                       'number': ['12', ' -3'],
+                       'decimal': ['1.5', '2'],
+                       'answer': ['yes', 'No'],
+                       'name': ['a', 'b'],
+                       'long': ['x' * 300, 'y'],
+                       'time': pd.to_datetime(['2026-10-16 14:30', '2026-10-16 15:30'], utc=True),
+                       'missing': [None, None]})
+    types = get_dataframe_types(df)
+
+    assert types == {'small': 'smallint', 'large': 'bigint', 'single': 'real',
+                     'double': 'double precision', 'flag': 'boolean', 'number': 'smallint',
+                     'decimal': 'real', 'answer': 'boolean', 'name': 'varchar(255)',
+                     'long': 'text', 'time': 'timestamp with time zone'}
+    # Merged with the existing types, columns are only ever widened
+    assert get_dataframe_types(df[['small', 'single']], {'small': 'integer', 'single': 'double precision'}) == \
+        {'small': 'integer', 'single': 'double precision'}
+
+    # Every value round-trips through a table created with the inferred types
+    columns = [column for column in types if column not in ('number', 'decimal', 'answer')]
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE TABLE {table} ({', '.join(f'{column} {types[column]}' for column in columns)})")
+        copy_dataframe(cursor, df[columns], table)
+
+    rows = fetch(f"SELECT {', '.join(columns)} FROM {table} ORDER BY small DESC")
+    assert [list(row[:-1]) for row in rows] == df[columns[:-1]].values.tolist()
+    assert [row[-1] for row in rows] == list(df['time'].dt.to_pydatetime())
+
+def test_upsert_updates_rows_with_the_same_key(table):
+    from db_tools import upsert_dataframe
+
+    with connection() as conn:
+        conn.cursor().execute(f'CREATE TABLE {table} (id integer, time bigint, value real, UNIQUE (id, time))')
+
+    df = pd.DataFrame({'id': [1, 1, 2], 'time': [10, 20, 10], 'value': [1.0, 2.0, 3.0]})
+    with connection() as conn:
+        assert upsert_dataframe(conn.cursor(), df, table, ['id', 'time']) == 3
+
+    # Repeated keys keep their last row, existing keys are updated
+    df = pd.DataFrame({'id': [1, 2, 2, 3], 'time': [20, 10, 10, 10], 'value': [5.0, 6.0, 7.0, 8.0]})
+    with connection() as conn:
+        assert upsert_dataframe(conn.cursor(), df, table, ['id', 'time'], batch_size=2) == 3
+
+    assert fetch(f'SELECT id, time, value FROM {table} ORDER BY id, time') == \
+        [(1, 10, 1.0), (1, 20, 5.0), (2, 10, 7.0), (3, 10, 8.0)]
+
+def test_binary_copy_parses_columns_across_chunks(table):
+    from db_tools import BinaryCopyReader, copy_to_arrays
+
+    with connection() as conn:
+        conn.cursor().execute(f"""CREATE TABLE {table} AS
+                SELECT timestamptz '2026-10-16 13:30+00' + value * interval '1 minute' AS time,
+                       value::bigint AS volume,
+                       CASE WHEN value % 7 = 0 THEN NULL ELSE value / 4.0 END::double precision AS price
+                FROM generate_series(1, 1000) AS value""")
+
+    query = f"SELECT time, volume, COALESCE(price, 'NaN') FROM {table} ORDER BY time"
+    types = ['timestamp with time zone', 'bigint', 'double precision']
+    with connection() as conn:
+        times, volumes, prices = copy_to_arrays(conn.cursor(), query, types)
+
+        # Rows split across the chunks written by the server parse the same
+        reader = BinaryCopyReader(types, chunk_size=100)
+        conn.cursor().copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", reader)
+        columns = reader.columns()
+
+    values = np.arange(1, 1001)
+    assert times.dtype == volumes.dtype == np.int64
+    np.testing.assert_array_equal(times, pd.Timestamp('2026-10-16 13:30', tz='UTC').value + values * 60 * 10**9)
+    np.testing.assert_array_equal(volumes, values)
+    np.testing.assert_array_equal(prices, np.where(values % 7 == 0, np.nan, values / 4))
+    for column, expected in zip(columns, [times, volumes, prices]):
+        np.testing.assert_array_equal(column, expected)
+
+    # A NULL changes the size of a row, so it is rejected
+    with pytest.raises(ValueError):
+        with connection() as conn:
+            copy_to_arrays(conn.cursor(), f'SELECT time, volume, price FROM {table}', types)
+
+def test_writes_reuse_statements_prepared_per_connection(table, sink):
+    from db_tools import adjust_database_columns, write_dataframe
+
+    with connection() as conn:
+        conn.cursor().execute(f'CREATE TABLE {table} (id integer, name text, price real)')
+
+    df = pd.DataFrame({'id': [1, 2, 3], 'name': ["O'Brien", 'b', None], 'price': [1.5, np.nan, 2.5]})
+
+    sink.reset()
+    with connection() as conn:
+        cursor = conn.cursor()
+        # Three sets of present columns: (id, name, price), (id, name) and (id, price)
+        assert write_dataframe(cursor, df, table) == 3
+        assert write_dataframe(cursor, df, table) == 3
+    assert sink.total('statements_prepared') == 3
+
+    # Rows leave out their missing values, and quotes need no escaping
+    assert fetch(f'SELECT DISTINCT id, name, price FROM {table} ORDER BY id') == \
+        [(1, "O'Brien", 1.5), (2, 'b', None), (3, None, 2.5)]
+
+    # Update mode, with statements prepared again once the columns change
+    adjust_database_columns(pd.DataFrame({'price': [0.1]}), table)
+    sink.reset()
+    with connection() as conn:
+        write_dataframe(conn.cursor(), pd.DataFrame({'price': [0.1]}), table, mode='update',
+                        identifier={'column': 'id', 'value': 1})
+    assert sink.total('statements_prepared') == 1
+    assert fetch(f'SELECT price FROM {table} WHERE id = 1') == [(0.1,), (0.1,)]
+
+    with pytest.raises(ValueError):
+        write_dataframe(None, df, table, mode='update')
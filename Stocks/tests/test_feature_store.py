@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from connect import connection
+from feature_store import FeatureStore
+from providers import SyntheticProvider
+
+end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+
+
+def test_blocks_are_rebuilt_only_when_their_sources_change(postgres, tmp_path):
+    from stock import Stock
+
+    tables = {f'{role}_table': f'feat_{role}'
+              for role in ['request', 'stock', 'stock_price', 'stock_financials',
+                           'stock_actions', 'stock_holders']}
+    provider = SyntheticProvider()
+    stock = Stock('FEAT', **tables)
+    stock.provider = provider
+    stock.response_cache = None
+    try:
+        data = provider.download('FEAT', period='3mo', interval='1d', end=end)
+        stock.insert_stock_price_to_database(data.iloc[:-5], '3mo', '1d')
+        stock.download_stock_info()
+        stock.download_stock_financials()
+        stock.download_stock_actions()
+
+        store = FeatureStore(str(tmp_path), interval='1d', rollup=False, tables=stock.tables)
+        assert store.build(['FEAT', 'NONE']) == {'FEAT': 'rebuilt', 'NONE': 'missing'}
+
+        features = store.features
+        times, matrix = store.load('FEAT')
+        assert list(times) == list(data.index[:-5].as_unit('ns').asi8)
+        assert matrix.shape == (len(times), len(features))
+        np.testing.assert_allclose(matrix[:, features.index('price.close')],
+                                   data['Close'].iloc[:-5], rtol=1e-6)
+        # Every bar follows the latest report, and carries the stock info
+        latest = provider.financials('FEAT').iloc[:, 0]
+        np.testing.assert_allclose(matrix[:, features.index('financials.item_0')],
+                                   latest['Item 0'], rtol=1e-6)
+        np.testing.assert_allclose(matrix[:, features.index('info.field0')],
+                                   provider.info('FEAT')['field0'], rtol=1e-6)
+
+        assert store.build(['FEAT']) == {'FEAT': 'unchanged'}
+
+        stock.insert_stock_price_to_database(data, '3mo', '1d')
+        assert store.build(['FEAT']) == {'FEAT': 'rebuilt'}
+        tickers, times, matrix = store.matrix()
+        assert len(times) == len(data.index) and set(tickers) == {'FEAT'}
+    finally:
+        stock.delete_all_tables()
+
+
+def test_jsonb_storage_features_come_from_the_documents(postgres, tmp_path):
+    from stock import Stock
+
+    tables = {f'{role}_table': f'featdoc_{role}'
+              for role in ['request', 'stock', 'stock_price', 'stock_financials',
+                           'stock_actions', 'stock_holders']}
+    provider = SyntheticProvider()
+    stock = Stock('FEAT', storage='jsonb', **tables)
+    stock.provider = provider
+    stock.response_cache = None
+    try:
+        data = provider.download('FEAT', period='3mo', interval='1d', end=end)
+        stock.insert_stock_price_to_database(data, '3mo', '1d')
+        stock.download_stock_info()
+        stock.download_stock_financials()
+
+        # The info document is stored with ticker, as the stock table is
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT payload FROM {stock.stock_table}_info_document")
+            (payload,), = cursor.fetchall()
+        assert payload['ticker'] == 'FEAT' and 'symbol' not in payload
+
+        store = FeatureStore(str(tmp_path), interval='1d', rollup=False,
+                             tables=stock.tables, storage='jsonb')
+        assert store.build(['FEAT']) == {'FEAT': 'rebuilt'}
+
+        features = store.features
+        times, matrix = store.load('FEAT')
+        latest = provider.financials('FEAT').iloc[:, 0]
+        np.testing.assert_allclose(matrix[:, features.index('financials.item_0')],
+                                   latest['Item 0'], rtol=1e-6)
+        np.testing.assert_allclose(matrix[:, features.index('info.field0')],
+                                   provider.info('FEAT')['field0'], rtol=1e-6)
+    finally:
+        stock.delete_all_tables()
+
+
+def test_unknown_storage_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        FeatureStore(str(tmp_path), storage='parquet')
@@ -0,0 +1,24 @@
+import datetime
+
+import freshness
+from freshness import load_ttls, reload_ttls
+
+
+def test_ttls_are_read_once(tmp_path):
+    path = tmp_path / 'settings.ini'
+    path.write_text('[freshness]\nstock_price = 120\n')
+
+    ttls = load_ttls(str(path))
+    path.write_text('[freshness]\nstock_price = 300\n')
+
+    assert ttls['stock_price'] == datetime.timedelta(seconds=120)
+    assert ttls['stock_financials'] == datetime.timedelta(seconds=86400)
+    assert load_ttls(str(path)) == ttls
+
+    reload_ttls()
+    assert load_ttls(str(path))['stock_price'] == datetime.timedelta(seconds=300)
+
+def test_ttls_are_copies():
+    load_ttls()['stock_price'] = datetime.timedelta(0)
+
+    assert load_ttls()['stock_price'] == datetime.timedelta(seconds=freshness.default_ttls['stock_price'])
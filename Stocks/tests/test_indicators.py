@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from indicators import EMA, SMA, Indicator
+from providers import SyntheticProvider
+
+end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+
+
+def test_added_indicator_leaves_the_others_incremental(postgres):
+    from stock import Stock
+
+    stock = Stock('IND')
+    data = SyntheticProvider().download('IND', period='5d', interval='1h', end=end)
+    first, second = data.iloc[:20], data.iloc[20:]
+
+    stock.insert_stock_price_to_database(first, '5d', '1h')
+    assert stock.update_indicators('1h', [SMA(5)]) == {'sma(5)': 20}
+
+    # Only the new bars are computed for SMA, the full history for EMA
+    stock.insert_stock_price_to_database(second, '5d', '1h')
+    counts = stock.update_indicators('1h', [SMA(5), EMA(5)])
+    assert counts == {'sma(5)': len(second.index), 'ema(5)': len(data.index)}
+    assert stock.update_indicators('1h', [SMA(5), EMA(5)]) == {'sma(5)': 0, 'ema(5)': 0}
+
+    closes = data['Close'].to_numpy()
+    np.testing.assert_allclose(stock.load_indicator(SMA(5), '1h')['value'].to_numpy(),
+                               pd.Series(closes).rolling(5).mean().to_numpy())
+    np.testing.assert_allclose(stock.load_indicator(EMA(5), '1h')['value'].to_numpy(),
+                               pd.Series(closes).ewm(span=5, adjust=False).mean().to_numpy())
+
+def test_indicators_must_define_update():
+    class Unfinished(Indicator):
+        name = 'unfinished'
+
+    with pytest.raises(TypeError):
+        Unfinished()
@@ -0,0 +1,56 @@
+import pandas as pd
+
+from connect import connection
+import partitions
+from partitions import PartitionManager
+
+
+def test_price_table_is_partitioned_by_month(postgres):
+    from providers import SyntheticProvider
+    from stock import Stock
+
+    tables = {f'{role}_table': f'part_{role}'
+              for role in ['request', 'stock', 'stock_price', 'stock_financials',
+                           'stock_actions', 'stock_holders']}
+    manager = PartitionManager(table='part_stock_price', span='month', premake=1,
+                               retention=2, expire='detach')
+    partitions._managers['part_stock_price'] = manager
+    try:
+        stock = Stock('PART', **tables)
+        data = SyntheticProvider().download('PART', period='3mo', interval='1d',
+                                            end='2026-10-16 21:00+00:00')
+        stock.insert_stock_price_to_database(data, '3mo', '1d')
+        # Loading the same bars again updates them through the partitioned unique index
+        stock.insert_stock_price_to_database(data, '3mo', '1d')
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            assert manager.is_partitioned(cursor)
+            spans = manager.partitions(cursor)
+            cursor.execute("""SELECT tableoid::regclass::text, count(*) FROM part_stock_price
+                              GROUP BY 1""")
+            stored = dict(cursor.fetchall())
+
+        assert sum(stored.values()) == len(data.index)
+        # Every bar is in the partition of its month
+        for timestamp in data.index:
+            name = manager.partition_name(manager.span_start(timestamp))
+            start, end = spans[name]
+            assert start <= timestamp < end
+        assert set(stored) <= set(spans)
+
+        # Partitions older than the retention are detached with their rows
+        with connection() as conn:
+            expired = manager.maintain(conn.cursor(), now=pd.Timestamp('2026-10-20', tz='UTC'))['expired']
+        assert expired == ['part_stock_price_p20260701']
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT count(*) FROM part_stock_price")
+            assert cursor.fetchone()[0] == sum(stored.values()) - stored[expired[0]]
+            cursor.execute(f"SELECT count(*) FROM {expired[0]}_detached")
+            assert cursor.fetchone()[0] == stored[expired[0]]
+    finally:
+        stock.delete_all_tables()
+        with connection() as conn:
+            conn.cursor().execute("DROP TABLE IF EXISTS part_stock_price_p20260701_detached")
+        del partitions._managers['part_stock_price']
@@ -0,0 +1,50 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from planner import plan_download
+from stock_market import get_market
+
+
+@pytest.mark.parametrize('end', ['2026-10-16 15:07',   # during a session
+                                 '2026-10-16 21:00',   # after the close
+                                 '2026-10-18 12:00'])  # on a weekend
+@pytest.mark.parametrize('period, interval', [('5d', '1m'), ('1mo', '1h'), ('3mo', '1d')])
+def test_complete_stored_range_plans_nothing(end, period, interval):
+    market = get_market('NYSE')
+    end = pd.Timestamp(end, tz='UTC')
+    stored = market.bar_timestamps(period, interval, end=end)
+
+    plan = plan_download('SYN', period, interval, stored, end=end, market=market)
+
+    assert plan.expected_bars > 0
+    assert plan.missing_ranges == []
+    assert plan.requests_saved == 1
+
+def test_missing_bars_become_one_range():
+    market = get_market('NYSE')
+    end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+    expected = market.bar_timestamps('5d', '1m', end=end)
+    stored = expected[:100].append(expected[200:])
+
+    plan = plan_download('SYN', '5d', '1m', stored, end=end, market=market)
+
+    assert plan.missing_ranges == [(expected[100], expected[199] + pd.Timedelta(minutes=1))]
+    assert plan.bars_saved == len(stored)
+
+def test_downloaded_period_is_complete(postgres):
+    from providers import SyntheticProvider
+    from stock import Stock
+
+    stock = Stock('PLAN', freshness_ttls={'stock_price': datetime.timedelta(0)})
+    stock.provider = SyntheticProvider()
+    stock.response_cache = None
+
+    plan = stock.download_stock_price_data(period='5d', interval='1m')
+    stored = stock.get_available_stock_timestamps('1m')
+
+    assert plan.is_full_period
+    assert plan.expected.isin(stored).all()
+    replan = plan_download(stock.ticker, '5d', '1m', stored, expected=plan.expected)
+    assert replan.missing_ranges == []
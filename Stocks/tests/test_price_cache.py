@@ -0,0 +1,107 @@
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+import price_cache
+from price_cache import PriceCache, cache_columns
+
+minute = 60 * 10**9
+
+
+def bars(times: list) -> dict:
+    times = np.asarray(times, dtype=np.int64)
+    return {column: times if column == 'utc_time' else times.astype(np.float64)
+            for column in cache_columns}
+
+class Store:
+    '''Stored bars of one (ticker, interval), counting the loads'''
+
+    def __init__(self, times: list) -> None:
+        self.times = list(times)
+        self.loads = 0
+
+    def load(self, start: int, end: int) -> dict:
+        self.loads += 1
+        return bars([time for time in self.times if start <= time < end])
+
+
+def test_open_ended_read_hits_until_newer_bars_are_written(tmp_path):
+    cache = PriceCache(str(tmp_path))
+    now = time.time_ns() // minute * minute
+    store = Store([now - 3 * minute, now - 2 * minute])
+
+    first = cache.read('SYN', '1m', 0, None, store.load)
+    later = cache.read('SYN', '1m', 0, time.time_ns() + minute, store.load)
+
+    assert store.loads == 1
+    assert list(first['utc_time']) == list(later['utc_time']) == store.times
+    assert cache.statistics()['hits'] == 1
+
+    # A bar following on from the cached range is appended
+    store.times.append(now - minute)
+    assert cache.update('SYN', '1m', bars([now - minute]))
+    assert list(cache.read('SYN', '1m', 0, None, store.load)['utc_time']) == store.times
+    assert store.loads == 1
+
+def utc(timestamp: str) -> int:
+    return pd.Timestamp(timestamp, tz='UTC').value
+
+def test_gap_after_cached_range_invalidates(tmp_path):
+    cache = PriceCache(str(tmp_path))
+    # A Thursday session of the NYSE (13:30 to 20:00 UTC)
+    last = utc('2026-10-15 15:00')
+    cache.put('SYN', '1m', bars([last]), 0, last + minute)
+
+    # Room for bars (e.g. written by another process) before the new one
+    assert not cache.update('SYN', '1m', bars([last + 3 * minute]))
+    assert cache.read_meta('SYN', '1m') is None
+
+def test_closed_market_gap_is_appended(tmp_path):
+    cache = PriceCache(str(tmp_path))
+
+    # Overnight, then over a weekend: no session has bars in between
+    for last, first in [('2026-10-15 19:59', '2026-10-16 13:30'),
+                        ('2026-10-16 19:59', '2026-10-19 13:30')]:
+        cache.put('SYN', '1m', bars([utc(last)]), 0, utc(last) + minute)
+        assert cache.update('SYN', '1m', bars([utc(first)]))
+        assert cache.read_meta('SYN', '1m')['end'] == utc(first) + 1
+
+    # The daily bars of Friday and Monday follow on from each other
+    cache.put('SYN', '1d', bars([utc('2026-10-16 04:00')]), 0, utc('2026-10-16 04:00') + 1)
+    assert cache.update('SYN', '1d', bars([utc('2026-10-19 04:00')]))
+
+def test_past_range_is_not_extended(tmp_path):
+    cache = PriceCache(str(tmp_path))
+    store = Store([minute, 2 * minute, 5 * minute])
+
+    assert list(cache.read('SYN', '1m', 0, 3 * minute, store.load)['utc_time']) == [minute, 2 * minute]
+    # Bars after the end of a past range were stored before it was loaded
+    assert list(cache.read('SYN', '1m', 0, 6 * minute, store.load)['utc_time']) == store.times
+    assert store.loads == 2
+
+def test_stock_price_tables_are_cached_apart(postgres, tmp_path):
+    from providers import SyntheticProvider
+    from stock import Stock
+
+    tables = {f'{role}_table': f'cache_{role}'
+              for role in ['request', 'stock', 'stock_financials', 'stock_actions', 'stock_holders']}
+    tables['stock_price_table'] = 'cache_price'
+    cache = PriceCache(str(tmp_path / 'cache_price'))
+    price_cache.set_price_cache(cache, 'cache_price')
+    try:
+        stock = Stock('CACHE', freshness_ttls={'stock_price': datetime.timedelta(0)}, **tables)
+        stock.provider = SyntheticProvider()
+        stock.response_cache = None
+        stock.download_stock_price_data(period='5d', interval='1h')
+
+        history = stock.price_history('1h')
+        assert len(history['utc_time']) == len(stock.get_available_stock_timestamps('1h'))
+        assert cache.read_meta('CACHE', '1h') is not None
+        assert price_cache.get_price_cache('stock_price') is None
+
+        stock.delete_all_tables()
+        assert cache.entries() == []
+    finally:
+        price_cache.set_price_cache(None, 'cache_price')
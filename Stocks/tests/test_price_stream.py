@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from price_stream import iter_price_chunks
+from providers import SyntheticProvider
+from stock import Stock
+
+end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+
+
+@pytest.fixture(scope='module')
+def stored(postgres):
+    '''Hourly bars of two tickers'''
+    data = dict()
+    for ticker in ['STRA', 'STRB']:
+        data[ticker] = SyntheticProvider().download(ticker, period='1mo', interval='1h', end=end)
+        Stock(ticker).insert_stock_price_to_database(data[ticker], '1mo', '1h')
+    return data
+
+def test_chunks_stream_every_row_in_order(stored):
+    chunks = list(iter_price_chunks(['STRB', 'STRA', 'MISSING'], interval='1h',
+                                    columns=['close'], chunk_size=50, prefetch=1))
+
+    assert all(len(chunk.index) <= 50 for chunk in chunks)
+    frame = pd.concat(chunks)
+    for ticker, data in stored.items():
+        rows = frame[frame['ticker'] == ticker]
+        assert rows.index.equals(data.index.rename('utc_time'))
+        np.testing.assert_allclose(rows['close'], data['Close'])
+
+    # Bounded by [start, end), as arrays
+    start, stop = stored['STRA'].index[[10, 20]]
+    arrays = list(iter_price_chunks('STRA', interval='1h', start=start, end=stop, as_frame=False))
+    assert list(arrays[0]['utc_time']) == list(stored['STRA'].index[10:20].as_unit('ns').asi8)
+
+def test_stopping_early_releases_the_connection(stored):
+    from connect import get_pool
+
+    in_use = get_pool().statistics()['in_use']
+    for chunk in iter_price_chunks(['STRA', 'STRB'], interval='1h', chunk_size=10, prefetch=1):
+        break
+    assert get_pool().statistics()['in_use'] == in_use
+
+def test_unknown_tickers_yield_nothing(postgres):
+    assert list(iter_price_chunks(['MISSING'], interval='1h')) == []
+    with pytest.raises(ValueError):
+        next(iter_price_chunks(['STRA'], columns=['price']))
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+from providers import Provider, RecordingProvider, ReplayProvider, SyntheticProvider
+
+end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+
+
+def test_synthetic_data_follows_its_clock():
+    provider = SyntheticProvider(end=end)
+
+    assert provider.fetch('SYN', 'financials').equals(SyntheticProvider(end=end).fetch('SYN', 'financials'))
+    assert provider.financials('SYN').columns[0] == pd.Timestamp('2025-10-16')
+    assert provider.actions('SYN').index[-1] == pd.Timestamp('2026-07-16')
+    assert provider.holder_frame('SYN', 'institutional_holders')['Date Reported'].max() <= pd.Timestamp('2026-10-16')
+    assert provider.download('SYN', period='5d', interval='1h').equals(
+        SyntheticProvider().download('SYN', period='5d', interval='1h', end=end))
+    # An explicit end overrides the clock
+    assert provider.financials('SYN', end='2020-01-01').columns[0] == pd.Timestamp('2019-01-01')
+
+def test_replayed_ranges_do_not_depend_on_when_they_were_planned(tmp_path):
+    synthetic = SyntheticProvider(end=end)
+    recorder = RecordingProvider(synthetic, str(tmp_path))
+    replay = ReplayProvider(str(tmp_path))
+
+    # Two ranges planned at different times are merged in one recording
+    first = recorder.fetch('SYN', 'download', start=end - pd.Timedelta(days=7),
+                           end=end - pd.Timedelta(days=3), interval='1h')
+    second = recorder.fetch('SYN', 'download', start=end - pd.Timedelta(days=3), end=end, interval='1h')
+    assert len(first.index) and len(second.index)
+
+    start = end - pd.Timedelta(days=5)
+    replayed = replay.fetch('SYN', 'download', start=start, end=end - pd.Timedelta(hours=1), interval='1h')
+    expected = synthetic.download('SYN', start=start, end=end - pd.Timedelta(hours=1), interval='1h')
+    assert replayed.equals(expected)
+
+    recorder.fetch('SYN', 'info')
+    assert replay.fetch('SYN', 'info') == synthetic.info('SYN')
+    with pytest.raises(KeyError):
+        replay.fetch('SYN', 'download', start=start, interval='1d')
+
+def test_providers_must_define_fetch():
+    class Unfinished(Provider):
+        name = 'unfinished'
+
+    with pytest.raises(TypeError):
+        Unfinished()
@@ -0,0 +1,60 @@
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_evicts_only_when_over_max_bytes(tmp_path, monkeypatch):
+    cache = ResponseCache(path=str(tmp_path / 'request.db'), max_bytes=2000, level=0)
+    evictions = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, 'evict', lambda: evictions.append(None) or evict())
+
+    for index in range(5):
+        cache.put(f'T{index}', 'info', {}, b'x' * 300)
+    assert evictions == []
+
+    # Replacing a response counts only its new size
+    cache.put('T0', 'info', {}, b'x' * 300)
+    assert evictions == []
+
+    for index in range(5, 20):
+        cache.put(f'T{index}', 'info', {}, b'x' * 300)
+    assert 0 < len(evictions) < 15
+    assert cache.size() <= cache.max_bytes
+    # The most recently stored responses are kept
+    assert cache.get('T19', 'info') == (True, b'x' * 300)
+
+def test_disabled_cache_reads_config_once(monkeypatch):
+    reads = []
+
+    def config(filename='database.ini', section='postgresql'):
+        reads.append(section)
+        raise Exception(f'Section {section} not found in the {filename} file')
+
+    monkeypatch.setattr(response_cache, 'config', config)
+    response_cache.set_response_cache(None)
+    try:
+        assert response_cache.get_response_cache() is None
+        assert response_cache.get_response_cache() is None
+        assert reads == ['response_cache']
+    finally:
+        response_cache.set_response_cache(None)
+
+def test_unreadable_responses_are_fetched_again(tmp_path):
+    import zlib
+
+    cache = ResponseCache(path=str(tmp_path / 'request.db'))
+    payloads = {'truncated': zlib.compress(b'x' * 100)[:10],
+                'not_pickle': zlib.compress(b'not a pickle'),
+                'missing_module': zlib.compress(b'cno_such_module\nThing\n.'),
+                'missing_class': zlib.compress(b'cbuiltins\nno_such_class\n.')}
+
+    for ticker, payload in payloads.items():
+        cache.put(ticker, 'info', {}, {'symbol': ticker})
+        cache.conn.execute('UPDATE response_cache SET payload = ?, size = ? WHERE ticker = ?',
+                           (payload, len(payload), ticker))
+
+    for ticker in payloads:
+        assert cache.get(ticker, 'info') == (False, None)
+        assert cache.fetch(ticker, 'info', {}, lambda: {'symbol': ticker}) == {'symbol': ticker}
+        assert cache.get(ticker, 'info') == (True, {'symbol': ticker})
+    assert cache.statistics()['corrupt'] == len(payloads)
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from rollups import bucket_starts, rollup_arrays, rollup_aggregations
+from stock_market import get_market
+
+
+def minute_bars(period: str, end: str) -> dict:
+    times = get_market('NYSE').bar_timestamps(period, '1m', end=pd.Timestamp(end, tz='UTC'))
+    times = times.as_unit('ns').asi8
+    values = np.arange(len(times), dtype=np.float64)
+    return dict(utc_time=times, **{column: values for column in rollup_aggregations})
+
+def test_buckets_start_at_the_session_open():
+    # Summer (EDT) and winter (EST) opens
+    times = pd.DatetimeIndex(['2026-10-16 13:30', '2026-10-16 14:29', '2026-10-16 14:30',
+                              '2026-12-16 14:30', '2026-12-16 15:45'], tz='UTC').as_unit('ns').asi8
+
+    starts = pd.DatetimeIndex(bucket_starts(times, '1h'), tz='UTC')
+
+    assert list(starts.strftime('%m-%d %H:%M')) == ['10-16 13:30', '10-16 13:30', '10-16 14:30',
+                                                    '12-16 14:30', '12-16 15:30']
+    # An explicit offset keeps the epoch alignment
+    assert bucket_starts(times[:1], '1h', offset=0)[0] == pd.Timestamp('2026-10-16 13:00', tz='UTC').as_unit('ns').value
+
+def test_daily_buckets_are_sessions():
+    data = minute_bars('5d', '2026-11-05 21:00')   # spans the end of daylight saving
+
+    rolled = rollup_arrays(data, '1d')
+    opens = get_market('NYSE').sessions_between('2026-10-30', '2026-11-06')['open']
+
+    assert list(rolled['utc_time']) == list(pd.DatetimeIndex(opens).as_unit('ns').asi8)
+    assert list(rolled['bar_count']) == [390] * 5
+    assert list(rolled['open']) == list(data['open'][::390])
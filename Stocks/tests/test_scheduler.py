@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from providers import SyntheticProvider
+from scheduler import IngestionScheduler, stock_jobs, write_slot_limit
+
+
+class SlowProvider(SyntheticProvider):
+    '''SyntheticProvider answering every call after a fixed latency'''
+
+    def __init__(self, latency: float, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, ticker: str, endpoint: str, **params):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return super().fetch(ticker, endpoint, **params)
+
+
+def test_write_slots_fit_the_pool():
+    assert write_slot_limit(10, 8) == 5
+    assert write_slot_limit(10, 2) == 2
+    assert write_slot_limit(1, 4) == 1
+
+def test_failed_jobs_are_retried():
+    attempts = []
+
+    def flaky():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise RuntimeError('upstream error')
+        return 'done'
+
+    with IngestionScheduler(max_retries=3, backoff=0.001) as scheduler:
+        future = scheduler.submit('flaky', flaky)
+        statistics = scheduler.wait()
+
+    assert future.result() == 'done'
+    assert statistics['completed'] == 1
+    assert statistics['retries'] == 2
+    assert statistics['failed'] == 0
+
+def test_concurrent_jobs_overlap_latency(postgres):
+    from stock import Stock
+
+    latency = 0.2
+    provider = SlowProvider(latency)
+    stocks = [Stock(f'SCH{index}') for index in range(4)]
+    for stock in stocks:
+        stock.provider = provider
+        stock.response_cache = None
+
+    with IngestionScheduler(max_workers=10, rate=1000, burst=100, max_retries=0,
+                            db_concurrency=100) as scheduler:
+        statistics = scheduler.run(stocks, period='5d', interval='1h')
+
+    jobs = len(stocks) * len(stock_jobs)
+    # The internal jobs submitting each stock's jobs are not counted
+    assert statistics['submitted'] == jobs
+    assert statistics['completed'] == jobs
+    assert statistics['failed'] == 0
+    assert statistics['throughput'] == pytest.approx(jobs / statistics['elapsed'], rel=0.05)
+    # Capped so writes and their nested checkouts fit the pool
+    assert scheduler.db_concurrency == write_slot_limit(8, 100)
+
+    # Run one after another, the upstream calls alone would take this long
+    sequential = provider.calls * latency
+    assert statistics['elapsed'] < sequential / 2
@@ -0,0 +1,144 @@
+import pytest
+
+import documents
+import freshness
+import response_cache
+from stock import Stock
+
+
+def test_constructor_reads_no_config(monkeypatch):
+    Stock('CFG')
+    reads = []
+
+    def config(filename='database.ini', section='postgresql'):
+        reads.append(section)
+        raise Exception(f'Section {section} not found in the {filename} file')
+
+    for module in [documents, freshness, response_cache]:
+        monkeypatch.setattr(module, 'config', config)
+
+    for index in range(3):
+        Stock(f'CFG{index}')
+    assert reads == []
+
+    # Read again once reloaded
+    documents.reload_storage_mode()
+    freshness.reload_ttls()
+    try:
+        assert Stock('CFG').storage == 'columns'
+        assert sorted(reads) == ['freshness', 'storage']
+    finally:
+        monkeypatch.undo()
+        documents.reload_storage_mode()
+        freshness.reload_ttls()
+
+def test_price_insert_is_one_transaction(postgres, monkeypatch):
+    import stock as stock_module
+    from connect import connection
+    from providers import SyntheticProvider
+
+    stock = Stock('LOAD')
+    data = SyntheticProvider().download('LOAD', period='5d', interval='1h',
+                                        end='2026-10-16 21:00+00:00')
+
+    result = stock.insert_stock_price_to_database(data, '5d', '1h')
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT count(*), count(DISTINCT request_id), min(close), max(close)
+                          FROM stock_price WHERE stock_id = %s""", (stock.stock_id,))
+        rows, requests, low, high = cursor.fetchone()
+    assert result['rows'] == rows == len(data.index)
+    assert requests == 1
+    assert (low, high) == pytest.approx((data['Close'].min(), data['Close'].max()))
+
+    # The request is not logged when the rows fail to load
+    def failing_upsert(*args, **kwargs):
+        raise RuntimeError('load failed')
+
+    monkeypatch.setattr(stock_module, 'upsert_dataframe', failing_upsert)
+    with pytest.raises(RuntimeError):
+        stock.insert_stock_price_to_database(data, '5d', '1h')
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT count(*) FROM request WHERE stock_id = %s', (stock.stock_id,))
+        assert cursor.fetchone()[0] == 1
+
+def test_reloaded_bars_update_rather_than_duplicate(postgres):
+    from connect import connection
+    from providers import SyntheticProvider
+
+    stock = Stock('RELOAD')
+    data = SyntheticProvider().download('RELOAD', period='5d', interval='1h',
+                                        end='2026-10-16 21:00+00:00')
+    stock.insert_stock_price_to_database(data, '5d', '1h')
+
+    data = data.copy()
+    data['Close'] = data['Close'] + 1
+    stock.insert_stock_price_to_database(data, '5d', '1h')
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT count(*), count(DISTINCT request_id), max(close)
+                          FROM stock_price WHERE stock_id = %s""", (stock.stock_id,))
+        rows, requests, high = cursor.fetchone()
+    assert rows == len(data.index)
+    # Every bar now belongs to the second request
+    assert requests == 1
+    assert high == pytest.approx(data['Close'].max())
+
+def test_prices_load_as_stored(postgres):
+    import numpy as np
+
+    from providers import SyntheticProvider
+
+    stock = Stock('BINARY')
+    data = SyntheticProvider().download('BINARY', period='5d', interval='1h',
+                                        end='2026-10-16 21:00+00:00')
+    data = data.astype({'Volume': np.float64})
+    data.iloc[3, data.columns.get_loc('Volume')] = np.nan
+    stock.insert_stock_price_to_database(data, '5d', '1h')
+
+    loaded = stock.load_prices(interval='1h', columns=['close', 'volume'])
+    assert loaded.index.equals(data.index.rename('utc_time'))
+    np.testing.assert_allclose(loaded['close'], data['Close'])
+    np.testing.assert_array_equal(loaded['volume'], data['Volume'])
+
+    # Bounded by [start, end), as arrays
+    start, end = data.index[2], data.index[5]
+    arrays = stock.load_prices(start, end, interval='1h', as_frame=False)
+    assert list(arrays['utc_time']) == list(data.index[2:5].as_unit('ns').asi8)
+    assert np.isnan(arrays['volume'][1])
+    assert stock.load_prices(interval='1d').empty
+
+def test_fetched_data_and_request_share_the_transaction(postgres, monkeypatch):
+    import datetime
+
+    from connect import connection
+    from providers import SyntheticProvider
+
+    stock = Stock('FRESH', freshness_ttls={'stock_actions': datetime.timedelta(days=1)})
+    stock.provider = SyntheticProvider()
+    stock.response_cache = None
+
+    def count(table: str) -> int:
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT count(*) FROM {table} WHERE stock_id = %s', (stock.stock_id,))
+            return cursor.fetchone()[0]
+
+    # The actions are rolled back with the failed request log
+    def failing_record(*args, **kwargs):
+        raise RuntimeError('record failed')
+
+    monkeypatch.setattr(stock.freshness, 'record', failing_record)
+    with pytest.raises(RuntimeError):
+        stock.download_stock_actions()
+    monkeypatch.undo()
+    assert count('stock_actions') == count('request') == 0
+    assert not stock.is_fresh('stock_actions')
+
+    stock.download_stock_actions()
+    assert stock.is_fresh('stock_actions')
+    assert count('stock_actions') == SyntheticProvider().action_count
+    assert count('request') == 1
@@ -0,0 +1,65 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from stock_market import StockMarket, get_market, lse_holidays, nyse_holidays
+
+
+def session_dates(market: StockMarket, year: int) -> set:
+    return {str(day) for day in market.session_table(year)['date']}
+
+def test_nyse_rules_match_published_holidays():
+    published = {2023: ['2023-01-02', '2023-01-16', '2023-02-20', '2023-04-07', '2023-05-29',
+                        '2023-06-19', '2023-07-04', '2023-09-04', '2023-11-23', '2023-12-25'],
+                 2024: ['2024-01-01', '2024-01-15', '2024-02-19', '2024-03-29', '2024-05-27',
+                        '2024-06-19', '2024-07-04', '2024-09-02', '2024-11-28', '2024-12-25']}
+    for year, holidays in published.items():
+        assert sorted(str(day) for day in nyse_holidays(year)[0]) == holidays
+
+    assert set(nyse_holidays(2024)[1]) == {datetime.date(2024, 7, 3), datetime.date(2024, 11, 29),
+                                           datetime.date(2024, 12, 24)}
+
+def test_lse_rules_substitute_weekend_holidays():
+    holidays = lse_holidays(2027)[0]
+    # Christmas Day and Boxing Day 2027 fall on a weekend
+    assert datetime.date(2027, 12, 27) in holidays
+    assert datetime.date(2027, 12, 28) in holidays
+
+def test_rules_cover_the_current_year():
+    market = get_market('NYSE')
+    dates = session_dates(market, 2026)
+
+    assert '2026-07-03' not in dates      # Independence Day observed
+    assert '2026-11-26' not in dates      # Thanksgiving
+    assert '2026-11-27' in dates
+
+    table = market.session_table(2026)
+    close = table['close'][table['date'] == np.datetime64('2026-11-27')][0]
+    assert pd.Timestamp(close, tz='UTC') == pd.Timestamp('2026-11-27 18:00', tz='UTC')
+
+def test_listed_holidays_add_to_the_rules():
+    assert '2025-01-09' not in session_dates(get_market('NYSE'), 2025)
+    assert '2023-05-08' not in session_dates(get_market('LSE'), 2023)
+
+def test_intraday_bars_follow_the_session():
+    market = get_market('NYSE')
+    end = pd.Timestamp('2026-10-16 15:07', tz='UTC')
+
+    bars = market.bar_timestamps('1d', '1m', end=end)
+
+    # 09:30 New York is 13:30 UTC; the bar in progress at the end is left out
+    assert bars[0] == pd.Timestamp('2026-10-16 13:30', tz='UTC')
+    assert bars[-1] == pd.Timestamp('2026-10-16 15:06', tz='UTC')
+    assert len(bars) == 97
+
+def test_daily_bars_are_labelled_by_session_date():
+    market = get_market('NYSE')
+    end = pd.Timestamp('2026-11-30 12:00', tz='UTC')
+
+    bars = market.bar_timestamps('1mo', '1d', end=end)
+    local = bars.tz_convert('America/New_York')
+
+    assert (local.hour == 0).all()
+    assert pd.Timestamp('2026-11-26') not in local.tz_localize(None)
+    assert local[-1].date() == datetime.date(2026, 11, 27)
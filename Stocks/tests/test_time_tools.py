@@ -0,0 +1,23 @@
+import datetime
+
+import pytz
+
+from stock_market import StockMarket
+from time_tools import generate_timestamps
+
+
+def test_timestamps_are_returned_in_timezone():
+    end = datetime.datetime(2026, 10, 16, 18, 0, tzinfo=pytz.UTC)
+    utc = generate_timestamps('5d', '1h', end=end)
+    local = generate_timestamps('5d', '1h', 'America/New_York', end=end)
+
+    assert str(utc.tz) == 'UTC'
+    assert str(local.tz) == 'America/New_York'
+    assert local.tz_convert(pytz.UTC).equals(utc)
+    assert (generate_timestamps('5d', '1h', 'America/New_York', end=end, as_epoch=True) ==
+            generate_timestamps('5d', '1h', end=end, as_epoch=True)).all()
+
+    market = StockMarket('NYSE')
+    bars = generate_timestamps('5d', '1h', 'America/New_York', end=end, market=market)
+    assert str(bars.tz) == 'America/New_York'
+    assert bars.tz_convert(pytz.UTC).equals(generate_timestamps('5d', '1h', end=end, market=market))
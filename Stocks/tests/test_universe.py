@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from connect import connection
+from providers import SyntheticProvider
+from schema import default_tables, ensure_schema
+import universe
+from universe import StockUniverse
+
+end = pd.Timestamp('2026-10-16 21:00', tz='UTC')
+
+
+def synthetic_download(provider: SyntheticProvider, missing: dict = None):
+    """Stub of yf.download building its multi ticker frame from a
+    SyntheticProvider (group_by='ticker' gives (ticker, field) columns)
+
+    Parameters:
+    ----------
+    provider (SyntheticProvider) : source of every ticker's bars
+    missing (dict) : ticker: number of leading bars it has no data for
+    """
+
+    missing = missing or dict()
+
+    def download(tickers, period, interval, group_by='column', **params):
+        frames = {ticker: provider.download(ticker, period=period, interval=interval, end=end)
+                  .iloc[missing.get(ticker, 0):]
+                  for ticker in tickers}
+        data = pd.concat(frames, axis=1)
+        return data if group_by == 'ticker' else data.swaplevel(axis=1)
+
+    return download
+
+def test_split_frame_slices_by_ticker():
+    provider = SyntheticProvider()
+    tickers = ['AAA', 'BBB', 'CCC']
+    data = synthetic_download(provider, missing={'BBB': 30})(tickers, '5d', '1h', group_by='ticker')
+
+    for frames in [StockUniverse.split_frame(data, tickers),
+                   StockUniverse.split_frame(data.swaplevel(axis=1), tickers)]:
+        assert list(frames) == tickers
+        for ticker in tickers:
+            expected = provider.download(ticker, period='5d', interval='1h', end=end)
+            expected = expected.iloc[30:] if ticker == 'BBB' else expected
+            frame = frames[ticker]
+
+            assert frame.index.equals(expected.index)
+            assert sorted(frame.columns) == sorted(expected.columns)
+            np.testing.assert_allclose(frame[expected.columns].to_numpy(),
+                                       expected.to_numpy(dtype=np.float64))
+
+def test_split_frame_single_ticker():
+    data = SyntheticProvider().download('AAA', period='5d', interval='1h', end=end)
+
+    frames = StockUniverse.split_frame(data, ['AAA'])
+
+    assert frames['AAA'] is data
+
+def test_stock_ids_resolved(postgres):
+    ensure_schema(default_tables)
+    with connection() as conn:
+        conn.cursor().execute("INSERT INTO stock (ticker) VALUES ('UNIA') ON CONFLICT DO NOTHING")
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM stock WHERE ticker = 'UNIA'")
+        existing = cursor.fetchone()[0]
+
+    stock_ids = StockUniverse(['UNIA', 'UNIB', 'UNIA']).stock_ids
+
+    assert set(stock_ids) == {'UNIA', 'UNIB'}
+    assert stock_ids['UNIA'] == existing
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM stock WHERE ticker = 'UNIB'")
+        assert cursor.fetchone()[0] == stock_ids['UNIB']
+
+def test_download_inserts_every_ticker_in_one_transaction(postgres):
+    tickers = ['UNIC', 'UNID', 'UNIE']
+    stock_universe = StockUniverse(tickers, group_size=2,
+                                   download=synthetic_download(SyntheticProvider(), {'UNID': 10}))
+
+    counts = stock_universe.download_price_data(period='5d', interval='1h')
+
+    stock_ids = stock_universe.stock_ids
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT stock_id, count(*) FROM stock_price
+                          WHERE stock_id = ANY(%s) AND interval = '1h' GROUP BY stock_id""",
+                       (list(stock_ids.values()),))
+        stored = dict(cursor.fetchall())
+        cursor.execute("""SELECT DISTINCT utc_time FROM request
+                          WHERE stock_id = ANY(%s) AND request_type = 'stock_price'""",
+                       (list(stock_ids.values()),))
+        request_times = cursor.fetchall()
+
+    assert counts['UNID'] == counts['UNIC'] - 10
+    assert stored == {stock_ids[ticker]: counts[ticker] for ticker in tickers}
+    # One request per ticker, all logged by the same statement
+    assert len(request_times) == 1
+
+def test_failed_insert_writes_nothing(postgres, monkeypatch):
+    tickers = ['UNIF', 'UNIG']
+    stock_universe = StockUniverse(tickers, download=synthetic_download(SyntheticProvider()))
+    stock_ids = list(stock_universe.stock_ids.values())
+
+    def failing_upsert(cursor, *args, **kwargs):
+        raise RuntimeError('upsert failed')
+
+    monkeypatch.setattr(universe, 'upsert_dataframe', failing_upsert)
+    with pytest.raises(RuntimeError):
+        stock_universe.download_price_data(period='5d', interval='1h')
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT count(*) FROM request WHERE stock_id = ANY(%s)', (stock_ids,))
+        assert cursor.fetchone()[0] == 0
+        cursor.execute('SELECT count(*) FROM stock_price WHERE stock_id = ANY(%s)', (stock_ids,))
+        assert cursor.fetchone()[0] == 0
+
+def test_groups_are_fetched_through_the_provider(postgres):
+    tickers = ['UNIH', 'UNII', 'UNIJ']
+    stock_universe = StockUniverse(tickers, group_size=2)
+    stock_universe.provider = SyntheticProvider()
+
+    acquired = []
+
+    class RateLimiter:
+        def acquire(self):
+            acquired.append(None)
+
+    stock_universe.rate_limiter = RateLimiter()
+    counts = stock_universe.download_price_data(period='5d', interval='1h')
+
+    # One rate limited call per group
+    assert len(acquired) == 2
+    assert set(counts) == set(tickers)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT stock_id, count(*) FROM stock_price
+                          WHERE stock_id = ANY(%s) AND interval = '1h' GROUP BY stock_id""",
+                       (list(stock_universe.stock_ids.values()),))
+        assert dict(cursor.fetchall()) == {stock_universe.stock_ids[ticker]: counts[ticker]
+                                           for ticker in tickers}
@@ -1,159 +1,216 @@
 import datetime
+import math
+
+import numpy as np
+import pandas as pd
 import pytz
 
-def generate_timestamps(period: str, interval: str, timezone: str) -> list:
+# Define time with respect to one day
+minute_denom = 60
+day_denom = 24 * 60 * 60
+
+# Define market open and close time
+open_days = [0, 1, 2, 3, 4]
+open_time = datetime.time(9, 30)
+close_time = datetime.time(16, 30)
+
+# Define interval lengths (seconds)
+interval_dict = {'1m': minute_denom,
+                 '2m': 2 * minute_denom,
+                 '5m': 5 * minute_denom,
+                 '15m': 15 * minute_denom,
+                 '30m': 30 * minute_denom,
+                 '60m': 60 * minute_denom,
+                 '90m': 90 * minute_denom,
+                 '1h': 60 * minute_denom,
+                 '1d': day_denom,
+                 '5d': 5 * day_denom,
+                 '1wk': 7 * day_denom,
+                 '1mo': 30 * day_denom,
+                 '3mo': 3 * 30 * day_denom
+}
+
+# Define period lengths (seconds)
+period_dict = {'1h': 60 * minute_denom,
+               '1d': 1 * day_denom,
+               '5d': 5 * day_denom,
+               '1mo': 1 * 30 * day_denom,
+               '3mo': 3 * 30 * day_denom,
+               '6mo': 6 * 30 * day_denom,
+               '1y': 365 * day_denom,
+               '2y': 2 * 365 * day_denom,
+               '5y': 5 * 365 * day_denom,
+               '10y': 10 * 365 * day_denom
+}
+
+# Nanoseconds per second and per day
+second_ns = 10 ** 9
+day_ns = day_denom * second_ns
+
+
+def time_to_ns(time: datetime.time) -> int:
     '''
-    Generate is of timestamps given a period and interal, or a start and end
+    Convert a time of day to nanoseconds since midnight
     '''
+    seconds = time.hour * 3600 + time.minute * 60 + time.second
+    return seconds * second_ns + time.microsecond * 1000
+
+def weekday_offsets(days: np.ndarray) -> np.ndarray:
+    """Compute the weekend adjustment of each day
+
+    Walking back from the latest day, every weekend day pushes it and all
+    earlier days back so that the days land on open days.
+
+    Parameters:
+    ----------
+    days (np.ndarray) : sorted unique days, as int64 days since the epoch
 
-    # Note: inconsistent use of dictionary index and .get() method
-    # Need to accomodate for start and end as opposed to period and interval
-
-    # Define time with respect to one day
-    # !rename to minute_denom
-    second_denom = 60
-    day_denom = 24 * 60 * 60
-
-    # Define market open and close time
-    open_days = [0, 1, 2, 3, 4]
-    open_time = datetime.time(9, 30)
-    close_time = datetime.time(16, 30)
-
-    # Define interval lengths
-    interval_dict = {'1m': second_denom,
-                        '2m': 2 * second_denom,
-                        '5m': 5 * second_denom,
-                        '15m': 15 * second_denom,
-                        '30m': 30 * second_denom,
-                        '60m': 60 * second_denom,
-                        '90m': 90 * second_denom,
-                        '1h': 60 * second_denom,
-                        '1d': day_denom,
-                        '5d': 5 * day_denom,
-                        '1wk': 7 * day_denom,
-                        '1mo': 30 * day_denom,
-                        '3mo': 3 * 30 * day_denom
-    }
-
-    # Define period lengths
-    period_dict = {'1h': 60 * second_denom,
-                    '1d': 1 * day_denom,
-                    '5d': 5 * day_denom,
-                    '1mo': 1 * 30 * day_denom,
-                    '3mo': 3 * 30 * day_denom,
-                    '6mo': 6 * 30 * day_denom,
-                    '1y': 365 * day_denom,
-                    '2y': 2 * 365 * day_denom,
-                    '5y': 5 * 365 * day_denom,
-                    '10y': 10 * 365 * day_denom
-    }
+    Returns:
+    ----------
+    np.ndarray : number of days to subtract from each day
+    """
+
+    offsets = np.zeros(len(days), dtype=np.int64)
+    offset = 0
+
+    # One iteration per distinct day rather than per timestamp
+    for position in range(len(days) - 1, -1, -1):
+        # 1970-01-01 was a Thursday (weekday 3)
+        weekday = (days[position] - offset + 3) % 7
+        if weekday not in open_days:
+            offset += weekday - max(open_days)
+        offsets[position] = offset
+
+    return offsets
+
+def generate_timestamps(period: str, interval: str, timezone: str = None,
+                        end: datetime.datetime = None, as_epoch: bool = False,
+                        market=None):
+    """Generate the timestamps of a period at an interval
+
+    With a market, these are the bars of its trading calendar (see
+    stock_market.StockMarket.bar_timestamps). Otherwise the fixed
+    open_time to close_time (UTC) grid below is used, which includes the
+    unrounded end and ignores holidays.
+
+    Timestamps are generated as int64 nanosecond arrays: the grid between
+    start and end is built with one np.arange, filtered to market hours
+    with one vectorized time of day check, and shifted off weekends with
+    one lookup per distinct day.
+
+    Timestamps are in the same order as the original loop based version:
+    the unrounded end (if it is not on the interval grid), the grid, then
+    the rounded end.
+
+    Parameters:
+    ----------
+    period (str) : period to generate timestamps over (key of period_dict)
+    interval (str) : interval between timestamps (key of interval_dict)
+    timezone (str) : timezone to return the timestamps in, defaults to UTC
+        (epoch values do not depend on it)
+    end (datetime.datetime) : end of the period, defaults to now
+    as_epoch (bool) : return int64 nanoseconds since the epoch instead
+    market (stock_market.StockMarket) : exchange whose sessions the bars fall in
+
+    Returns:
+    ----------
+    pd.DatetimeIndex : timestamps in timezone (np.ndarray of int64 if as_epoch)
+    """
+
+    # Note: need to accomodate for start and end as opposed to period and interval
+
+    if market is not None:
+        timestamps = market.bar_timestamps(period, interval, end=end)
+        if as_epoch:
+            return timestamps.as_unit('ns').asi8
+        return timestamps.tz_convert(timezone) if timezone else timestamps
+
+    open_ns = time_to_ns(open_time)
+    close_ns = time_to_ns(close_time)
 
     # Set end time to now and as UTC
-    end = datetime.datetime.now().astimezone(pytz.UTC)
+    if end is None:
+        end = datetime.datetime.now()
+    end = pd.Timestamp(end.astimezone(pytz.UTC))
 
-    # Set end period
+    end_day = end.normalize()
+    end_time = end.value - end_day.value
 
     # If the end time is greater than the close
     # time, set the end time to the close time
-    if end.time() > close_time:
-        end = end.replace(
-                    hour=close_time.hour, 
-                    minute=close_time.minute,
-                    second=close_time.second,
-                    microsecond=close_time.microsecond
-                    )
+    if end_time > close_ns:
+        end_time = close_ns
     # If the end time is less than the open
     # time, set the end time to the close time
-    # and subtract a day
-    if end.time() < open_time:
-        end = end.replace(day=end.day-1,
-                            hour=close_time.hour,
-                            minute=close_time.minute,
-                            second=close_time.second,
-                            microsecond=close_time.microsecond)
-
-    # Get duration in seconds
+    # of the previous day
+    if end_time < open_ns:
+        end_day = end_day - pd.Timedelta(days=1)
+        end_time = close_ns
+    end_value = end_day.value + end_time
+
+    # Get duration in nanoseconds
     interval_seconds = interval_dict[interval]
+    interval_ns = interval_seconds * second_ns
+    period_seconds = period_dict[period]
+
     timestamps_list = []
 
     # Get largest time within interval from close time
-    # to round the timestamps
-    largest_time = datetime.datetime(
-                            year=end.year,
-                            month=end.month,
-                            day=end.day,
-                            hour=close_time.hour,
-                            minute=close_time.minute,
-                            second=close_time.second,
-                            microsecond=close_time.microsecond)
-
-    while largest_time.time() > end.time():
-        largest_time = largest_time - datetime.timedelta(seconds=interval_seconds)
-    
-    # If different, save the end time in timestamps list
-    # and set the new end to the rounded value
-    if largest_time.time() != end.time():
-        timestamps_list.append(end)
-        end = end.replace(hour=largest_time.hour,
-                    minute=largest_time.minute,
-                    second=largest_time.second,
-                    microsecond=largest_time.microsecond
-        )
+    # to round the timestamps. Step back from the close in whole
+    # intervals (wrapping over midnight) until at or before the end
+    # time; intervals of whole days cannot be rounded.
+    if interval_seconds % day_denom:
+        cycle = day_denom // math.gcd(interval_seconds, day_denom)
+        steps = np.arange(cycle + 1, dtype=np.int64)
+        largest_times = (close_ns - steps * interval_ns) % day_ns
+        largest_time = int(largest_times[np.argmax(largest_times <= end_time)])
+
+        # If different, save the end time in timestamps list
+        # and set the new end to the rounded value
+        if largest_time != end_time:
+            timestamps_list.append(np.array([end_value], dtype=np.int64))
+            end_time = largest_time
+            end_value = end_day.value + end_time
 
     # If period is more than or equal to one day,
     # set start to the open time and subtract
     # the number of days remaining
-    if period_dict.get(period) >= day_denom:
-        start = end.replace(hour=open_time.hour,
-                        minute=open_time.minute,
-                        second=open_time.second,
-                        microsecond=open_time.microsecond)
-        sub_days = (period_dict.get(period) / day_denom)  - 1
-        start = start - datetime.timedelta(days=sub_days)
-
+    if period_seconds >= day_denom:
+        sub_days = (period_seconds / day_denom) - 1
+        start_value = end_day.value + open_ns - int(sub_days * day_ns)
     # If period is less than one day, subtract
     # the period from the end time
-    if period_dict.get(period) < day_denom:
-        start = end - datetime.timedelta(seconds=period_dict[period])
-
-    # Add all timestamps in period to list
-    while start < end:
-        if start.time() >= open_time and start.time() < close_time:
-            timestamps_list.append(start)
-        start += datetime.timedelta(seconds=interval_seconds)
+    else:
+        start_value = end_value - period_seconds * second_ns
+
+    # Add all timestamps in period within market hours
+    if day_ns % interval_ns == 0:
+        # The grid falls at the same times every day, so build one day's
+        # session times and broadcast them over the days in the period
+        phase = start_value % interval_ns
+        first_time = open_ns + (phase - open_ns) % interval_ns
+        session_times = np.arange(first_time, close_ns, interval_ns, dtype=np.int64)
+        day_values = np.arange(start_value // day_ns, end_value // day_ns + 1, dtype=np.int64) * day_ns
+        grid = (day_values[:, None] + session_times[None, :]).ravel()
+        grid = grid[(grid >= start_value) & (grid < end_value)]
+    else:
+        grid = np.arange(start_value, end_value, interval_ns, dtype=np.int64)
+        grid_times = grid % day_ns
+        grid = grid[(grid_times >= open_ns) & (grid_times < close_ns)]
+    timestamps_list.append(grid)
+
+    timestamps = np.concatenate(timestamps_list)
 
     # Add end timestamp if not included
-    if end not in timestamps_list:
-        timestamps_list.append(end)
-
-    # Get list of days
-    days = set([timestamp.date() for timestamp in timestamps_list])
-    days = sorted(list(days))[::-1]
-
-    # Define closed days
-    closed_days = [timestamp for timestamp in days if timestamp.weekday() not in open_days] 
-
-    offset = 0
-    new_day_dict = {day: None for day in days}
-
-    # Replace days with weekend-adjusted days
-    for day in days:
-        new_day = day - datetime.timedelta(days=offset)
-        if new_day.weekday() not in open_days:
-            offset += new_day.weekday() - max(open_days)
-        new_day = day - datetime.timedelta(days=offset)
+    if not (timestamps == end_value).any():
+        timestamps = np.append(timestamps, end_value)
 
-        new_day_dict[day] = new_day
-    
     # Adjust all days to not include weekends
-    normalised_list = []
-    for timestamp in timestamps_list:
-        new_day = new_day_dict[timestamp.date()]
-        new_timestamp = timestamp.replace(
-            year=new_day.year,
-            month=new_day.month,
-            day=new_day.day
-        )
-        normalised_list.append(new_timestamp)
-
-    return normalised_list
+    days, day_positions = np.unique(timestamps // day_ns, return_inverse=True)
+    offsets = weekday_offsets(days)
+    timestamps = timestamps - offsets[day_positions] * day_ns
+
+    if as_epoch:
+        return timestamps
+    timestamps = pd.DatetimeIndex(timestamps, tz=pytz.UTC)
+    return timestamps.tz_convert(timezone) if timezone else timestamps
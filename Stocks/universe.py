@@ -0,0 +1,306 @@
+import datetime
+import time
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# Created libraries
+from connect import connection
+import metrics
+from db_tools import upsert_dataframe
+from freshness import get_freshness_cache, price_scope
+from partitions import prepare_partitions
+from price_cache import update_price_cache
+from providers import get_provider
+from response_cache import get_response_cache
+from rollups import update_rollups
+from schema import ensure_schema
+from stock import Stock, stock_price_key
+from stock_market import default_exchange
+
+
+class StockUniverse:
+    '''
+    Batch API over many tickers: downloads price data for groups of
+    tickers per provider call and stores every ticker in one transaction
+    '''
+
+    def __init__(self, tickers: list, group_size: int = 100,
+                 request_table: str = 'request',
+                 stock_price_table: str = 'stock_price',
+                 stock_table: str = 'stock',
+                 exchange: str = default_exchange,
+                 download=None) -> None:
+        """Initialise instance of StockUniverse class
+
+        Parameters:
+        ----------
+        tickers (list) : names of the stock tickers
+        group_size (int) : number of tickers per download call
+        request_table (str) : name of the request table
+        stock_price_table (str) : name of the stock price table
+        stock_table (str) : name of the stock table
+        exchange (str) : exchange (section of exchanges.ini) the tickers
+            trade on, whose sessions the rolled up buckets follow
+        download (callable) : replacement for the provider's download_group,
+            called like yf.download, e.g. a stub returning synthetic frames
+
+        Raises:
+        ----------
+        TypeError : tickers is not a list of strings
+        ValueError : tickers is empty or group_size is not positive
+        """
+
+        if not isinstance(tickers, (list, tuple)):
+            raise TypeError(f'{tickers} is not a list (type: {type(tickers)})')
+        for ticker in tickers:
+            if not isinstance(ticker, str):
+                raise TypeError(f'{ticker} is not a string (type: {type(ticker)})')
+            if not ticker:
+                raise ValueError(f'{ticker} is an empty string')
+        if not tickers:
+            raise ValueError('tickers is empty')
+        if group_size < 1:
+            raise ValueError(f'group_size must be positive (group_size: {group_size})')
+
+        # Remove duplicates, keeping order
+        self.tickers = list(dict.fromkeys(tickers))
+        self.group_size = group_size
+
+        self.request_table = request_table
+        self.stock_price_table = stock_price_table
+        self.stock_table = stock_table
+        self.exchange = exchange
+
+        self.download = download
+
+        # As for Stock: optional rate limiter (with an acquire method) set
+        # by an ingestion scheduler, the persistent cache of responses and
+        # the source of upstream data, defaulting to get_provider()
+        self.rate_limiter = None
+        self.response_cache = get_response_cache()
+        self.provider = None
+
+    @property
+    def tables(self) -> dict:
+        '''Table role: table name, as used by schema.ensure_schema'''
+        return {'stock': self.stock_table,
+                'request': self.request_table,
+                'stock_price': self.stock_price_table}
+
+    @property
+    def groups(self) -> list:
+        '''Tickers split into groups of group_size'''
+        return [self.tickers[start:start + self.group_size]
+                for start in range(0, len(self.tickers), self.group_size)]
+
+    @cached_property
+    def stock_ids(self) -> dict:
+        """Getter method for stock_ids
+
+        Get the id of every ticker in one round trip, adding the tickers
+        not yet in the stock table.
+
+        Returns:
+        ----------
+        dict : ticker: stock_id
+        """
+
+        query = f"""
+                WITH added AS (
+                    INSERT INTO {self.stock_table} (ticker)
+                    SELECT unnest(%s::varchar[])
+                    ON CONFLICT (ticker) DO NOTHING
+                    RETURNING id, ticker
+                )
+                SELECT id, ticker FROM added
+                UNION ALL
+                SELECT id, ticker FROM {self.stock_table} WHERE ticker = ANY(%s::varchar[])
+        """
+
+        ensure_schema(self.tables)
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (self.tickers, self.tickers))
+            return {ticker: stock_id for stock_id, ticker in cursor.fetchall()}
+
+    @staticmethod
+    def split_frame(data: pd.DataFrame, tickers: list) -> dict:
+        """Split a multi ticker yf.download frame by ticker
+
+        The frame is converted to one array with the columns of each
+        ticker next to each other, so every ticker's frame is a view of
+        it rather than a copy. Rows where the ticker has no data (e.g. it
+        trades on a different calendar) are dropped.
+
+        Parameters:
+        ----------
+        data (pd.DataFrame) : frame with (ticker, field) or (field, ticker) columns
+        tickers (list) : tickers in the frame
+
+        Returns:
+        ----------
+        dict : ticker: pd.DataFrame with the fields as columns
+        """
+
+        if not isinstance(data.columns, pd.MultiIndex):
+            return {tickers[0]: data}
+
+        # Make the ticker the first column level
+        if not set(data.columns.get_level_values(0)) & set(tickers):
+            data = data.swaplevel(axis=1)
+        data = data.sort_index(axis=1)
+
+        values = data.to_numpy(dtype=np.float64)
+
+        frames = dict()
+        for ticker in tickers:
+            if ticker not in data.columns.get_level_values(0):
+                continue
+
+            columns = data.columns.get_loc(ticker)
+            ticker_values = values[:, columns]
+            fields = data.columns[columns].get_level_values(1)
+
+            # Drop rows without data, copying only if there are any
+            has_data = ~np.isnan(ticker_values).all(axis=1)
+            index = data.index
+            if not has_data.all():
+                ticker_values = ticker_values[has_data]
+                index = index[has_data]
+
+            if len(index):
+                frames[ticker] = pd.DataFrame(ticker_values, index=index,
+                                              columns=fields, copy=False)
+
+        return frames
+
+    def fetch_group(self, group: list, **params) -> pd.DataFrame:
+        """Download the price data of a group of tickers
+
+        Like Stock.fetch: responses are served from the response_cache
+        while within their TTL, and upstream calls are rate limited.
+
+        Parameters:
+        ----------
+        group (list) : names of the stock tickers
+        params : keyword arguments of yf.download
+
+        Returns:
+        ----------
+        pd.DataFrame : frame with (ticker, field) columns
+        """
+
+        if self.response_cache is not None:
+            return self.response_cache.fetch(' '.join(group), 'download', params,
+                                             lambda: self.fetch_group_upstream(group, **params))
+        return self.fetch_group_upstream(group, **params)
+
+    def fetch_group_upstream(self, group: list, **params) -> pd.DataFrame:
+        '''Download a group from the provider, bypassing the response cache (see fetch_group)'''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        if self.download is not None:
+            return self.download(tickers=group, group_by='ticker', **params)
+        provider = self.provider or get_provider()
+        return provider.download_group(group, **params)
+
+    @metrics.instrument('download')
+    def download_price_data(self, period: str = '1d', interval: str = '1m') -> dict:
+        """Download stock price data for every ticker
+
+        Download group_size tickers per call, split the combined frames by
+        ticker and store them all in a single transaction.
+
+        Parameters:
+        ----------
+        period (str) : period over which to retrieve data
+        interval (str) : interval between stock price data values
+
+        Returns:
+        ----------
+        dict : ticker: number of rows inserted
+        """
+
+        frames = dict()
+
+        for group in self.groups:
+            data = self.fetch_group(group, period=period, interval=interval)
+            frames.update(self.split_frame(data, group))
+
+        return self.insert_price_data(frames, period, interval)
+
+    def insert_price_data(self, frames: dict, period: str, interval: str) -> dict:
+        """Insert the price data of many tickers into the stock price table
+
+        Log one request per ticker with a single INSERT and upsert every
+        ticker's rows by stock_price_key with a single COPY, all inside
+        one transaction.
+
+        Parameters:
+        ----------
+        frames (dict) : ticker: price data indexed by time
+        period (str) : period the data was downloaded for
+        interval (str) : interval between stock price data values
+
+        Returns:
+        ----------
+        dict : ticker: number of rows downloaded
+        """
+
+        if not frames:
+            return dict()
+
+        start = time.perf_counter()
+
+        ensure_schema(self.tables)
+        for frame in frames.values():
+            prepare_partitions(self.stock_price_table, frame.index)
+
+        tickers = list(frames.keys())
+        stock_ids = [self.stock_ids[ticker] for ticker in tickers]
+        request_time = datetime.datetime.now(pytz.UTC)
+
+        request_query = f"""INSERT INTO {self.request_table}
+                            (utc_time, stock_id, period, interval, request_type)
+                            SELECT %s, unnest(%s::integer[]), %s, %s, 'stock_price'
+                            RETURNING id, stock_id"""
+
+        with connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(request_query, (request_time, stock_ids, period, interval))
+            request_ids = {stock_id: request_id for request_id, stock_id in cursor.fetchall()}
+            metrics.count('rows_written', len(request_ids), table=self.request_table)
+            get_freshness_cache(self.request_table).record(cursor, stock_ids, 'stock_price', request_time,
+                                                           scope=price_scope(period, interval))
+
+            rows = pd.concat([Stock.format_price_data(frames[ticker],
+                                                      request_ids[self.stock_ids[ticker]],
+                                                      self.stock_ids[ticker], interval)
+                              for ticker in tickers])
+            row_count = upsert_dataframe(cursor, rows, self.stock_price_table,
+                                         stock_price_key)
+
+            # Recompute the rolled up buckets containing the new bars
+            times = pd.DatetimeIndex(rows['utc_time']).as_unit('ns').asi8
+            for stock_id in rows['stock_id'].unique():
+                stock_times = times[(rows['stock_id'] == stock_id).to_numpy()]
+                update_rollups(int(stock_id), interval, stock_times.min(), stock_times.max(),
+                               stock_price_table=self.stock_price_table,
+                               exchange=self.exchange, cursor=cursor)
+
+        for ticker in tickers:
+            update_price_cache(ticker, interval, rows[rows['stock_id'] == self.stock_ids[ticker]],
+                               self.stock_price_table, self.exchange)
+
+        seconds = time.perf_counter() - start
+        rows_per_second = row_count / seconds if seconds else 0.0
+        metrics.event('prices_upserted', tickers=len(tickers), interval=interval, rows=row_count,
+                      seconds=seconds, rows_per_second=rows_per_second)
+
+        return {ticker: len(frames[ticker].index) for ticker in tickers}